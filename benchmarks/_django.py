@@ -0,0 +1,68 @@
+"""Shared setup for the benchmark scripts.
+
+Benchmarks are run from the repository root, e.g.
+``python benchmarks/bench_message_persistence.py``. They use the development
+settings against a throwaway test database.
+"""
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup():
+    sys.path.insert(0, ROOT)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings.development')
+    os.environ.setdefault('SECRET_KEY', 'benchmark-secret-key-that-is-long-enough')
+
+    import django
+    django.setup()
+
+    from django.db import connection
+    connection.creation.create_test_db(verbosity=0)
+
+
+def create_users(count):
+    from django.contrib.auth import get_user_model
+
+    User = get_user_model()
+    return User.objects.bulk_create(
+        User(
+            username=f'bench{index}',
+            email=f'bench{index}@mail.com',
+            first_name='bench',
+            password='benchmark-password',
+            is_active=True,
+        )
+        for index in range(count)
+    )
+
+
+def websocket_application():
+    from channels.routing import URLRouter
+    from config.jwt_middleware import JWTAuthMiddleware
+    from config.routing import websocket_urlpatterns
+
+    return JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+
+
+def auth_headers(user):
+    from rest_framework_simplejwt.tokens import AccessToken
+
+    return [(b'authorization', f'Bearer {AccessToken.for_user(user)}'.encode())]
+
+
+class Timer:
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.perf_counter() - self.start
+
+
+def report(title, rows):
+    print(title)
+    for label, value in rows:
+        print(f'  {label:<50} {value}')
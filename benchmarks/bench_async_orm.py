@@ -0,0 +1,76 @@
+"""Consumer database calls through database_sync_to_async vs Django's async ORM.
+
+Runs the queries the consumers make per connection (sender username lookup)
+and per message (INSERT) from many concurrent tasks, the way one worker
+serves many sockets, and reports connections and messages per second.
+
+    python benchmarks/bench_async_orm.py [operations] [concurrency]
+"""
+import asyncio
+import sys
+
+import _django
+
+_django.setup()
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from django.contrib.auth import get_user_model
+
+from mimi.chats.models import Message
+
+User = get_user_model()
+
+
+def username_query(user_id):
+    return User.objects.filter(id=user_id).values_list('username', flat=True)
+
+
+async def connect_sync_to_async(user_id):
+    return await database_sync_to_async(lambda: username_query(user_id).first())()
+
+
+async def connect_async_orm(user_id):
+    return await username_query(user_id).afirst()
+
+
+async def message_sync_to_async(sender, receiver):
+    return await database_sync_to_async(Message.objects.create)(
+        sender_id=sender, receiver_id=receiver, message='benchmark'
+    )
+
+
+async def message_async_orm(sender, receiver):
+    return await Message.objects.acreate(sender_id=sender, receiver_id=receiver, message='benchmark')
+
+
+async def run(operation, args, count, concurrency):
+    async def worker(share):
+        for _ in range(share):
+            await operation(*args)
+
+    with _django.Timer() as timer:
+        await asyncio.gather(*(worker(count // concurrency) for _ in range(concurrency)))
+    return (count // concurrency) * concurrency / timer.elapsed
+
+
+def main(count, concurrency):
+    sender, receiver = _django.create_users(2)
+
+    rows = []
+    for label, operation, args in (
+        ('connect, database_sync_to_async', connect_sync_to_async, (sender.id,)),
+        ('connect, async ORM', connect_async_orm, (sender.id,)),
+        ('message, database_sync_to_async', message_sync_to_async, (sender.id, receiver.id)),
+        ('message, async ORM', message_async_orm, (sender.id, receiver.id)),
+    ):
+        rate = async_to_sync(run)(operation, args, count, concurrency)
+        rows.append((label, f'{rate:,.0f}/sec'))
+
+    _django.report(f'Consumer ORM calls, {count} operations, {concurrency} concurrent tasks', rows)
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    defaults = [5000, 100]
+    main(*(args + defaults[len(args):]))
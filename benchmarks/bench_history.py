@@ -0,0 +1,69 @@
+"""Time to open a conversation, backlog read from the database vs memory.
+
+Each connect to DirectMessageConsumer receives the chat's latest
+CHAT_HISTORY_SIZE messages. A cold connect reads them from the database, a
+warm one is served from the in-memory ring buffer, which the worker keeps
+while the other participant has the chat open.
+
+    python benchmarks/bench_history.py [connects] [stored messages]
+"""
+import sys
+
+import _django
+
+_django.setup()
+
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+
+from config.consumers import recent_messages
+from mimi.chats.models import ChatIDs, Message
+
+
+async def open_chats(application, chat, user, other_user, connects, cold):
+    listener = WebsocketCommunicator(
+        application, f'/ws/chat/{chat.id}/', headers=_django.auth_headers(other_user)
+    )
+    await listener.connect()
+    await listener.receive_json_from()
+
+    with _django.Timer() as timer:
+        for _ in range(connects):
+            if cold:
+                recent_messages.clear()
+            communicator = WebsocketCommunicator(
+                application, f'/ws/chat/{chat.id}/', headers=_django.auth_headers(user)
+            )
+            await communicator.connect()
+            history = await communicator.receive_json_from()
+            await communicator.disconnect()
+    await listener.disconnect()
+    assert len(history['messages']) == recent_messages.size
+    return timer.elapsed
+
+
+def main(connects, stored):
+    application = _django.websocket_application()
+    sender, receiver = _django.create_users(2)
+    chat = ChatIDs.objects.create(sender=sender, receiver=receiver, last_sequence=stored)
+    Message.objects.bulk_create(
+        Message(chat=chat, sequence=index + 1, sender=sender, receiver=receiver, message=f'message {index}')
+        for index in range(stored)
+    )
+
+    rows = []
+    for label, cold in (('backlog from the database', True), ('backlog from memory', False)):
+        elapsed = async_to_sync(open_chats)(application, chat, receiver, sender, connects, cold)
+        rows.append((label, f'{elapsed / connects * 1e3:.2f} ms per connect'))
+
+    _django.report(
+        f'Opening a chat with {stored} stored messages, {connects} connects, '
+        f'{recent_messages.size} messages of backlog',
+        rows,
+    )
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    defaults = [500, 10000]
+    main(*(args + defaults[len(args):]))
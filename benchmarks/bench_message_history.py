@@ -0,0 +1,117 @@
+"""DM history reads on a large Message table: the old unpaginated OR query
+vs keyset pages over the conversation index.
+
+The table is seeded with ``total`` messages spread over conversations of
+``conversation`` messages each; one of them is read. Pages are read
+through MessageAPIView's queryset and KeysetPagination, without HTTP.
+
+    python benchmarks/bench_message_history.py [total] [conversation] [reads]
+
+e.g. ``python benchmarks/bench_message_history.py 10000000 5000`` for the
+10M-message table (the seed alone takes several minutes).
+"""
+import sys
+import uuid
+from datetime import timedelta
+
+import _django
+
+_django.setup()
+
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from mimi.chats.api.v1.pagination import KeysetPagination
+from mimi.chats.models import Message, conversation_key
+
+SEED_BATCH = 20000
+
+
+def seed(total, conversation_size):
+    """Insert total messages straight through the cursor, much faster than
+    bulk_create, and return the two users of the first conversation."""
+    users = _django.create_users(2 * (total // conversation_size + 1))
+    fields = ['id', 'created_at', 'last_modified_at', 'sender', 'receiver', 'edit_count', 'message', 'conversation']
+    columns = [Message._meta.get_field(name) for name in fields]
+    sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+        Message._meta.db_table,
+        ', '.join(connection.ops.quote_name(column.column) for column in columns),
+        ', '.join(['%s'] * len(columns)),
+    )
+
+    start = timezone.now() - timedelta(days=365)
+    rows = []
+    with connection.cursor() as cursor:
+        for index in range(total):
+            first, second = users[2 * (index // conversation_size)], users[2 * (index // conversation_size) + 1]
+            sender, receiver = (first, second) if index % 2 else (second, first)
+            created_at = start + timedelta(seconds=index)
+            values = [uuid.uuid4(), created_at, created_at, sender.id, receiver.id, 0, f'message {index}', conversation_key(first.id, second.id)]
+            rows.append([column.get_db_prep_value(value, connection) for column, value in zip(columns, values)])
+            if len(rows) == SEED_BATCH:
+                cursor.executemany(sql, rows)
+                rows = []
+        if rows:
+            cursor.executemany(sql, rows)
+        if connection.vendor == 'postgresql':
+            cursor.execute(f'ANALYZE {Message._meta.db_table}')
+    return users[0], users[1]
+
+
+def old_query(user, other_user):
+    condition_1 = Q(receiver=other_user.id, sender=user)
+    condition_2 = Q(sender=other_user.id, receiver=user)
+    return list(Message.objects.filter(condition_1 | condition_2).select_related('sender', 'receiver'))
+
+
+def keyset_page(user, other_user, params):
+    request = Request(APIRequestFactory().get('/', params))
+    queryset = Message.objects.filter(conversation=conversation_key(user.id, other_user.id)).select_related(
+        'sender', 'receiver'
+    )
+    pagination = KeysetPagination()
+    return pagination, pagination.paginate_queryset(queryset, request)
+
+
+def timed(function, reads):
+    with _django.Timer() as timer:
+        for _ in range(reads):
+            function()
+    return timer.elapsed / reads
+
+
+def main(total, conversation_size, reads):
+    with _django.Timer() as seed_timer:
+        user, other_user = seed(total, conversation_size)
+
+    # A cursor halfway through the conversation, for a page deep in history
+    middle = Message.objects.filter(conversation=conversation_key(user.id, other_user.id)).order_by(
+        '-created_at', '-id'
+    )[conversation_size // 2]
+    deep_cursor = KeysetPagination().encode_cursor(middle)
+
+    _, page = keyset_page(user, other_user, {})
+    plan = Message.objects.filter(conversation=conversation_key(user.id, other_user.id)).order_by(
+        '-created_at', '-id'
+    )[:51].explain()
+
+    rows = [
+        ('seeding', f'{seed_timer.elapsed:.1f} s'),
+        ('old: whole conversation, OR on sender/receiver', f'{timed(lambda: old_query(user, other_user), reads) * 1e3:.2f} ms'),
+        ('keyset: latest page of 50', f'{timed(lambda: keyset_page(user, other_user, {}), reads) * 1e3:.2f} ms'),
+        ('keyset: page of 50 halfway back', f'{timed(lambda: keyset_page(user, other_user, {"before": deep_cursor}), reads) * 1e3:.2f} ms'),
+        ('keyset: page plan', ' / '.join(line.strip() for line in plan.splitlines())),
+    ]
+    assert len(page) == 50
+    _django.report(
+        f'DM history, {total:,} messages, {conversation_size:,} in the conversation read, {reads} reads', rows
+    )
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    defaults = [1000000, 5000, 20]
+    main(*(args + defaults[len(args):]))
@@ -0,0 +1,57 @@
+"""Messages/sec through DirectMessageConsumer, per-message INSERT vs write-behind.
+
+    python benchmarks/bench_message_persistence.py [messages]
+"""
+import sys
+
+import _django
+
+_django.setup()
+
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.test import override_settings
+
+from config.consumers import message_buffer
+from mimi.chats.models import ChatIDs, Message
+
+# Throughput is the point here, so sockets aren't rate limited.
+settings.CHAT_RATE_LIMIT = settings.CHAT_USER_RATE_LIMIT = 0
+
+
+async def send_messages(application, chat, sender, count):
+    communicator = WebsocketCommunicator(
+        application, f'/ws/chat/{chat.id}/', headers=_django.auth_headers(sender)
+    )
+    await communicator.connect()
+    await communicator.receive_json_from()  # history
+
+    with _django.Timer() as timer:
+        for index in range(count):
+            await communicator.send_json_to({'message': f'message {index}'})
+            await communicator.receive_json_from()
+        await message_buffer.flush()
+
+    await communicator.disconnect()
+    return timer.elapsed
+
+
+def main(count):
+    application = _django.websocket_application()
+    sender, receiver = _django.create_users(2)
+    chat = ChatIDs.objects.create(sender=sender, receiver=receiver)
+
+    rows = []
+    for label, write_behind in (('per-message create', False), ('write-behind bulk_create', True)):
+        Message.objects.all().delete()
+        with override_settings(CHAT_WRITE_BEHIND=write_behind):
+            elapsed = async_to_sync(send_messages)(application, chat, sender, count)
+        assert Message.objects.count() == count
+        rows.append((label, f'{count / elapsed:,.0f} messages/sec'))
+
+    _django.report(f'DirectMessageConsumer persistence, {count} messages', rows)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
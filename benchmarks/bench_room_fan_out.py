@@ -0,0 +1,108 @@
+"""p50/p99 delivery latency of a room message against room size, with room
+groups fanned out per worker (CHAT_ROOM_FAN_OUT) and without.
+
+Members are connected through RoomMessageConsumer and chat_message events
+carrying their send time are pushed into the room group one at a time;
+latency is measured from group_send to the frame reaching each socket.
+
+    python benchmarks/bench_room_fan_out.py [sizes] [events]
+
+e.g. ``python benchmarks/bench_room_fan_out.py 10,100,1000 20``
+"""
+import asyncio
+import json
+import statistics
+import sys
+import time
+
+import _django
+
+_django.setup()
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.test import override_settings
+
+from mimi.chats.models import Room, RoomMembers
+
+settings.CHANNEL_LAYERS['default']['CONFIG'] = {'capacity': 100000}
+
+
+async def drain(communicator, events, latencies):
+    received = 0
+    while received < events:
+        frame = json.loads((await communicator.receive_output(timeout=120))['text'])
+        if frame.get('type') != 'chat_message':
+            continue
+        latencies.append(time.perf_counter() - frame['message_info']['sent_at'])
+        received += 1
+
+
+async def publish(room, events):
+    channel_layer = get_channel_layer()
+    for _ in range(events):
+        await channel_layer.group_send(f'room_{room.id}', {
+            'type': 'chat_message',
+            'stream': f'room:{room.id}',
+            'message_info': {'message': 'x' * 80, 'sender': 'bench0', 'sent_at': time.perf_counter()},
+        })
+        # One message at a time, so latency isn't queueing behind a burst.
+        await asyncio.sleep(0.02)
+
+
+async def run(application, room, users, events):
+    path = f'/ws/room-chat/{room.id}/'
+    communicators = [
+        WebsocketCommunicator(application, path, headers=_django.auth_headers(user))
+        for user in users
+    ]
+    for communicator in communicators:
+        await communicator.connect(timeout=120)
+        await communicator.receive_output(timeout=120)  # history
+
+    # Members are told about everyone joining after them; those frames are
+    # read first so they don't count towards the latency of the messages.
+    for index, communicator in enumerate(communicators):
+        for _ in range(len(communicators) - index - 1):
+            await communicator.receive_output(timeout=120)
+
+    latencies = []
+    await asyncio.gather(
+        publish(room, events),
+        *(drain(communicator, events, latencies) for communicator in communicators),
+    )
+
+    await asyncio.gather(*(communicator.disconnect() for communicator in communicators))
+    return latencies
+
+
+def percentile(values, fraction):
+    return statistics.quantiles(values, n=100)[int(fraction * 100) - 1]
+
+
+def main(sizes, events):
+    application = _django.websocket_application()
+    users = _django.create_users(max(sizes))
+
+    rows = []
+    for size in sizes:
+        room = Room.objects.create(room_name=f'fan out {size}', description='benchmark')
+        RoomMembers.objects.bulk_create(RoomMembers(room=room, room_member=user) for user in users[:size])
+
+        for label, fan_out in (('socket per member', False), ('fanned out per worker', True)):
+            with override_settings(CHAT_ROOM_FAN_OUT=fan_out):
+                latencies = async_to_sync(run)(application, room, users[:size], events)
+            rows.append((
+                f'{size} members, {label}: p50 / p99',
+                f'{percentile(latencies, 0.5) * 1e3:.2f} ms / {percentile(latencies, 0.99) * 1e3:.2f} ms',
+            ))
+
+    _django.report(f'Room message delivery latency, {events} messages per room', rows)
+
+
+if __name__ == '__main__':
+    sizes = [int(size) for size in sys.argv[1].split(',')] if len(sys.argv) > 1 else [10, 100, 500]
+    events = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    main(sizes, events)
@@ -0,0 +1,97 @@
+"""Load test for RoomMessageConsumer built on WebsocketCommunicator.
+
+Opens one socket per room member, lets a few members send messages and waits
+until every member received every message.
+
+    python benchmarks/load_room_chat.py [members] [senders] [messages_per_sender]
+"""
+import asyncio
+import json
+import sys
+
+import _django
+
+_django.setup()
+
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+
+from mimi.chats.models import Room, RoomMembers, RoomMessages
+from mimi.chats.utils.heartbeat import connection_stats
+
+# Every member joining is announced to the others, so the default capacity of
+# 100 queued events per channel is too small for the join burst.
+settings.CHANNEL_LAYERS['default']['CONFIG'] = {'capacity': 100000}
+
+# Senders go as fast as they can, so sockets aren't rate limited.
+settings.CHAT_RATE_LIMIT = settings.CHAT_USER_RATE_LIMIT = 0
+
+
+async def drain(communicator, count):
+    # Presence frames of members joining after this one are skipped.
+    received = 0
+    while received < count:
+        frame = json.loads((await communicator.receive_output(timeout=60))['text'])
+        received += frame.get('type') == 'chat_message'
+
+
+async def send(communicator, count):
+    for index in range(count):
+        await communicator.send_json_to({'message': f'message {index}'})
+
+
+async def run(application, room, users, senders, messages_per_sender):
+    path = f'/ws/room-chat/{room.id}/'
+    communicators = [
+        WebsocketCommunicator(application, path, headers=_django.auth_headers(user))
+        for user in users
+    ]
+
+    with _django.Timer() as connect_timer:
+        results = await asyncio.gather(
+            *(communicator.connect(timeout=120) for communicator in communicators)
+        )
+    assert all(connected for connected, _ in results)
+    # Every socket gets the room's history frame first.
+    await asyncio.gather(*(communicator.receive_output(timeout=120) for communicator in communicators))
+
+    total = senders * messages_per_sender
+    with _django.Timer() as delivery_timer:
+        await asyncio.gather(
+            *(drain(communicator, total) for communicator in communicators),
+            *(send(communicator, messages_per_sender) for communicator in communicators[:senders]),
+        )
+
+    await asyncio.gather(*(communicator.disconnect() for communicator in communicators))
+    return connect_timer.elapsed, delivery_timer.elapsed
+
+
+def main(members, senders, messages_per_sender):
+    application = _django.websocket_application()
+    users = _django.create_users(members)
+    room = Room.objects.create(room_name='load test room', description='load test')
+    RoomMembers.objects.bulk_create(RoomMembers(room=room, room_member=user) for user in users)
+
+    connect_time, delivery_time = async_to_sync(run)(
+        application, room, users, senders, messages_per_sender
+    )
+
+    messages = senders * messages_per_sender
+    assert RoomMessages.objects.filter(room=room).count() == messages
+    deliveries = messages * members
+    _django.report(
+        f'RoomMessageConsumer, {members} members, {messages} messages',
+        [
+            ('connect', f'{members / connect_time:,.0f} connections/sec'),
+            ('messages', f'{messages / delivery_time:,.1f} messages/sec'),
+            ('deliveries', f'{deliveries / delivery_time:,.0f} deliveries/sec'),
+            ('left after disconnect', str(dict(connection_stats['RoomMessageConsumer']))),
+        ],
+    )
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    defaults = [1000, 5, 10]
+    main(*(args + defaults[len(args):]))
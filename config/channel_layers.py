@@ -0,0 +1,408 @@
+import asyncio
+import itertools
+import logging
+import random
+import string
+import struct
+import time
+import uuid
+from collections import defaultdict, deque
+
+import msgpack
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+logger = logging.getLogger(__name__)
+
+HEADER = struct.Struct("!I")
+
+# Bytes a worker may have waiting in the broker's socket buffer before the
+# broker drops deliveries to it rather than stall every other worker.
+MAX_WORKER_BACKLOG = 16 * 1024 * 1024
+
+
+def pack(obj):
+    return msgpack.packb(obj, use_bin_type=True)
+
+
+def unpack(data):
+    return msgpack.unpackb(data, raw=False)
+
+
+def write_frame(writer, obj):
+    data = pack(obj)
+    writer.write(HEADER.pack(len(data)) + data)
+
+
+async def read_frame(reader):
+    """The next frame sent over the socket, or None once it is closed."""
+    try:
+        header = await reader.readexactly(HEADER.size)
+        return unpack(await reader.readexactly(HEADER.unpack(header)[0]))
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+
+
+def worker_of(channel):
+    """Worker id of a process-specific channel, ``<prefix>.<worker>!<name>``."""
+    return channel[:channel.index("!")].rsplit(".", 1)[-1]
+
+
+class Mailbox:
+    """Messages waiting on one channel of this worker, oldest first."""
+
+    __slots__ = ("messages", "waiter")
+
+    def __init__(self):
+        self.messages = None
+        self.waiter = None
+
+    def __len__(self):
+        return len(self.messages) if self.messages else 0
+
+    def put(self, expires_at, message):
+        if self.messages is None:
+            self.messages = deque()
+        self.messages.append((expires_at, message))
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+
+class UnixSocketChannelLayer(BaseChannelLayer):
+    """Channel layer shared by the worker processes of one host.
+
+    Every worker connects to a ChannelBroker over the Unix socket at
+    ``path`` (run it with ``manage.py runchannelbroker``). The broker keeps
+    the groups; messages for a worker's channels are queued in that worker.
+    ``group_send`` costs the sender a single write, and the broker forwards
+    one copy per worker that has members in the group, which the worker
+    hands to each of its channels.
+
+    Capacity is enforced by the worker owning the channel. ``send`` raises
+    ChannelFull only for channels of the sending worker; for remote
+    channels, as for groups, messages over capacity are dropped. Messages
+    expire after ``expiry`` seconds, group memberships after
+    ``group_expiry``, and a channel with an expired message leaves its
+    groups. Memberships live in the broker, so they are lost if it restarts.
+    """
+
+    extensions = ["groups", "flush"]
+
+    def __init__(
+        self,
+        path="/tmp/mimi-channels.sock",
+        expiry=60,
+        group_expiry=86400,
+        capacity=100,
+        channel_capacity=None,
+        **kwargs
+    ):
+        super().__init__(expiry=expiry, capacity=capacity, **kwargs)
+        self.channel_capacity = self.compile_capacities(channel_capacity or {})
+        self.path = path
+        self.group_expiry = group_expiry
+        self.worker = uuid.uuid4().hex[:12]
+        self.channels = {}
+        self._pruned_at = time.time()
+        self._listening = set()
+        self._pending = {}
+        self._request_ids = itertools.count()
+        self._reader = None
+        self._writer = None
+        self._read_task = None
+        self._connecting = None
+
+    # Connection to the broker
+
+    async def connection(self):
+        """The writer to the broker, connecting from this event loop if needed."""
+        loop = asyncio.get_running_loop()
+        if self._read_task is not None and self._read_task.get_loop() is loop and not self._read_task.done():
+            return self._writer
+
+        if self._connecting is None or self._connecting.get_loop() is not loop:
+            self._connecting = loop.create_task(self._connect())
+        try:
+            await asyncio.shield(self._connecting)
+        finally:
+            if self._connecting is not None and self._connecting.done():
+                self._connecting = None
+        return self._writer
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_unix_connection(self.path)
+        write_frame(self._writer, {"op": "hello", "worker": self.worker})
+        self._listening = set()
+        self._read_task = asyncio.get_running_loop().create_task(self._read(self._reader))
+
+    async def _read(self, reader):
+        try:
+            while True:
+                frame = await read_frame(reader)
+                if frame is None:
+                    break
+                if frame["op"] == "deliver":
+                    self._deliver(frame["channels"], frame["message"])
+                elif frame["op"] == "ok":
+                    future = self._pending.pop(frame["id"], None)
+                    if future is not None and not future.done():
+                        future.set_result(None)
+        finally:
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Lost the channel broker"))
+            self._pending = {}
+
+    async def _request(self, frame):
+        """Send frame to the broker and wait until it has been applied."""
+        writer = await self.connection()
+        frame["id"] = next(self._request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[frame["id"]] = future
+        write_frame(writer, frame)
+        await future
+
+    async def _post(self, frame):
+        writer = await self.connection()
+        write_frame(writer, frame)
+        await writer.drain()
+
+    def _deliver(self, channels, data):
+        now = time.time()
+        if now - self._pruned_at > self.expiry:
+            self._prune(now)
+        expires_at = now + self.expiry
+        for channel in channels:
+            mailbox = self.channels.get(channel)
+            if mailbox is None:
+                # Nobody receives on it yet, or any more.
+                mailbox = self.channels[channel] = Mailbox()
+            if len(mailbox) >= self.get_capacity(channel):
+                continue
+            # Each channel gets its own copy, like deepcopy would.
+            mailbox.put(expires_at, unpack(data))
+
+    def _prune(self, now):
+        """Forget mailboxes nobody receives on once all their messages expired."""
+        self._pruned_at = now
+        for channel, mailbox in list(self.channels.items()):
+            if mailbox.waiter is None and (not mailbox.messages or mailbox.messages[-1][0] < now):
+                del self.channels[channel]
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        assert "__asgi_channel__" not in message
+
+        data = pack(message)
+        if "!" in channel and worker_of(channel) == self.worker:
+            mailbox = self.channels.setdefault(channel, Mailbox())
+            if len(mailbox) >= self.get_capacity(channel):
+                raise ChannelFull(channel)
+            mailbox.put(time.time() + self.expiry, unpack(data))
+            return
+
+        await self._post({"op": "send", "channel": channel, "message": data})
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel)
+        await self.connection()
+        if "!" not in channel and channel not in self._listening:
+            self._listening.add(channel)
+            await self._post({"op": "listen", "channel": channel})
+
+        mailbox = self.channels.setdefault(channel, Mailbox())
+        try:
+            while True:
+                while mailbox.messages:
+                    expires_at, message = mailbox.messages.popleft()
+                    if expires_at >= time.time():
+                        return message
+                    await self._post({"op": "expired", "channel": channel})
+
+                mailbox.waiter = asyncio.get_running_loop().create_future()
+                try:
+                    await mailbox.waiter
+                finally:
+                    mailbox.waiter = None
+        finally:
+            if not mailbox.messages and self.channels.get(channel) is mailbox:
+                del self.channels[channel]
+
+    async def new_channel(self, prefix="specific."):
+        name = "".join(random.choice(string.ascii_letters) for _ in range(12))
+        return f"{prefix.rstrip('.')}.{self.worker}!{name}"
+
+    async def flush(self):
+        self.channels = {}
+        await self._request({"op": "flush"})
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._read_task = None
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        await self._request({"op": "group_add", "group": group, "channel": channel})
+
+    async def group_discard(self, group, channel):
+        assert self.valid_channel_name(channel), "Invalid channel name"
+        assert self.valid_group_name(group), "Invalid group name"
+        await self._request({"op": "group_discard", "group": group, "channel": channel})
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        assert self.valid_group_name(group), "Invalid group name"
+        await self._post({"op": "group_send", "group": group, "message": pack(message)})
+
+
+class ChannelBroker:
+    """Routes messages between the UnixSocketChannelLayer of every worker.
+
+    Groups are kept as ``group -> worker -> channel -> joined_at``, so a
+    group_send writes one frame per worker, whatever the size of the group.
+    Messages for channels without a ``!`` go to the workers receiving on
+    them in turn, and wait here, ``capacity`` at most, while there are none.
+    """
+
+    def __init__(self, path="/tmp/mimi-channels.sock", expiry=60, group_expiry=86400, capacity=100, **kwargs):
+        self.path = path
+        self.expiry = expiry
+        self.group_expiry = group_expiry
+        self.capacity = capacity
+        self.workers = {}
+        self.groups = {}
+        self.waiting = defaultdict(deque)
+        self.listeners = defaultdict(deque)
+
+    async def serve(self, ready=None):
+        server = await asyncio.start_unix_server(self.handle, path=self.path)
+        if ready is not None:
+            ready.set()
+        async with server:
+            expire = asyncio.ensure_future(self.expire_memberships())
+            try:
+                await server.serve_forever()
+            finally:
+                expire.cancel()
+
+    async def handle(self, reader, writer):
+        worker = None
+        try:
+            while True:
+                frame = await read_frame(reader)
+                if frame is None:
+                    break
+
+                op = frame["op"]
+                if op == "hello":
+                    worker = frame["worker"]
+                    self.workers[worker] = writer
+                elif op == "group_send":
+                    self.group_send(frame["group"], frame["message"])
+                elif op == "send":
+                    self.send(frame["channel"], frame["message"])
+                elif op == "group_add":
+                    channel = frame["channel"]
+                    members = self.groups.setdefault(frame["group"], {})
+                    members.setdefault(self.owner(channel), {})[channel] = time.time()
+                elif op == "group_discard":
+                    self.discard(frame["group"], frame["channel"])
+                elif op == "expired":
+                    for group in list(self.groups):
+                        self.discard(group, frame["channel"])
+                elif op == "listen":
+                    self.listen(frame["channel"], worker)
+                elif op == "flush":
+                    self.groups.clear()
+                    self.waiting.clear()
+
+                if "id" in frame:
+                    write_frame(writer, {"op": "ok", "id": frame["id"]})
+        except Exception:
+            logger.exception("Channel broker dropped worker %s", worker)
+        finally:
+            if worker is not None and self.workers.get(worker) is writer:
+                self.forget(worker)
+            writer.close()
+
+    def owner(self, channel):
+        # Channels without a "!" aren't owned by a worker; "" stands for them.
+        return worker_of(channel) if "!" in channel else ""
+
+    def deliver(self, worker, channels, data):
+        writer = self.workers.get(worker)
+        if writer is None or writer.transport.get_write_buffer_size() > MAX_WORKER_BACKLOG:
+            return
+        write_frame(writer, {"op": "deliver", "channels": channels, "message": data})
+
+    def group_send(self, group, data):
+        for worker, channels in self.groups.get(group, {}).items():
+            if worker:
+                self.deliver(worker, list(channels), data)
+            else:
+                for channel in channels:
+                    self.send(channel, data)
+
+    def send(self, channel, data):
+        if "!" in channel:
+            return self.deliver(worker_of(channel), [channel], data)
+
+        listeners = self.listeners.get(channel)
+        while listeners:
+            worker = listeners[0]
+            listeners.rotate(-1)
+            if worker in self.workers:
+                return self.deliver(worker, [channel], data)
+            listeners.remove(worker)
+
+        waiting = self.waiting[channel]
+        if len(waiting) < self.capacity:
+            waiting.append((time.time() + self.expiry, data))
+
+    def listen(self, channel, worker):
+        self.listeners[channel].append(worker)
+        waiting = self.waiting.pop(channel, ())
+        now = time.time()
+        for expires_at, data in waiting:
+            if expires_at >= now:
+                self.deliver(worker, [channel], data)
+
+    def discard(self, group, channel):
+        members = self.groups.get(group)
+        if members is None:
+            return
+        channels = members.get(self.owner(channel))
+        if channels is not None:
+            channels.pop(channel, None)
+            if not channels:
+                del members[self.owner(channel)]
+        if not members:
+            del self.groups[group]
+
+    def forget(self, worker):
+        """Drop a worker that disconnected, with all its channels' memberships."""
+        del self.workers[worker]
+        for group, members in list(self.groups.items()):
+            members.pop(worker, None)
+            if not members:
+                del self.groups[group]
+
+    async def expire_memberships(self):
+        while True:
+            await asyncio.sleep(min(self.group_expiry, 60))
+            expired_before = time.time() - self.group_expiry
+            for group, members in list(self.groups.items()):
+                for channel, joined_at in [
+                    (channel, joined_at)
+                    for channels in members.values()
+                    for channel, joined_at in channels.items()
+                ]:
+                    if joined_at < expired_before:
+                        self.discard(group, channel)
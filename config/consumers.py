@@ -1,112 +1,1176 @@
-import json
+import asyncio
+import time
+import uuid
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from channels.exceptions import StopConsumer
 from channels.generic.websocket import AsyncWebsocketConsumer
-from mimi.chats.models import Message, RoomMembers, Room
-from channels.db import database_sync_to_async
+from mimi.chats.models import ChatIDs, Message, RoomMembers, RoomMessages
+from mimi.chats.utils.codecs import JSON_CODEC, dumps, loads, negotiate
+from mimi.chats.utils.constants import HEARTBEAT_TIMEOUT_CLOSE_CODE, SLOW_CONSUMER_CLOSE_CODE
+from mimi.chats.utils.fanout import GroupFanOut
+from mimi.chats.utils.heartbeat import HeartbeatMonitor, connection_stats
+from mimi.chats.utils.history import RecentMessages
+from mimi.chats.utils.inbox import record_messages
+from mimi.chats.utils.metrics import (
+    connect_seconds,
+    delivery_seconds,
+    frames_rate_limited,
+    group_send_seconds,
+    persist_seconds,
+    receive_seconds,
+)
+from mimi.chats.utils.outbound import DROP_OLDEST, OutboundQueue, outbound_stats
+from mimi.chats.utils.presence import Debouncer, PresenceRegistry
+from mimi.chats.utils.rate_limit import RateLimiter, TokenBucket
+from mimi.chats.utils.sequences import SequenceBlocks, build_sequenced_message, create_sequenced_message
+from mimi.chats.utils.watermarks import ReadWatermarks
+from mimi.chats.utils.write_behind import WriteBehindBuffer
+from mimi.utils.caches import LRUCache
+from mimi.utils.metrics import registry
 from asgiref.sync import sync_to_async
+from django.db import IntegrityError
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from django.contrib.auth import get_user_model
 
-class DirectMessageConsumer(AsyncWebsocketConsumer):
-    async def connect(self):
-        self.id = self.scope['url_route']['kwargs']['chat_id']
-        self.chat_room_name = f'chat_{self.id}'
 
-        await self.accept()
+User = get_user_model()
 
-        if self.is_error():
-            error = {
-                'error': str(self.scope['error'])
-            }
-            await self.send(text_data=json.dumps(error))
-            await self.close()
 
-        else:            
-            await self.channel_layer.group_add(    
-                self.chat_room_name,
-                self.channel_name
+# A retried send that slipped past the dedupe cache is dropped by the
+# (sender, client_message_id) constraint rather than failing its batch.
+message_buffer = WriteBehindBuffer(
+    Message,
+    batch_size=getattr(settings, 'CHAT_WRITE_BEHIND_BATCH_SIZE', 100),
+    flush_interval=getattr(settings, 'CHAT_WRITE_BEHIND_FLUSH_INTERVAL', 0.05),
+    ignore_conflicts=True,
+    on_write=record_messages,
+)
+
+room_message_buffer = WriteBehindBuffer(
+    RoomMessages,
+    batch_size=getattr(settings, 'CHAT_WRITE_BEHIND_BATCH_SIZE', 100),
+    flush_interval=getattr(settings, 'CHAT_WRITE_BEHIND_FLUSH_INTERVAL', 0.05),
+)
+
+# Sequence numbers of write-behind direct messages, see SequenceBlocks for
+# what blocks larger than 1 give up
+sequence_blocks = SequenceBlocks(size=getattr(settings, 'CHAT_SEQUENCE_BLOCK', 1))
+
+# message_info of recently sent direct messages keyed by (sender, client message id)
+recent_client_message_ids = LRUCache(
+    maxsize=getattr(settings, 'CHAT_DEDUPE_CACHE_SIZE', 10000)
+)
+
+# User ids of a chat's two participants, keyed by chat id. A chat's
+# participants never change, so entries don't expire.
+chat_participants = LRUCache(
+    maxsize=getattr(settings, 'CHAT_PARTICIPANTS_CACHE_SIZE', 10000)
+)
+
+# Backlog sent when a conversation is opened, keyed by stream
+recent_messages = RecentMessages(
+    size=getattr(settings, 'CHAT_HISTORY_SIZE', 50),
+    conversations=getattr(settings, 'CHAT_HISTORY_CONVERSATIONS', 1000),
+    ttl=getattr(settings, 'CHAT_HISTORY_TTL', 60),
+)
+
+# Pings quiet sockets and reaps half-open ones, see HeartbeatMonitor
+heartbeat_monitor = HeartbeatMonitor(
+    interval=getattr(settings, 'CHAT_HEARTBEAT_INTERVAL', 30),
+    timeout=getattr(settings, 'CHAT_HEARTBEAT_TIMEOUT', 75),
+)
+
+# Presence and typing are ephemeral: they live in the cache and in memory and
+# never go through the message write path. The TTL has to outlast the gap
+# between two refreshes of an idle client, see CHAT_PRESENCE_TTL.
+online_users = PresenceRegistry(
+    ttl=getattr(settings, 'CHAT_PRESENCE_TTL', 4 * heartbeat_monitor.interval)
+)
+if online_users.ttl <= 3 * heartbeat_monitor.interval:
+    raise ImproperlyConfigured(
+        'CHAT_PRESENCE_TTL must be more than three CHAT_HEARTBEAT_INTERVALs, '
+        'or idle users drop offline between two heartbeats'
+    )
+
+# "is typing" events let through per (user, stream)
+typing_debouncer = Debouncer(interval=getattr(settings, 'CHAT_TYPING_INTERVAL', 0.3))
+
+# Inbound frames of every connection of a user, by (consumer class, user)
+user_rate_limiter = RateLimiter(maxsize=getattr(settings, 'CHAT_RATE_LIMIT_USERS', 10000))
+
+# Rooms read by their members, written at most once per interval per member
+read_watermarks = ReadWatermarks(interval=getattr(settings, 'CHAT_READ_WATERMARK_INTERVAL', 5))
+
+# Room groups are joined once per worker and fanned out locally, see GroupFanOut
+room_fan_out = GroupFanOut(batch=getattr(settings, 'CHAT_FAN_OUT_BATCH', 500))
+
+# Per-worker state, read when the metrics are scraped
+registry.gauge(
+    'chat_connections',
+    'Open sockets and the channel layer groups they joined, per consumer class.',
+    lambda: [
+        ({'consumer': consumer, 'stat': name}, value)
+        for consumer, stats in connection_stats.items()
+        for name, value in stats.items()
+    ],
+)
+registry.gauge(
+    'chat_outbound_frames',
+    'Frames queued, dropped and connections closed for falling behind, per consumer class.',
+    lambda: [
+        ({'consumer': consumer, 'stat': name}, value)
+        for consumer, stats in outbound_stats.items()
+        for name, value in stats.items()
+    ],
+)
+registry.gauge(
+    'chat_recent_messages',
+    'Conversations held by the backlog buffer, its capacity, hits and misses.',
+    lambda: [({'stat': name}, value) for name, value in recent_messages.stats().items()],
+)
+registry.gauge(
+    'chat_fanned_out_groups',
+    'Groups this worker relays to its own sockets.',
+    lambda: [({}, len(room_fan_out))],
+)
+
+
+class BaseChatConsumer(AsyncWebsocketConsumer):
+    """Plumbing shared by the chat consumers."""
+
+    # Outbound backpressure, see OutboundQueue. None falls back to the
+    # CHAT_OUTBOUND_QUEUE_SIZE, CHAT_OUTBOUND_POLICY and CHAT_OUTBOUND_WINDOW
+    # settings.
+    outbound_queue_size = None
+    outbound_policy = None
+    outbound_window = None
+    outbound = None
+
+    # Opt-in batching of chat_message events, see coalesce(). None falls back
+    # to CHAT_COALESCE_WINDOW (seconds, 0 disables) and CHAT_COALESCE_MAX_BATCH.
+    coalesce_window = None
+    coalesce_max_batch = None
+    pending_batch = None
+    batch_timer = None
+    batch_flush = None
+
+    # Wire format of the connection, picked from the offered subprotocols
+    codec = JSON_CODEC
+
+    # Whether the socket counts towards the user's presence, see go_online()
+    online = False
+
+    # Set once disconnect() has run, so a reaped socket isn't cleaned up twice
+    disconnected = False
+
+    # Inbound frames per second and burst, per connection and per user across
+    # their connections; 0 disables a limit. None falls back to the
+    # CHAT_RATE_LIMIT(_BURST) and CHAT_USER_RATE_LIMIT(_BURST) settings.
+    rate_limit = None
+    rate_limit_burst = None
+    user_rate_limit = None
+    user_rate_limit_burst = None
+    rate_bucket = None
+    throttled = False
+
+    # Whether every frame is limited before it is decoded. The multiplexed
+    # socket decodes first and limits by action instead, see its receive().
+    rate_limit_raw_frames = True
+
+    async def accept(self, subprotocol=None):
+        self.codec = negotiate(self.scope)
+        await super().accept(subprotocol or self.codec.subprotocol)
+        heartbeat_monitor.register(self)
+
+    async def websocket_connect(self, message):
+        started = time.perf_counter()
+        try:
+            await super().websocket_connect(message)
+        finally:
+            connect_seconds.labels(type(self).__name__).observe(time.perf_counter() - started)
+
+    async def websocket_receive(self, message):
+        # Any frame from the client proves the connection is alive.
+        self.last_seen = time.monotonic()
+        started = time.perf_counter()
+
+        # Checked before the frame is decoded, so a flood costs no parsing
+        # and no database work.
+        retry_after = self.check_rate_limit() if self.rate_limit_raw_frames else 0
+        if retry_after:
+            frames_rate_limited.labels(type(self).__name__).inc()
+            # One error per run of rejected frames, not one per frame
+            if not self.throttled:
+                self.throttled = True
+                await self.send_frame({
+                    'type': 'error',
+                    'error': 'Too many messages, slow down',
+                    'retry_after': round(retry_after, 3),
+                })
+            return
+
+        self.throttled = False
+        try:
+            await super().websocket_receive(message)
+        finally:
+            receive_seconds.labels(type(self).__name__).observe(time.perf_counter() - started)
+
+    def check_rate_limit(self):
+        """Seconds until the client may send again, or 0 if this frame is allowed."""
+        rate = self.get_setting('rate_limit', 'CHAT_RATE_LIMIT', 10)
+        if rate:
+            if self.rate_bucket is None:
+                self.rate_bucket = TokenBucket(rate, self.get_setting('rate_limit_burst', 'CHAT_RATE_LIMIT_BURST', 20))
+            if not self.rate_bucket.take():
+                return self.rate_bucket.retry_after()
+
+        rate = self.get_setting('user_rate_limit', 'CHAT_USER_RATE_LIMIT', 20)
+        if rate and self.scope.get('user') is not None:
+            bucket = user_rate_limiter.bucket(
+                (type(self).__name__, str(self.scope['user'])),
+                rate,
+                self.get_setting('user_rate_limit_burst', 'CHAT_USER_RATE_LIMIT_BURST', 40),
             )
+            if not bucket.take():
+                return bucket.retry_after()
 
-    
-    async def disconnect(self, close_code):
+        return 0
 
-        self.channel_layer.group_discard(
-            self.chat_room_name,
-            self.channel_name
-        )
+    def get_setting(self, attribute, setting, default):
+        value = getattr(self, attribute)
+        if value is None:
+            return getattr(settings, setting, default)
+        return value
 
-    async def receive(self, text_data):
-        if self.scope.get('user') is not None:
-            sender_id = self.scope.get('user')
+    async def ping(self):
+        """Ask a quiet client for a frame; it answers {"action": "pong"}."""
+        await self.send_frame({'type': 'ping'})
 
+    async def reap(self):
+        """Clean up after a socket that stopped answering pings and close it,
+        instead of waiting for the OS to notice the connection is gone."""
+        self.disconnected = True
+        heartbeat_monitor.unregister(self)
+        self.pending_batch = None
+        if self.outbound is not None:
+            self.outbound.cancel()
+        await self.disconnect(HEARTBEAT_TIMEOUT_CLOSE_CODE)
+        await self.close(code=HEARTBEAT_TIMEOUT_CLOSE_CODE)
 
-            text_data_json = json.loads(text_data)
-            
-            message = text_data_json['message']
-            receiver_id = text_data_json['receiver_id']
+    async def send_frame(self, obj):
+        await self.send(**self.codec.encode(obj))
 
-            message = await database_sync_to_async(Message.objects.create)(
-                sender_id=sender_id,
-                receiver_id=receiver_id,  
-                message=message
-            )    
+    def decode_frame(self, text_data=None, bytes_data=None):
+        return self.codec.decode(text_data, bytes_data)
 
-            await self.channel_layer.group_send(
-                self.chat_room_name,
-            {
-                'type': 'chat_message',
-                'message_info': await self.message_information(message),
-                }
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        if text_data is not None or bytes_data is not None:
+            if not self.queue_frame({'text_data': text_data, 'bytes_data': bytes_data}):
+                # The queue already dropped its frames and the stalled write;
+                # waiting on anything more would hold up whoever sent this
+                # frame, such as the room's fan-out relay.
+                self.pending_batch = None
+                return await super().close(code=SLOW_CONSUMER_CLOSE_CODE)
+
+        if close:
+            await self.close(None if close is True else close)
+
+    def queue_frame(self, frame):
+        if self.outbound is None:
+            self.outbound = OutboundQueue(
+                self.write_frame,
+                maxsize=self.outbound_queue_size or getattr(settings, 'CHAT_OUTBOUND_QUEUE_SIZE', 256),
+                policy=self.outbound_policy or getattr(settings, 'CHAT_OUTBOUND_POLICY', DROP_OLDEST),
+                stats_key=type(self).__name__,
+                window=self.outbound_window or getattr(settings, 'CHAT_OUTBOUND_WINDOW', 256),
             )
-        
+
+        return self.outbound.put(frame)
+
+    async def write_frame(self, frame):
+        if 'overflow' in frame:
+            frame = self.codec.encode({'type': 'overflow', 'dropped': frame['overflow']})
+        await super().send(**frame)
+
+    def acknowledge(self, received):
+        """The client has received ``received`` frames of this socket in all,
+        answering {"action": "ack", "received": <count>}."""
+        if self.outbound is not None and isinstance(received, int):
+            self.outbound.ack(received)
+
+    async def close(self, code=None):
+        await self.flush_batch()
+        if self.outbound is not None:
+            await self.outbound.join()
+        await super().close(code)
+
+    async def websocket_disconnect(self, message):
+        if self.batch_timer is not None:
+            self.batch_timer.cancel()
+            self.batch_timer = None
+        self.pending_batch = None
+        if self.outbound is not None:
+            self.outbound.clear()
+        heartbeat_monitor.unregister(self)
+
+        if self.disconnected:
+            raise StopConsumer()
+        self.disconnected = True
+        await super().websocket_disconnect(message)
+
+    async def send_error(self):
+        await self.accept()
+        error = {
+            'error': str(self.scope['error'])
+        }
+        await self.send_frame(error)
+        await self.close()
+
+    async def save_message(self, buffer, **fields):
+        """Store the message now, or hand it to the write-behind buffer."""
+        started = time.perf_counter()
+        try:
+            if getattr(settings, 'CHAT_WRITE_BEHIND', False):
+                message = buffer.model(**fields)
+                await buffer.add(message)
+                return message
+
+            return await buffer.model.objects.acreate(**fields)
+        finally:
+            persist_seconds.labels(buffer.model.__name__).observe(time.perf_counter() - started)
+
+    async def group_send(self, group_name, event):
+        started = time.perf_counter()
+        await self.channel_layer.group_send(group_name, event)
+        group_send_seconds.labels(type(self).__name__).observe(time.perf_counter() - started)
+
+    def user_group_name(self, user_id):
+        return f'user_{user_id}'
+
+    async def join_group(self, group_name):
+        if self.is_fanned_out(group_name):
+            await room_fan_out.join(self.channel_layer, group_name, self)
+        else:
+            await self.channel_layer.group_add(group_name, self.channel_name)
+        connection_stats[type(self).__name__]['group_memberships'] += 1
+
+    async def leave_group(self, group_name):
+        if self.is_fanned_out(group_name):
+            await room_fan_out.leave(self.channel_layer, group_name, self)
+        else:
+            await self.channel_layer.group_discard(group_name, self.channel_name)
+        connection_stats[type(self).__name__]['group_memberships'] -= 1
+
+    def is_fanned_out(self, group_name):
+        """Whether group_name is joined through the worker's relay instead
+        of by this socket's own channel."""
+        return False
+
+    async def join_user_group(self):
+        """Every authenticated socket joins ``user_<id>``, which is where
+        direct messages for that user are delivered."""
+        await self.join_group(self.user_group_name(self.scope['user']))
+
+    async def leave_user_group(self):
+        await self.leave_group(self.user_group_name(self.scope['user']))
+
+    def accepts_stream(self, stream):
+        return True
+
+    async def go_online(self):
+        """Count this socket towards the user's presence."""
+        self.online = True
+        await online_users.connect(self.scope['user'])
+
+    async def go_offline(self):
+        if not self.online:
+            return
+
+        streams = list(self.present_streams())
+        self.online = False
+        await online_users.disconnect(self.scope['user'])
+        # Still online when the user has other sockets open.
+        online = await online_users.is_online(self.scope['user'])
+        for stream in streams:
+            await self.leave(stream, online)
+
+    async def enter(self, stream):
+        recent_messages.listen(stream)
+        await self.announce(stream, {'type': 'presence', 'online': True})
+
+    async def leave(self, stream, online=True):
+        recent_messages.unlisten(stream)
+        await self.announce(stream, {'type': 'presence', 'online': online})
+
+    def present_streams(self):
+        """Streams the others were told this user is present on."""
+        return (self.stream,) if self.online else ()
+
+    def participants_for(self, stream):
+        """Users of a chat stream, empty when this user isn't one of them."""
+        return ()
+
+    async def heartbeat(self):
+        """Any frame from the client keeps the user's presence alive."""
+        if self.online:
+            await online_users.heartbeat(self.scope['user'])
+
+    async def send_typing(self, stream):
+        if stream not in self.present_streams():
+            return
+
+        kind, _, stream_id = stream.partition(':')
+        if typing_debouncer.allow((str(self.scope['user']), self.stream_name(kind, stream_id))):
+            await self.announce(stream, {'type': 'typing'})
+
+    async def announce(self, stream, event):
+        """Send an ephemeral event about this user to everyone on stream."""
+        event.update(stream=stream, user=str(self.scope['user']), username=self.sender_username)
+        for group_name in self.groups_for(stream):
+            await self.group_send(group_name, event)
+
+    def groups_for(self, stream):
+        kind, _, stream_id = stream.partition(':')
+        if kind == 'room':
+            return [self.room_group_name_for(stream_id)]
+        return [self.user_group_name(user_id) for user_id in self.participants_for(stream)]
+
+    async def presence(self, event):
+        await self.deliver_about_others(event)
+
+    async def typing(self, event):
+        await self.deliver_about_others(event)
+
+    async def deliver_about_others(self, event):
+        # The user's own sockets share its groups; they don't need telling.
+        if event['user'] != str(self.scope['user']):
+            await self.deliver(event)
+
+    def stream_name(self, kind, stream_id):
+        """``<kind>:<id>`` with the id in canonical UUID form, so streams
+        named by URL route and by client frames share a history buffer."""
+        return f'{kind}:{uuid.UUID(str(stream_id))}'
+
+    async def send_history(self, stream, messages):
+        await self.deliver({
+            'type': 'history',
+            'stream': stream,
+            'messages': messages,
+        })
+
     async def chat_message(self, event):
-        
-        await self.send(text_data=json.dumps(event))
+        started = time.perf_counter()
+        # Every local socket on the stream gets the broadcast; the buffer
+        # keeps it once, whichever worker it was sent through.
+        message_id = event.pop('message_id', None)
+        if message_id is not None:
+            recent_messages.append(event['stream'], event['message_info'], message_id)
+
+        frame = self.frame_for(event)
+        if frame is None:
+            return
+
+        if self.get_coalesce_window():
+            await self.coalesce(frame)
+        else:
+            await self.send_frame(frame)
+        delivery_seconds.labels(type(self).__name__).observe(time.perf_counter() - started)
+
+    async def deliver(self, event):
+        frame = self.frame_for(event)
+        if frame is not None:
+            await self.send_frame(frame)
+
+    def frame_for(self, event):
+        """The JSON frame sent to the client for event, or None to skip it."""
+        if not self.accepts_stream(event.get('stream')):
+            return None
+        return event
+
+    def get_coalesce_window(self):
+        if self.coalesce_window is None:
+            return getattr(settings, 'CHAT_COALESCE_WINDOW', 0)
+        return self.coalesce_window
+
+    async def coalesce(self, frame):
+        """Collect chat_message frames and send them as one JSON array frame.
+
+        The batch goes out ``coalesce_window`` seconds after its first
+        frame, or as soon as it holds ``coalesce_max_batch`` frames.
+        """
+        if self.pending_batch is None:
+            self.pending_batch = []
+            loop = asyncio.get_running_loop()
+            self.batch_timer = loop.call_later(self.get_coalesce_window(), self.flush_batch_later)
+
+        self.pending_batch.append(frame)
+        max_batch = self.coalesce_max_batch or getattr(settings, 'CHAT_COALESCE_MAX_BATCH', 50)
+        if len(self.pending_batch) >= max_batch:
+            await self.flush_batch()
+
+    def flush_batch_later(self):
+        self.batch_timer = None
+        self.batch_flush = asyncio.ensure_future(self.flush_batch())
+
+    async def flush_batch(self):
+        if self.batch_timer is not None:
+            self.batch_timer.cancel()
+            self.batch_timer = None
+
+        batch, self.pending_batch = self.pending_batch, None
+        if batch:
+            await self.send_frame(batch)
 
-    @sync_to_async
     def message_information(self, message):
         return {
             "message": message.message,
-            "sender": message.sender.username       
+            "sender": self.sender_username
             }
 
+    async def get_username(self, user_id):
+        return await User.objects.filter(id=user_id).values_list('username', flat=True).afirst()
+
     def is_error(self):
+        return bool(self.scope.get('error'))
+
+
+class DirectMessageMixin:
+    """Sending a direct message to the ``user_<id>`` groups of both participants."""
+
+    chat_error = "Chat doesn't exist or you aren't part of the chat"
+
+    async def get_participants(self, chat_id):
+        """User ids of the participants of a chat, empty when it doesn't exist.
+
+        Read with one query the first time this worker sees the chat.
+        """
+        chat_id = uuid.UUID(str(chat_id))
+        participants = chat_participants.get(chat_id)
+        if participants is None:
+            row = await ChatIDs.objects.filter(id=chat_id).values_list(
+                'sender_id', 'receiver_id'
+            ).afirst()
+            if row is None:
+                return frozenset()
+            participants = frozenset(str(user_id) for user_id in row)
+            chat_participants.set(chat_id, participants)
+        return participants
+
+    def receiver_for(self, participants):
+        """The participant other than the user; the user in a chat with themselves."""
+        user_id = str(self.scope['user'])
+        return next(iter(participants - {user_id}), user_id)
+
+    async def send_direct_message(self, chat_id, participants, data):
+        """Send to the chat whose participants were checked on connect or
+        subscribe; the receiver is taken from them, not from the frame."""
+        receiver_id = self.receiver_for(participants)
+        client_message_id = data.get('client_message_id')
+        if client_message_id is not None:
+            client_message_id = str(client_message_id)
+            if len(client_message_id) > 64:
+                return await self.deliver({
+                    'type': 'error',
+                    'stream': f'chat:{chat_id}',
+                    'error': 'client_message_id is longer than 64 characters',
+                })
+
+            dedupe_key = (str(self.scope['user']), client_message_id)
+            message_info = recent_client_message_ids.get(dedupe_key)
+            if message_info is None and getattr(settings, 'CHAT_WRITE_BEHIND', False):
+                # Buffered rows are broadcast before they are stored, and a
+                # retry's row would only be skipped as a conflict after its
+                # broadcast under a new sequence number, so a cache miss is
+                # checked here. A retry through another worker within a
+                # flush interval of the original still slips through.
+                message = message_buffer.find(sender_id=self.scope['user'], client_message_id=client_message_id)
+                if message is None:
+                    message = await Message.objects.filter(
+                        sender_id=self.scope['user'], client_message_id=client_message_id
+                    ).afirst()
+                if message is not None:
+                    message_info = self.direct_message_information(message)
+                    recent_client_message_ids.set(dedupe_key, message_info)
+            if message_info is not None:
+                return await self.acknowledge_duplicate(chat_id, message_info)
+
         try:
-            if self.scope['error']:
-                return True
-        except:
-            return False
+            message = await self.save_direct_message(
+                chat_id,
+                sender_id=self.scope['user'],
+                receiver_id=receiver_id,
+                message=data['message'],
+                client_message_id=client_message_id,
+            )
+        except IntegrityError:
+            if client_message_id is None:
+                raise
+            # Sent before through another worker, or evicted from the cache.
+            message = await Message.objects.filter(
+                sender_id=self.scope['user'], client_message_id=client_message_id
+            ).afirst()
+            if message is None:
+                raise
+            message_info = self.direct_message_information(message)
+            recent_client_message_ids.set(dedupe_key, message_info)
+            return await self.acknowledge_duplicate(chat_id, message_info)
+
+        message_info = self.direct_message_information(message)
+        if client_message_id is not None:
+            recent_client_message_ids.set(dedupe_key, message_info)
+
+        event = {
+            'type': 'chat_message',
+            'stream': f'chat:{chat_id}',
+            'message_info': message_info,
+            'message_id': str(message.id),
+        }
+        # One group per participant reaches every device they have connected,
+        # however many conversations each of them has open.
+        for user_id in participants:
+            await self.group_send(self.user_group_name(user_id), event)
+
+    def direct_message_information(self, message):
+        message_info = self.message_information(message)
+        message_info['sequence'] = message.sequence
+        if message.client_message_id is not None:
+            message_info['client_message_id'] = message.client_message_id
+        return message_info
+
+    def row_information(self, row):
+        """message_info of a Message row read with ``values()``."""
+        message_info = {
+            'message': row['message'],
+            'sender': row['sender__username'],
+            'sequence': row['sequence'],
+        }
+        if row['client_message_id'] is not None:
+            message_info['client_message_id'] = row['client_message_id']
+        return message_info
 
-        
+    async def acknowledge_duplicate(self, chat_id, message_info):
+        """Answer a retried send without storing or broadcasting it again."""
+        await self.deliver({
+            'type': 'ack',
+            'stream': f'chat:{chat_id}',
+            'duplicate': True,
+            'message_info': message_info,
+        })
 
-class RoomMessageConsumer(AsyncWebsocketConsumer):
+    async def save_direct_message(self, chat_id, **fields):
+        """Store a direct message under the chat's next sequence number."""
+        started = time.perf_counter()
+        try:
+            if getattr(settings, 'CHAT_WRITE_BEHIND', False):
+                sequence = sequence_blocks.take(chat_id)
+                if sequence is None:
+                    sequence = await sync_to_async(sequence_blocks.reserve)(chat_id)
+                message = build_sequenced_message(chat_id, sequence, **fields)
+                await message_buffer.add(message)
+                return message
+
+            return await sync_to_async(create_sequenced_message)(chat_id, **fields)
+        finally:
+            persist_seconds.labels(Message.__name__).observe(time.perf_counter() - started)
+
+    async def resume(self, chat_id, last_sequence):
+        """Replay the messages of a chat sent after ``last_sequence``.
+
+        One range query over the (chat, sequence) index, capped at
+        CHAT_RESUME_LIMIT messages; ``complete`` is false when the client
+        has to page through the rest of the history over REST.
+        """
+        try:
+            last_sequence = int(last_sequence)
+        except (TypeError, ValueError):
+            return await self.deliver({
+                'type': 'error',
+                'stream': f'chat:{chat_id}',
+                'error': 'last_sequence must be an integer',
+            })
+
+        # Buffered messages already have their sequence numbers, so they
+        # must be stored before the range is read.
+        await message_buffer.flush()
+
+        limit = getattr(settings, 'CHAT_RESUME_LIMIT', 500)
+        user_id = self.scope['user']
+        missed = Message.objects.filter(
+            Q(sender_id=user_id) | Q(receiver_id=user_id),
+            chat_id=chat_id,
+            sequence__gt=last_sequence,
+        ).order_by('sequence').values(
+            'message', 'sequence', 'client_message_id', 'sender__username'
+        )
+
+        complete = True
+        replayed = 0
+        async for row in missed[:limit + 1]:
+            if replayed == limit:
+                complete = False
+                break
+            replayed += 1
+            last_sequence = row['sequence']
+            await self.deliver({
+                'type': 'chat_message',
+                'stream': f'chat:{chat_id}',
+                'message_info': self.row_information(row),
+            })
+
+        await self.deliver({
+            'type': 'resumed',
+            'stream': f'chat:{chat_id}',
+            'last_sequence': last_sequence,
+            'complete': complete,
+        })
+
+    async def send_direct_history(self, chat_id, participants):
+        """Send the latest messages of a chat the user is part of, from
+        memory when possible."""
+        stream = self.stream_name('chat', chat_id)
+        cached = recent_messages.get(stream)
+        if cached is None:
+            messages = await recent_messages.load(
+                stream, lambda: self.load_direct_history(chat_id), participants
+            )
+        else:
+            messages, _ = cached
+
+        await self.send_history(f'chat:{chat_id}', messages)
+
+    async def load_direct_history(self, chat_id):
+        # Buffered messages must be stored before the latest ones are read.
+        await message_buffer.flush()
+
+        latest = Message.objects.filter(chat_id=chat_id).order_by('-sequence').values(
+            'id', 'message', 'sequence', 'client_message_id', 'sender__username'
+        )[:recent_messages.size]
+        rows = [(row['id'], self.row_information(row)) async for row in latest]
+        rows.reverse()
+        return rows
+
+
+class RoomMessageMixin:
+    """Sending to a room, group ``room_<room_id>``."""
+
+    def room_group_name_for(self, room_id):
+        return f'room_{room_id}'
+
+    def is_fanned_out(self, group_name):
+        # Rooms are the groups that grow to thousands of sockets.
+        if group_name.startswith('room_') and getattr(settings, 'CHAT_ROOM_FAN_OUT', True):
+            return True
+        return super().is_fanned_out(group_name)
+
+    async def send_room_message(self, room_id, data):
+        message = await self.save_message(
+            room_message_buffer,
+            room_id=room_id,
+            sender_id=self.scope['user'],
+            message=data['message']
+        )
+        message_info = self.message_information(message)
+
+        await self.group_send(
+            self.room_group_name_for(room_id),
+            {
+                'type': 'chat_message',
+                'stream': f'room:{room_id}',
+                'message_info': message_info,
+                'message_id': str(message.id),
+                'created_at': message.created_at.isoformat(),
+            }
+        )
+
+    async def chat_message(self, event):
+        stream = event.get('stream', '')
+        created_at = event.pop('created_at', None)
+        await super().chat_message(event)
+        # A room message shown on an open stream counts as read, up to the
+        # time it was sent.
+        if stream.startswith('room:') and stream in self.present_streams():
+            read_watermarks.advance(
+                stream.partition(':')[2], self.scope['user'], created_at and parse_datetime(created_at)
+            )
+
+    async def check_membership(self, room_id):
+        """This checks if user is a member of a room"""
+        return await RoomMembers.objects.filter(
+            room_id=room_id, room_member_id=self.scope['user']
+        ).aexists()
+
+    async def send_room_history(self, room_id):
+        """Send the latest messages of a room the user is a member of."""
+        stream = self.stream_name('room', room_id)
+        cached = recent_messages.get(stream)
+        if cached is None:
+            messages = await recent_messages.load(stream, lambda: self.load_room_history(room_id))
+        else:
+            messages, _ = cached
+
+        await self.send_history(f'room:{room_id}', messages)
+        read_watermarks.advance(room_id, self.scope['user'])
+
+    async def load_room_history(self, room_id):
+        # Buffered messages must be stored before the latest ones are read.
+        await room_message_buffer.flush()
+
+        latest = RoomMessages.objects.filter(room_id=room_id).order_by(
+            '-created_at'
+        ).values('id', 'message', 'sender__username')[:recent_messages.size]
+        rows = [
+            (row['id'], {'message': row['message'], 'sender': row['sender__username']})
+            async for row in latest
+        ]
+        rows.reverse()
+        return rows
+
+
+class DirectMessageConsumer(DirectMessageMixin, BaseChatConsumer):
+
+    # Idle sockets make up most connections, so per-connection state is kept
+    # small: values derived from the scope are read from it, not copied.
+    participants = ()
+
+    @property
+    def id(self):
+        # The route accepts upper case ids; groups, keys and streams use the
+        # canonical form the multiplexed sockets use.
+        return str(uuid.UUID(self.scope['url_route']['kwargs']['chat_id']))
+
+    @property
+    def stream(self):
+        return f'chat:{self.id}'
+
+    async def connect(self):
+        if not self.is_error():
+            # Participation is checked once per connection; every message
+            # sent afterwards relies on it and goes to these participants.
+            participants = await self.get_participants(self.id)
+            if str(self.scope['user']) in participants:
+                # Shared with the participants cache, not a copy
+                self.participants = participants
+            else:
+                self.scope['error'] = self.chat_error
+
+        if self.is_error():
+            await self.send_error()
+
+        else:
+            # The sender is the same for the whole connection, so its display
+            # name is resolved once here instead of once per message.
+            self.sender_username = await self.get_username(self.scope['user'])
+
+            # Joining before accepting means a client never sees an open
+            # socket that can still miss messages.
+            await self.join_user_group()
+            await self.accept()
+            await self.go_online()
+            await self.send_direct_history(self.id, self.participants)
+            await self.enter(self.stream)
+
+    
+    async def disconnect(self, close_code):
+        if not self.is_error():
+            await self.go_offline()
+            await self.leave_user_group()
+
+        await message_buffer.flush()
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if self.participants:
+            text_data_json = self.decode_frame(text_data, bytes_data)
+            await self.heartbeat()
+            action = text_data_json.get('action')
+
+            if action == 'resume':
+                await self.resume(self.id, text_data_json.get('last_sequence'))
+            elif action == 'typing':
+                await self.send_typing(self.stream)
+            elif action == 'ack':
+                self.acknowledge(text_data_json.get('received'))
+            elif action not in ('heartbeat', 'pong'):
+                await self.send_direct_message(self.id, self.participants, text_data_json)
+
+    def accepts_stream(self, stream):
+        # The user group carries all of this user's conversations; this
+        # socket only shows its own.
+        return stream == self.stream
+
+    def participants_for(self, stream):
+        return self.participants
+
+
+class RoomMessageConsumer(RoomMessageMixin, BaseChatConsumer):
+
+    is_member = False
+
+    @property
+    def room_id(self):
+        return str(uuid.UUID(self.scope['url_route']['kwargs']['room_id']))
+
+    @property
+    def room_group_name(self):
+        return self.room_group_name_for(self.room_id)
+
+    @property
+    def stream(self):
+        return f'room:{self.room_id}'
 
     async def connect(self):
-        self.room_id = self.scope['url_route']['kwargs']['room_id']
-        self.room_chat_room_name = f'chat_{self.id}'
+        if not self.is_error():
+            # Membership is checked once per connection; every message sent
+            # afterwards relies on it.
+            self.is_member = await self.check_membership(self.room_id)
+            if not self.is_member:
+                self.scope['error'] = "Room doesn't exist or you aren't a member of the room"
+
+        if self.is_error():
+            await self.send_error()
+            return
+
+        self.sender_username = await self.get_username(self.scope['user'])
+
+        await self.join_group(self.room_group_name)
+        await self.join_user_group()
         await self.accept()
+        await self.go_online()
+        await self.send_room_history(self.room_id)
+        await self.enter(self.stream)
+
+    async def disconnect(self, close_code):
+        if self.is_member:
+            await self.go_offline()
+            await self.leave_group(self.room_group_name)
+            await self.leave_user_group()
+
+            await room_message_buffer.flush()
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if not self.is_member:
+            return
+
+        text_data_json = self.decode_frame(text_data, bytes_data)
+        await self.heartbeat()
+        action = text_data_json.get('action')
+
+        if action == 'typing':
+            await self.send_typing(self.stream)
+        elif action == 'ack':
+            self.acknowledge(text_data_json.get('received'))
+        elif action not in ('heartbeat', 'pong'):
+            await self.send_room_message(self.room_id, text_data_json)
+
+    def accepts_stream(self, stream):
+        return stream == self.stream
+
+
+class MultiplexConsumer(DirectMessageMixin, RoomMessageMixin, BaseChatConsumer):
+    """One authenticated socket carrying any number of chat and room streams.
+
+    Client frames name a stream, ``chat:<chat_id>`` or ``room:<room_id>``,
+    and an action::
+
+        {"stream": "room:<room_id>", "action": "subscribe"}
+        {"stream": "room:<room_id>", "action": "send", "payload": {"message": "hi"}}
+        {"stream": "room:<room_id>", "action": "unsubscribe"}
+        {"stream": "chat:<chat_id>", "action": "resume", "last_sequence": 41}
+        {"stream": "room:<room_id>", "action": "typing"}
+        {"action": "heartbeat"}
+        {"action": "pong"}
+        {"action": "ack", "received": 120}
+
+    Every event delivered on a stream is sent as
+    ``{"stream": ..., "payload": <event>}``. Direct messages arrive through
+    the user's own group, so chat streams are delivered and can be sent on
+    without subscribing. Subscribing to a stream sends its history and
+    tells the others on it that the user is present.
+    """
+
+    rate_limit_raw_frames = False
+
+    # Subscribes and unsubscribes per second and burst, limited apart from
+    # sends so a client can open all its conversations at once. None falls
+    # back to CHAT_CONTROL_RATE_LIMIT(_BURST).
+    control_rate_limit = None
+    control_rate_limit_burst = None
+    control_rate_bucket = None
+
+    async def connect(self):
+        self.streams = {}
+        self.chat_participants = {}
 
         if self.is_error():
-            error = {
-                'error': str(self.scope['error'])
-            }
-            await self.send(text_data=json.dumps(error))
-            await self.close()    
+            await self.send_error()
+            return
 
+        self.sender_username = await self.get_username(self.scope['user'])
+        await self.join_user_group()
+        await self.accept()
+        await self.go_online()
 
-    def is_error(self):
+    async def disconnect(self, close_code):
+        if self.is_error():
+            return
+
+        await self.go_offline()
+
+        for group_name in self.streams.values():
+            if group_name is not None:
+                await self.leave_group(group_name)
+        self.streams = {}
+        await self.leave_user_group()
+
+        await message_buffer.flush()
+        await room_message_buffer.flush()
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if self.is_error():
+            return
+
+        # One bad frame must not close every stream of the socket, so
+        # malformed ones get an error frame instead of raising.
         try:
-            if self.scope['error']:
-                return True
-            
-            if self.scope['error'] is None:
-                """This checks if user is a member of a room"""
-                room = Room.objects.filter(room_id=self.room_id).first()
-                room_member = RoomMembers.objects.filter(room_id=self.room_id, room_member_id=self.scope['user']).first()
-                if room is None or room_member is None:
-                    self.scope['error'] = "Room doesn't exist or you aren't a member of the room"
-                    return True
-        except:
-            return False
+            frame = self.decode_frame(text_data, bytes_data)
+        except ValueError:
+            frame = None
+        await self.heartbeat()
+        if not isinstance(frame, dict):
+            # A flood of them gets no answer once over the limit
+            if not self.check_rate_limit():
+                await self.send_stream_error(None, 'Invalid frame')
+            return
 
-        
+        stream = frame.get('stream', '')
+        kind, _, stream_id = str(stream).partition(':')
+        action = frame.get('action', 'send')
+
+        if action == 'ack':
+            return self.acknowledge(frame.get('received'))
+        if action in ('heartbeat', 'pong'):
+            return
+
+        if action in ('subscribe', 'unsubscribe'):
+            retry_after = self.check_control_rate_limit()
+        else:
+            retry_after = self.check_rate_limit()
+        if retry_after:
+            frames_rate_limited.labels(type(self).__name__).inc()
+            return await self.send_stream_error(
+                stream, 'Too many messages, slow down', retry_after=round(retry_after, 3)
+            )
+
+        if kind not in ('chat', 'room') or not self.is_valid_id(stream_id):
+            return await self.send_stream_error(stream, 'Unknown stream')
+
+        # Ids are accepted in any case and form; groups, keys and events all
+        # use the canonical one.
+        stream = self.stream_name(kind, stream_id)
+        stream_id = stream.partition(':')[2]
+
+        if kind == 'chat' and action != 'unsubscribe':
+            # Chat streams need no subscription, so every action on one is
+            # checked; after the first, from the participants cache.
+            participants = await self.get_participants(stream_id)
+            if str(self.scope['user']) not in participants:
+                return await self.send_stream_error(stream, self.chat_error)
+
+        if action == 'subscribe':
+            await self.subscribe(stream, kind, stream_id)
+
+        elif action == 'unsubscribe':
+            if stream in self.streams:
+                await self.leave(stream)
+            self.chat_participants.pop(stream, None)
+            group_name = self.streams.pop(stream, None)
+            if group_name is not None:
+                await self.leave_group(group_name)
+            await self.send_frame({'stream': stream, 'subscribed': False})
+
+        elif action == 'typing':
+            await self.send_typing(stream)
+
+        elif action == 'send':
+            if kind == 'room' and stream not in self.streams:
+                return await self.send_stream_error(stream, 'Subscribe to the stream first')
+
+            payload = frame.get('payload')
+            if not isinstance(payload, dict) or not isinstance(payload.get('message'), str):
+                return await self.send_stream_error(stream, 'payload must be an object with a message string')
+
+            if kind == 'chat':
+                await self.send_direct_message(stream_id, participants, payload)
+            else:
+                await self.send_room_message(stream_id, payload)
+
+        elif action == 'resume' and kind == 'chat':
+            await self.resume(stream_id, frame.get('last_sequence'))
+
+        else:
+            await self.send_stream_error(stream, f'Unknown action {action}')
+
+    async def subscribe(self, stream, kind, stream_id):
+        if stream in self.streams:
+            return await self.send_frame({'stream': stream, 'subscribed': True})
+
+        if len(self.streams) >= getattr(settings, 'CHAT_MULTIPLEX_MAX_STREAMS', 500):
+            return await self.send_stream_error(stream, 'Too many streams on this connection')
+
+        if kind == 'room':
+            if not await self.check_membership(stream_id):
+                return await self.send_stream_error(
+                    stream, "Room doesn't exist or you aren't a member of the room"
+                )
+            group_name = self.room_group_name_for(stream_id)
+            await self.join_group(group_name)
+        else:
+            group_name = None
+
+        self.streams[stream] = group_name
+        await self.send_frame({'stream': stream, 'subscribed': True})
+
+        if kind == 'room':
+            await self.send_room_history(stream_id)
+        else:
+            # Checked in receive(), so this is a cache hit
+            self.chat_participants[stream] = await self.get_participants(stream_id)
+            await self.send_direct_history(stream_id, self.chat_participants[stream])
+        await self.enter(stream)
+
+    def present_streams(self):
+        return self.streams if self.online else ()
+
+    def participants_for(self, stream):
+        return self.chat_participants.get(stream, ())
+
+    def frame_for(self, event):
+        stream = event.pop('stream', None)
+        return {'stream': stream, 'payload': event}
+
+    def check_control_rate_limit(self):
+        """Seconds until the client may subscribe or unsubscribe again, or 0."""
+        rate = self.get_setting('control_rate_limit', 'CHAT_CONTROL_RATE_LIMIT', 20)
+        if not rate:
+            return 0
+        if self.control_rate_bucket is None:
+            self.control_rate_bucket = TokenBucket(
+                rate, self.get_setting('control_rate_limit_burst', 'CHAT_CONTROL_RATE_LIMIT_BURST', 500)
+            )
+        if self.control_rate_bucket.take():
+            return 0
+        return self.control_rate_bucket.retry_after()
+
+    async def send_stream_error(self, stream, error, **fields):
+        await self.send_frame({'stream': stream, 'error': error, **fields})
+
+    def is_valid_id(self, stream_id):
+        try:
+            uuid.UUID(stream_id)
+        except ValueError:
+            return False
+        return True
 
 
 
@@ -132,7 +1196,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
     # Receive message from WebSocket
     async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
+        text_data_json = loads(text_data)
         message = text_data_json['message']
 
         # Send message to room group
@@ -149,7 +1213,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
         message = event['message']
 
         # Send message to WebSocket
-        await self.send(text_data=json.dumps({
+        await self.send(text_data=dumps({
             'message': message
         }))
 
@@ -4,8 +4,9 @@ from . import consumers
 
 websocket_urlpatterns = [
     
+     re_path(r'ws/multiplex/$', consumers.MultiplexConsumer.as_asgi()),
      re_path(r'ws/chat/(?P<chat_id>[0-9a-fA-F-]{36})/$', consumers.DirectMessageConsumer.as_asgi()),
-     re_path(r'ws/room-chat/(?P<room_id>\d+)/$',consumers.RoomMessageConsumer.as_asgi()), 
+     re_path(r'ws/room-chat/(?P<room_id>[0-9a-fA-F-]{36})/$', consumers.RoomMessageConsumer.as_asgi()),
      re_path(r'ws/chat/(?P<chat_name>[0-9a-zA-Z-_.@]+)/$', consumers.ChatConsumer.as_asgi()),
 
 ]
\ No newline at end of file
@@ -1,4 +1,6 @@
 from .base import *
+import fnmatch
+import re
 from datetime import timedelta
 
 
@@ -67,6 +69,9 @@ SIMPLE_JWT = {
     "AUTH_HEADER_TYPES": ("Bearer",),
 }
 
+# Number of decoded access tokens JWTAuthMiddleware keeps per worker
+JWT_IDENTITY_CACHE_SIZE = 10000
+
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
 
@@ -89,12 +94,105 @@ TEMPLATES = [
 PASSWORD_RESET_TIMEOUT = 18000
 
 # CHANNELS_SETTINGS
+# With CHAT_ROOM_FAN_OUT all of a room's traffic to a worker goes through one
+# relay.* channel, and a message dropped there because the channel is full is
+# lost for every local member of the room, so relay channels get far more
+# room than the layers' default capacity of 100. Every layer below uses it.
+CHANNEL_CAPACITY = {"relay.*": 10000}
+
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer'
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        'CONFIG': {
+            # channels 4.0's in-memory layer doesn't compile the globs itself
+            "channel_capacity": [
+                (re.compile(fnmatch.translate(pattern)), capacity)
+                for pattern, capacity in CHANNEL_CAPACITY.items()
+            ],
+        },
     }
 }
 
+# Store chat messages through a shared bulk_create buffer instead of one
+# INSERT per frame; messages are broadcast before they are written.
+CHAT_WRITE_BEHIND = False
+CHAT_WRITE_BEHIND_BATCH_SIZE = 100
+CHAT_WRITE_BEHIND_FLUSH_INTERVAL = 0.05
+
+# Sequence numbers a worker reserves per chat with one UPDATE in write-behind
+# mode. With 1 each direct message still costs that UPDATE before it is
+# broadcast; larger blocks save it, but only keep a chat's numbers in order
+# when all of its messages go through one worker (see SequenceBlocks).
+CHAT_SEQUENCE_BLOCK = 1
+
+# Upper bound on chat/room streams a single multiplexed socket may subscribe to
+CHAT_MULTIPLEX_MAX_STREAMS = 500
+
+# Most messages replayed to a reconnecting client before it must fall back to REST
+CHAT_RESUME_LIMIT = 500
+
+# Recently seen client message ids remembered per worker to answer retried sends
+CHAT_DEDUPE_CACHE_SIZE = 10000
+
+# Recent messages kept in memory per conversation and sent as the backlog on
+# connect, for at most CHAT_HISTORY_CONVERSATIONS conversations (LRU), each
+# reloaded from the database CHAT_HISTORY_TTL seconds after it was read
+CHAT_HISTORY_SIZE = 50
+CHAT_HISTORY_CONVERSATIONS = 1000
+CHAT_HISTORY_TTL = 60
+
+# Sockets that sent nothing for CHAT_HEARTBEAT_INTERVAL seconds get a ping;
+# those silent for CHAT_HEARTBEAT_TIMEOUT seconds are closed and cleaned up
+CHAT_HEARTBEAT_INTERVAL = 30
+CHAT_HEARTBEAT_TIMEOUT = 75
+
+# Seconds a user stays online in the presence cache without a heartbeat, the
+# least time between two "is typing" events of one user on a stream, and the
+# most user ids the presence endpoint answers for at once. An idle client's
+# frames (its pongs) can be two heartbeat intervals apart, and they refresh
+# the key at most every third of the TTL, so the TTL must be more than three
+# intervals plus a round trip or idle users flicker offline.
+CHAT_PRESENCE_TTL = 4 * CHAT_HEARTBEAT_INTERVAL
+CHAT_TYPING_INTERVAL = 0.3
+CHAT_PRESENCE_BATCH_LIMIT = 500
+
+# Room groups are joined once per worker, which hands each message to its own
+# sockets, yielding to the event loop every CHAT_FAN_OUT_BATCH of them. See
+# CHANNEL_CAPACITY for the capacity of the relay channels.
+CHAT_ROOM_FAN_OUT = True
+CHAT_FAN_OUT_BATCH = 500
+
+# Inbound frames per second (and burst) a socket, and a user across all their
+# sockets of one consumer, may send; over-limit frames get an error frame
+CHAT_RATE_LIMIT = 10
+CHAT_RATE_LIMIT_BURST = 20
+CHAT_USER_RATE_LIMIT = 20
+CHAT_USER_RATE_LIMIT_BURST = 40
+
+# The multiplexed socket limits its subscribes and unsubscribes apart from
+# the frames above, with a burst that lets a client open every stream it may
+# hold (CHAT_MULTIPLEX_MAX_STREAMS) at once. Every frame over a limit that
+# names a stream gets a {"stream", "error", "retry_after"} frame.
+CHAT_CONTROL_RATE_LIMIT = 20
+CHAT_CONTROL_RATE_LIMIT_BURST = CHAT_MULTIPLEX_MAX_STREAMS
+
+# Frames a socket may have waiting to be written, and what happens once it is
+# that far behind: "drop_oldest", "coalesce" or "disconnect". Under daphne
+# frames only wait for clients that ack what they received
+# ({"action": "ack", "received": <count>}), which get at most
+# CHAT_OUTBOUND_WINDOW frames written ahead of their last ack.
+CHAT_OUTBOUND_QUEUE_SIZE = 256
+CHAT_OUTBOUND_POLICY = "drop_oldest"
+CHAT_OUTBOUND_WINDOW = 256
+
+# Send chat_message events arriving within this many seconds as one JSON array
+# frame of at most CHAT_COALESCE_MAX_BATCH events; 0 sends one frame per event
+CHAT_COALESCE_WINDOW = 0
+CHAT_COALESCE_MAX_BATCH = 50
+
+# Least seconds between two writes of a room member's read watermark
+CHAT_READ_WATERMARK_INTERVAL = 5
+
 
 ASGI_APPLICATION = "config.asgi.application"
 AUTH_USER_MODEL = 'accounts.CustomUser'
@@ -15,17 +15,55 @@ DEBUG = False
 
 REDIS_URL = os.getenv('REDIS_URL')
 
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
-        'CONFIG': {
-            "hosts": [REDIS_URL]
+if REDIS_URL:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                "hosts": [REDIS_URL],
+                "channel_capacity": CHANNEL_CAPACITY,
+            },
         },
-    },
-}
+    }
+else:
+    # Single host: the workers share groups through `manage.py runchannelbroker`
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'config.channel_layers.UnixSocketChannelLayer',
+            'CONFIG': {
+                "path": os.getenv('CHANNEL_BROKER_SOCKET', '/tmp/mimi-channels.sock'),
+                "channel_capacity": CHANNEL_CAPACITY,
+            },
+        },
+    }
+
+# Shared by every worker, so presence reads the same from all of them. On a
+# single host without Redis that is a directory every worker process can
+# write to; presence keeps one entry per online user and worker, so culling
+# must not start before the host's users are all in.
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.getenv('CACHE_DIR', '/tmp/mimi-cache'),
+            'OPTIONS': {
+                'MAX_ENTRIES': int(os.getenv('CACHE_MAX_ENTRIES', 100000)),
+            },
+        },
+    }
+
 
 
 
+# Bearer token Prometheus sends to /api/v1/chats/metrics/
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
 
 DATABASES = {
 	"default": dj_database_url.parse(os.getenv('DATABASE_URL'))
@@ -0,0 +1,112 @@
+import base64
+import uuid
+from datetime import datetime
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """Pages of a queryset by position on ``(<ordering_field>, id)``, newest first.
+
+    ``?before=<cursor>`` gives the page of older items and ``?after=<cursor>``
+    the page of newer ones; both are answered by one index range scan, so a
+    page costs the same at the end of a long history as at its start.
+    Cursors are opaque to clients and the page size is ``?page_size=``.
+    """
+
+    ordering_field = "created_at"
+    page_size = 50
+    max_page_size = 200
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        before = self.decode_cursor(request.query_params.get("before"))
+        after = self.decode_cursor(request.query_params.get("after"))
+
+        field = self.ordering_field
+        if after is not None:
+            position, pk = after
+            queryset = queryset.filter(
+                Q(**{f"{field}__gt": position}) | Q(**{field: position, "id__gt": pk})
+            ).order_by(field, "id")
+        else:
+            if before is not None:
+                position, pk = before
+                queryset = queryset.filter(
+                    Q(**{f"{field}__lt": position}) | Q(**{field: position, "id__lt": pk})
+                )
+            queryset = queryset.order_by(f"-{field}", "-id")
+
+        # One extra row tells whether there is a page beyond this one.
+        page = list(queryset[: self.page_size + 1])
+        has_more = len(page) > self.page_size
+        page = page[: self.page_size]
+        if after is not None:
+            page.reverse()
+            has_older, has_newer = True, has_more
+        else:
+            has_older, has_newer = has_more, before is not None
+
+        # Pages are newest first: older ones go on from the last item.
+        self.older = self.encode_cursor(page[-1]) if page and has_older else None
+        self.newer = self.encode_cursor(page[0]) if page and has_newer else None
+        return page
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params.get("page_size", self.page_size))
+        except ValueError:
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    def encode_cursor(self, item):
+        position = f"{getattr(item, self.ordering_field).isoformat()}|{item.id}"
+        return base64.urlsafe_b64encode(position.encode("utf-8")).decode("ascii")
+
+    def decode_cursor(self, cursor):
+        if cursor is None:
+            return None
+        try:
+            position, pk = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").split("|")
+            return datetime.fromisoformat(position), uuid.UUID(pk)
+        except (TypeError, ValueError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_link(self, name, cursor):
+        if cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, "before" if name == "after" else "after")
+        return replace_query_param(url, name, cursor)
+
+    def get_paginated_response(self, data):
+        return Response(
+            {
+                "older": self.get_link("before", self.older),
+                "newer": self.get_link("after", self.newer),
+                "results": data,
+            }
+        )
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "required": ["results"],
+            "properties": {
+                "older": {"type": "string", "nullable": True, "format": "uri"},
+                "newer": {"type": "string", "nullable": True, "format": "uri"},
+                "results": schema,
+            },
+        }
+
+
+class InboxPagination(KeysetPagination):
+    """Conversations by last activity, most recent first."""
+
+    ordering_field = "last_activity_at"
@@ -1,3 +1,6 @@
+import hmac
+
+from django.conf import settings
 from rest_framework.permissions import BasePermission
 from mimi.chats.models import RoomMembers, Room
 
@@ -22,3 +25,18 @@ class IsRoomAdmin(BasePermission):
         if member and member.is_admin:
             return True
         return False
+
+
+class HasMetricsToken(BasePermission):
+    """Scrapers send ``Authorization: Bearer <METRICS_TOKEN>``. Without the
+    setting the metrics are open only with DEBUG on, so a deployment that
+    forgot the token doesn't publish them."""
+
+    message = "Invalid metrics token"
+
+    def has_permission(self, request, view):
+        token = getattr(settings, "METRICS_TOKEN", None)
+        if not token:
+            return settings.DEBUG
+        authorization = request.META.get("HTTP_AUTHORIZATION", "")
+        return hmac.compare_digest(authorization, f"Bearer {token}")
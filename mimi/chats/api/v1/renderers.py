@@ -0,0 +1,15 @@
+from rest_framework.renderers import BaseRenderer
+
+
+class PrometheusTextRenderer(BaseRenderer):
+    """The Prometheus text exposition format, which the view renders itself."""
+
+    media_type = "text/plain"
+    format = "txt"
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, dict):
+            # Errors, e.g. a rejected token
+            data = "\n".join(f"{key}: {value}" for key, value in data.items()) + "\n"
+        return data.encode(self.charset)
@@ -1,4 +1,4 @@
-from mimi.chats.models import Message, Room, RoomMembers, JoinRoomRequests
+from mimi.chats.models import ConversationSummary, Message, Room, RoomMembers, JoinRoomRequests
 
 from rest_framework import serializers
 
@@ -9,7 +9,26 @@ class MessageSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Message
-        fields = ["id", "sender", "receiver", "edit_count", "message"]
+        fields = ["id", "sender", "receiver", "edit_count", "message", "sequence"]
+
+
+class ConversationSummarySerializer(serializers.ModelSerializer):
+    other_user_id = serializers.UUIDField()
+    other_user = serializers.CharField(source="other_user.username")
+    last_sender = serializers.CharField(source="last_sender.username", allow_null=True)
+
+    class Meta:
+        model = ConversationSummary
+        fields = [
+            "id",
+            "chat",
+            "other_user_id",
+            "other_user",
+            "last_message",
+            "last_sender",
+            "last_activity_at",
+            "unread_count",
+        ]
 
 
 class EditOrDeleteMessageSerializer(serializers.ModelSerializer):
@@ -6,11 +6,16 @@ from mimi.chats.api.v1.views import (
     UserRoomRequestAPIVIew,
     AcceptOrRejectUserRoomRequestAPIView,
     UserRoomsAPIView,
+    RoomUnreadCountsAPIView,
     GetAllUsersInTheRoomAPIView,
     RemoveUserFromARoomAPIView,
     UserLeaveRoomAPIView,
     MessageAPIView,
     GenerateUniqueIDForChatAPIView,
+    PresenceAPIView,
+    MetricsAPIView,
+    InboxAPIView,
+    MarkConversationReadAPIView,
 )
 
 app_name = "chats"
@@ -36,6 +41,7 @@ urlpatterns = [
         name="accept_or_reject_room_request",
     ),
     path("user-rooms/", UserRoomsAPIView.as_view(), name="user_rooms"),
+    path("user-rooms/unread/", RoomUnreadCountsAPIView.as_view(), name="room_unread_counts"),
     path(
         "get-user-in-room/<str:room_name>/",
         GetAllUsersInTheRoomAPIView.as_view(),
@@ -57,5 +63,13 @@ urlpatterns = [
         name="get_message",
     ),
 
-    path('generate-chat-id/', GenerateUniqueIDForChatAPIView.as_view(), name='generate_chat_id')
+    path('generate-chat-id/', GenerateUniqueIDForChatAPIView.as_view(), name='generate_chat_id'),
+    path('presence/', PresenceAPIView.as_view(), name='presence'),
+    path('metrics/', MetricsAPIView.as_view(), name='metrics'),
+    path('inbox/', InboxAPIView.as_view(), name='inbox'),
+    path(
+        'inbox/<uuid:other_user_id>/read/',
+        MarkConversationReadAPIView.as_view(),
+        name='mark_conversation_read',
+    ),
 ]
@@ -1,6 +1,9 @@
+import uuid
+
 from rest_framework import generics, permissions, status
 from rest_framework.response import Response
 from rest_framework.views import APIView
+from rest_framework_simplejwt.authentication import JWTStatelessUserAuthentication
 from mimi.chats.models import Message
 from mimi.chats.api.v1.serializers import (
     EditOrDeleteMessageSerializer,
@@ -9,22 +12,32 @@ from mimi.chats.api.v1.serializers import (
     AcceptOrRejectUserRoomRequestSerializer,
     GetAllUsersInTheRoomSerializer,
     MessageSerializer,
+    ConversationSummarySerializer,
 )
 from mimi.chats.utils.constants import (
     PENDING_ROOM_REQUEST,
     ACCEPTED_ROOM_REQUEST,
     REJECT_ROOM_REQUEST,
 )
-from mimi.chats.api.v1.permissions import IsRoomAdmin
+from mimi.chats.api.v1.pagination import InboxPagination, KeysetPagination
+from mimi.chats.api.v1.permissions import HasMetricsToken, IsRoomAdmin
+from mimi.chats.api.v1.renderers import PrometheusTextRenderer
+from mimi.chats.utils.chat_ids import chat_id_for
+from mimi.chats.utils.inbox import mark_read
+from mimi.chats.utils.presence import PresenceRegistry
+from mimi.chats.utils.watermarks import unread_counts
+from mimi.utils.metrics import registry
 from mimi.chats.models import (
     Room,
     JoinRoomRequests,
     RoomMembers,
-    ChatIDs
+    ConversationSummary,
+    conversation_key,
 )
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db.models import Q
+from django.db import IntegrityError
 
 
 User = get_user_model()
@@ -135,6 +148,16 @@ class UserRoomsAPIView(generics.ListAPIView):
         return super().get(request, *args, **kwargs)
 
 
+class RoomUnreadCountsAPIView(APIView):
+    """Unread messages of each of the user's rooms, by room id, in one query."""
+
+    authentication_classes = [JWTStatelessUserAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, *args, **kwargs):
+        return Response(unread_counts(request.user.id))
+
+
 class GetAllUsersInTheRoomAPIView(generics.ListAPIView):
     serializer_class = GetAllUsersInTheRoomSerializer
     permission_classes = [permissions.IsAuthenticated]
@@ -228,54 +251,131 @@ class UserLeaveRoomAPIView(APIView):
 
 
 class MessageAPIView(generics.ListAPIView):
+    """Messages between the user and ``other_user_id``, newest first, in
+    keyset pages read from the conversation index."""
+
     serializer_class = MessageSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
-        condition_1 = Q(receiver=self.kwargs["other_user_id"], sender=self.request.user)
-        condition_2 = Q(sender=self.kwargs["other_user_id"], receiver=self.request.user)
-        message_queryset = Message.objects.filter(condition_1 | condition_2).all()
-
-        return message_queryset
+        conversation = conversation_key(self.request.user.id, self.kwargs["other_user_id"])
+        return Message.objects.filter(conversation=conversation).select_related(
+            "sender", "receiver"
+        )
 
     def get(self, request, *args, **kwargs):
         return super().get(request, *args, **kwargs)
 
 
+class InboxAPIView(generics.ListAPIView):
+    """The user's conversations by last activity, with the latest message
+    and how many are unread, in keyset pages.
+
+    Each page is one query over the (owner, last_activity_at) index; the
+    token is trusted without loading the user.
+    """
+
+    authentication_classes = [JWTStatelessUserAuthentication]
+    serializer_class = ConversationSummarySerializer
+    permission_classes = [permissions.IsAuthenticated]
+    pagination_class = InboxPagination
+
+    def get_queryset(self):
+        return ConversationSummary.objects.filter(owner_id=self.request.user.id).select_related(
+            "other_user", "last_sender"
+        )
+
+
+class MarkConversationReadAPIView(APIView):
+    """Reset the unread count of the conversation with ``other_user_id``."""
+
+    authentication_classes = [JWTStatelessUserAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        mark_read(request.user.id, conversation_key(request.user.id, kwargs["other_user_id"]))
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
 class GenerateUniqueIDForChatAPIView(APIView):
-    
+    """The chat between the requesting user and ``receiver``, created on first use.
+
+    The pair is looked up in canonical order, so both users get the same
+    chat whoever asks first. After the first request for a pair the id is
+    served from the in-process cache without touching the database.
+    """
+
+    authentication_classes = [JWTStatelessUserAuthentication]
     permission_classes = [permissions.IsAuthenticated]
 
     def get(self, request, *args, **kwargs):
-        sender = self.request.data['sender']
-        receiver = self.request.data['receiver']
-        
-       
-
-         
-        condition_1 = Q(receiver=receiver, sender=receiver)
-        condition_2 = Q(sender=sender, receiver=receiver)
-        chat_details = ChatIDs.objects.filter(
-            condition_1 | condition_2
-        ).first()
+        receiver = request.query_params.get("receiver") or request.data.get("receiver")
+        try:
+            receiver = uuid.UUID(str(receiver))
+        except ValueError:
+            return Response(
+                {"error": "receiver must be a user id"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        try:
+            chat_id = chat_id_for(request.user.id, receiver)
+        except IntegrityError:
+            return Response(
+                {"error": "user not found"},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+
+        return Response({"chat_id": chat_id}, status=status.HTTP_200_OK)
 
-        if chat_details is not None:
-            print(ChatIDs.objects.count())
-            print(chat_details.id)
-            return Response (
-                data={"chat_id": 
-                      chat_details.id},
-                status=status.HTTP_200_OK
+
+class PresenceAPIView(APIView):
+    """Presence of a batch of users, ``?user_ids=<id>,<id>``.
+
+    Answered from the presence cache alone: the token is trusted without
+    loading the user, so no query reaches the database.
+    """
+
+    authentication_classes = [JWTStatelessUserAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, *args, **kwargs):
+        user_ids = [
+            user_id for user_id in request.query_params.get("user_ids", "").split(",") if user_id
+        ]
+        if len(user_ids) > getattr(settings, "CHAT_PRESENCE_BATCH_LIMIT", 500):
+            return Response(
+                {"error": "too many user ids"},
+                status=status.HTTP_400_BAD_REQUEST,
             )
 
-        if chat_details is None:
-            chat_detail = ChatIDs.objects.create(sender_id=sender, receiver_id=receiver)
-            print(ChatIDs.objects.count())
-            return Response (
-                data={"chat_id": chat_detail.id
-                      
-                    },
-                status=status.HTTP_200_OK
+        try:
+            user_ids = [str(uuid.UUID(user_id)) for user_id in user_ids]
+        except ValueError:
+            return Response(
+                {"error": "user ids must be UUIDs"},
+                status=status.HTTP_400_BAD_REQUEST,
             )
 
-        
+        last_seen = PresenceRegistry.last_seen(user_ids)
+        return Response(
+            {
+                user_id: {"online": seen is not None, "last_seen": seen}
+                for user_id, seen in last_seen.items()
+            }
+        )
+
+
+class MetricsAPIView(APIView):
+    """Counters and latency histograms of this worker, for Prometheus to scrape."""
+
+    authentication_classes = []
+    permission_classes = [HasMetricsToken]
+    renderer_classes = [PrometheusTextRenderer]
+
+    def get(self, request, *args, **kwargs):
+        return Response(
+            registry.render(),
+            content_type="text/plain; version=0.0.4; charset=utf-8",
+        )
@@ -0,0 +1,33 @@
+import asyncio
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from config.channel_layers import ChannelBroker
+
+
+class Command(BaseCommand):
+    help = "Run the broker the UnixSocketChannelLayer of each worker connects to."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--path", help="Unix socket to listen on; defaults to the channel layer's.")
+
+    def handle(self, *args, **options):
+        config = dict(settings.CHANNEL_LAYERS["default"].get("CONFIG", {}))
+        if options["path"]:
+            config["path"] = options["path"]
+        broker = ChannelBroker(**config)
+
+        # A socket left behind by a previous run would make the bind fail.
+        if os.path.exists(broker.path):
+            os.unlink(broker.path)
+
+        self.stdout.write(f"Channel broker listening on {broker.path}")
+        try:
+            asyncio.run(broker.serve())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if os.path.exists(broker.path):
+                os.unlink(broker.path)
@@ -0,0 +1,44 @@
+# Generated by Django 5.0 on 2026-10-18 18:24
+
+from django.conf import settings
+from django.db import migrations, models
+
+from mimi.chats.models import conversation_key
+
+
+def fill_conversations(apps, schema_editor):
+    Message = apps.get_model('chats', 'Message')
+    messages = Message.objects.filter(
+        conversation=None, sender__isnull=False, receiver__isnull=False
+    ).only('id', 'sender_id', 'receiver_id')
+
+    batch = []
+    for message in messages.iterator(chunk_size=2000):
+        message.conversation = conversation_key(message.sender_id, message.receiver_id)
+        batch.append(message)
+        if len(batch) == 2000:
+            Message.objects.bulk_update(batch, ['conversation'])
+            batch = []
+    Message.objects.bulk_update(batch, ['conversation'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0005_message_client_message_id'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='conversation',
+            field=models.UUIDField(blank=True, editable=False, null=True),
+        ),
+        # Before the index exists, so filling it doesn't update it row by row
+        migrations.RunPython(fill_conversations, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'created_at', 'id'], name='message_conversation_idx'),
+        ),
+    ]
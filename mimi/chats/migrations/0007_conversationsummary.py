@@ -0,0 +1,73 @@
+# Generated by Django 5.0 on 2026-10-18 18:33
+
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+def fill_summaries(apps, schema_editor):
+    """One row per participant of every existing conversation, with its
+    latest message and nothing unread."""
+    Message = apps.get_model('chats', 'Message')
+    ConversationSummary = apps.get_model('chats', 'ConversationSummary')
+    messages = Message.objects.exclude(conversation=None).order_by('conversation', '-created_at', '-id').only(
+        'conversation', 'chat_id', 'sender_id', 'receiver_id', 'message', 'created_at'
+    )
+
+    summaries = []
+    conversation = None
+    for message in messages.iterator(chunk_size=2000):
+        if message.conversation == conversation:
+            continue
+        conversation = message.conversation
+        participants = [(message.sender_id, message.receiver_id), (message.receiver_id, message.sender_id)]
+        for owner_id, other_user_id in participants[:1 if message.sender_id == message.receiver_id else 2]:
+            summaries.append(ConversationSummary(
+                owner_id=owner_id,
+                other_user_id=other_user_id,
+                conversation=conversation,
+                chat_id=message.chat_id,
+                last_message=message.message[:140],
+                last_sender_id=message.sender_id,
+                last_activity_at=message.created_at,
+            ))
+        if len(summaries) >= 2000:
+            ConversationSummary.objects.bulk_create(summaries, ignore_conflicts=True)
+            summaries = []
+    ConversationSummary.objects.bulk_create(summaries, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0006_message_conversation'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationSummary',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_modified_at', models.DateTimeField(auto_now=True)),
+                ('conversation', models.UUIDField()),
+                ('last_message', models.CharField(blank=True, default='', max_length=140)),
+                ('last_activity_at', models.DateTimeField()),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('chat', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chats.chatids')),
+                ('last_sender', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('other_user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversation_summaries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['owner', '-last_activity_at', '-id'], name='conversation_inbox_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='conversationsummary',
+            constraint=models.UniqueConstraint(fields=('conversation', 'owner'), name='unique_conversation_summary_per_owner'),
+        ),
+        migrations.RunPython(fill_summaries, migrations.RunPython.noop),
+    ]
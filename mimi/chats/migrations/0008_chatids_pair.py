@@ -0,0 +1,50 @@
+# Generated by Django 5.0 on 2026-10-18 18:36
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def fill_pairs(apps, schema_editor):
+    """Order the participants of existing chats; the oldest chat of a pair
+    keeps it."""
+    ChatIDs = apps.get_model('chats', 'ChatIDs')
+    seen = set()
+    batch = []
+    for chat in ChatIDs.objects.order_by('created_at').only('id', 'sender_id', 'receiver_id').iterator(chunk_size=2000):
+        pair = tuple(sorted((chat.sender_id, chat.receiver_id), key=str))
+        if pair in seen:
+            continue
+        seen.add(pair)
+        chat.user_a_id, chat.user_b_id = pair
+        batch.append(chat)
+        if len(batch) == 2000:
+            ChatIDs.objects.bulk_update(batch, ['user_a', 'user_b'])
+            batch = []
+    ChatIDs.objects.bulk_update(batch, ['user_a', 'user_b'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0007_conversationsummary'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatids',
+            name='user_a',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='chatids',
+            name='user_b',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(fill_pairs, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='chatids',
+            constraint=models.UniqueConstraint(fields=('user_a', 'user_b'), name='unique_chat_per_pair'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.0 on 2026-10-18 18:40
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models.functions import Now
+
+
+def start_watermarks(apps, schema_editor):
+    """Existing members start with nothing unread rather than their whole
+    room history."""
+    RoomMembers = apps.get_model('chats', 'RoomMembers')
+    RoomMembers.objects.update(last_read_at=Now())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0008_chatids_pair'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='roommembers',
+            name='last_read_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(start_watermarks, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='roommessages',
+            index=models.Index(fields=['room', 'created_at'], name='room_message_created_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.0 on 2026-10-18 19:17
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0009_room_read_watermarks'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='roommessages',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
@@ -1,10 +1,21 @@
+import uuid
+
 from django.db import models
 from django.contrib.auth import get_user_model
+from django.utils import timezone
 from mimi.utils.base_class import BaseModel
 from mimi.chats.utils.constants import PENDING_ROOM_REQUEST, ACCEPTED_ROOM_REQUEST
 
 User = get_user_model()
 
+CONVERSATION_NAMESPACE = uuid.UUID("3f4c1c2e-8f0a-5b7e-9a51-6d2f0c9e4b17")
+
+
+def conversation_key(user_id, other_user_id):
+    """The same UUID for both directions of a conversation between two users."""
+    first, second = sorted(str(uuid.UUID(str(user))) for user in (user_id, other_user_id))
+    return uuid.uuid5(CONVERSATION_NAMESPACE, f"{first}:{second}")
+
 
 class Message(BaseModel):
     sender = models.ForeignKey(
@@ -23,10 +34,49 @@ class Message(BaseModel):
     )
     edit_count = models.IntegerField(default=0)
     message = models.TextField()
+    chat = models.ForeignKey(
+        "ChatIDs",
+        on_delete=models.CASCADE,
+        related_name="messages",
+        null=True,
+        blank=True,
+    )
+    # Position of the message in its chat, allocated from ChatIDs.last_sequence
+    sequence = models.PositiveBigIntegerField(null=True, blank=True)
+    # Optional id chosen by the client so retried sends can be recognised
+    client_message_id = models.CharField(max_length=64, null=True, blank=True)
+    # conversation_key() of sender and receiver, so the messages between two
+    # users are one range of the index below whichever way they were sent
+    conversation = models.UUIDField(null=True, blank=True, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["conversation", "created_at", "id"], name="message_conversation_idx"
+            ),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["chat", "sequence"], name="unique_message_sequence_per_chat"
+            ),
+            models.UniqueConstraint(
+                fields=["sender", "client_message_id"],
+                name="unique_client_message_id_per_sender",
+            ),
+        ]
 
     def __str__(self):
         return self.message
 
+    def save(self, *args, **kwargs):
+        self.set_conversation()
+        super().save(*args, **kwargs)
+
+    def set_conversation(self):
+        """Fill in the conversation; bulk_create doesn't call save()."""
+        if self.conversation is None and self.sender_id and self.receiver_id:
+            self.conversation = conversation_key(self.sender_id, self.receiver_id)
+
 
 class Room(BaseModel):
     room_creator_id = models.CharField(max_length=250, blank=False, null=False)
@@ -58,14 +108,68 @@ class RoomMembers(BaseModel):
     room_member = models.ForeignKey(
         User, on_delete=models.CASCADE, related_name="current_room_member"
     )
+    # Room messages created after this are unread; empty means everything
+    # since joining. Advanced by mimi.chats.utils.watermarks, not per message.
+    last_read_at = models.DateTimeField(null=True, blank=True)
 
 
 class RoomMessages(BaseModel):
+    # Stamped when the message is sent rather than when a write-behind batch
+    # stores it, so a read watermark taken on delivery covers it.
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
     room = models.ForeignKey(Room, on_delete=models.CASCADE)
     message = models.TextField()
     sender = models.ForeignKey(User, on_delete=models.CASCADE)
     is_locked = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["room", "created_at"], name="room_message_created_idx"),
+        ]
+
 class ChatIDs(BaseModel):
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name="sender_chats")
     receiver = models.ForeignKey(User, on_delete=models.CASCADE, related_name="receiver_chats")
+    last_sequence = models.PositiveBigIntegerField(default=0)
+    # The participants in canonical order, the smaller id first, so a pair
+    # of users has one chat whoever opened it. Empty on chats that duplicated
+    # an older one of the same pair before the constraint existed.
+    user_a = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, related_name="+")
+    user_b = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, related_name="+")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user_a", "user_b"], name="unique_chat_per_pair"),
+        ]
+
+
+class ConversationSummary(BaseModel):
+    """A conversation as it appears in one participant's inbox.
+
+    Each participant has a row, brought up to date on every message write
+    by mimi.chats.utils.inbox, so an inbox page is one range of the
+    (owner, last_activity_at) index however long the histories are.
+    """
+
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name="conversation_summaries")
+    other_user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+    # conversation_key() of the two participants, shared by both rows
+    conversation = models.UUIDField()
+    chat = models.ForeignKey(ChatIDs, on_delete=models.SET_NULL, null=True, blank=True, related_name="+")
+    last_message = models.CharField(max_length=140, blank=True, default="")
+    last_sender = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name="+")
+    last_activity_at = models.DateTimeField()
+    # Messages received since the owner last read the conversation
+    unread_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["owner", "-last_activity_at", "-id"], name="conversation_inbox_idx"
+            ),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["conversation", "owner"], name="unique_conversation_summary_per_owner"
+            ),
+        ]
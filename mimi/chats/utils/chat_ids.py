@@ -0,0 +1,67 @@
+import uuid
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from mimi.chats.models import ChatIDs
+from mimi.utils.caches import LRUCache
+
+# Chat ids by canonical pair; a pair's chat never changes once created.
+chat_ids = LRUCache(maxsize=getattr(settings, "CHAT_ID_CACHE_SIZE", 10000))
+
+
+def canonical_pair(user_id, other_user_id):
+    """The two user ids as UUIDs, smaller first, as stored in user_a/user_b."""
+    return tuple(sorted((uuid.UUID(str(user_id)), uuid.UUID(str(other_user_id))), key=str))
+
+
+def chat_id_for(user_id, other_user_id):
+    """The id of the chat between two users, created on first use.
+
+    Served from the in-process cache after the first call for a pair;
+    otherwise one upsert on the (user_a, user_b) constraint, which returns
+    the existing chat when there is one. Raises IntegrityError when a user
+    doesn't exist; foreign keys are checked at commit, so the id is only
+    cached once the upsert has committed.
+    """
+    pair = canonical_pair(user_id, other_user_id)
+    chat_id = chat_ids.get(pair)
+    if chat_id is None:
+        with transaction.atomic():
+            chat_id = upsert_chat(user_id, other_user_id, pair)
+        chat_ids.set(pair, chat_id)
+    return chat_id
+
+
+def upsert_chat(sender_id, receiver_id, pair):
+    # INSERT ... ON CONFLICT ... RETURNING (PostgreSQL, SQLite 3.35+). The
+    # no-op update is what makes RETURNING give back an existing row.
+    now = timezone.now()
+    values = {
+        "id": uuid.uuid4(),
+        "created_at": now,
+        "last_modified_at": now,
+        "last_sequence": 0,
+        "sender": sender_id,
+        "receiver": receiver_id,
+        "user_a": pair[0],
+        "user_b": pair[1],
+    }
+    fields = [ChatIDs._meta.get_field(name) for name in values]
+    quote = connection.ops.quote_name
+    user_a, user_b = quote(fields[-2].column), quote(fields[-1].column)
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {quote(ChatIDs._meta.db_table)} "
+            f"({', '.join(quote(field.column) for field in fields)}) "
+            f"VALUES ({', '.join(['%s'] * len(fields))}) "
+            f"ON CONFLICT ({user_a}, {user_b}) DO UPDATE SET {user_a} = EXCLUDED.{user_a} "
+            f"RETURNING {quote(ChatIDs._meta.pk.column)}",
+            [
+                field.get_db_prep_value(value, connection)
+                for field, value in zip(fields, values.values())
+            ],
+        )
+        return ChatIDs._meta.pk.to_python(cursor.fetchone()[0])
@@ -0,0 +1,64 @@
+"""Wire formats for the chat WebSocket consumers.
+
+JSON is the default and goes through orjson when it is installed. Clients
+that offer the ``msgpack`` subprotocol during the handshake get MessagePack
+binary frames instead, provided msgpack is installed.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK_SUBPROTOCOL = "msgpack"
+
+
+def dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj)
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class JSONCodec:
+    subprotocol = None
+
+    def encode(self, obj):
+        return {"text_data": dumps(obj)}
+
+    def decode(self, text_data=None, bytes_data=None):
+        return loads(text_data if text_data is not None else bytes_data)
+
+
+class MessagePackCodec(JSONCodec):
+    subprotocol = MSGPACK_SUBPROTOCOL
+
+    def encode(self, obj):
+        return {"bytes_data": msgpack.packb(obj, use_bin_type=True)}
+
+    def decode(self, text_data=None, bytes_data=None):
+        if bytes_data is not None:
+            return msgpack.unpackb(bytes_data, raw=False)
+        return super().decode(text_data)
+
+
+JSON_CODEC = JSONCodec()
+MSGPACK_CODEC = MessagePackCodec() if msgpack is not None else None
+
+
+def negotiate(scope):
+    """Pick the codec for a connection from the subprotocols it offered."""
+    if MSGPACK_CODEC is not None and MSGPACK_SUBPROTOCOL in scope.get("subprotocols", []):
+        return MSGPACK_CODEC
+    return JSON_CODEC
@@ -2,3 +2,7 @@
 PENDING_ROOM_REQUEST = 0
 ACCEPTED_ROOM_REQUEST = 1
 REJECT_ROOM_REQUEST = 2
+
+# WEBSOCKET CLOSE CODES
+SLOW_CONSUMER_CLOSE_CODE = 4008
+HEARTBEAT_TIMEOUT_CLOSE_CODE = 4009
@@ -0,0 +1,118 @@
+import asyncio
+import logging
+
+from channels.consumer import get_handler_name
+
+logger = logging.getLogger(__name__)
+
+
+class GroupRelay:
+    """The channel a worker has in one group, and its sockets in that group."""
+
+    __slots__ = ("group", "channel", "members", "joined", "task")
+
+    def __init__(self, group):
+        self.group = group
+        self.channel = None
+        self.members = set()
+        self.joined = asyncio.get_running_loop().create_future()
+        self.task = None
+
+
+class GroupFanOut:
+    """Delivers a group's messages to the sockets of this worker in one hop.
+
+    Instead of every socket joining the channel layer group, the worker
+    joins it once through a relay channel and hands each message it
+    receives there to all of its local members. A ``group_send`` then costs
+    the layer one copy per worker rather than one per socket, and the
+    relay yields to the event loop every ``batch`` sockets so a large room
+    doesn't hold up other work. Messages still go through the layer
+    unchanged, so anything may ``group_send`` to a relayed group.
+
+    Layers drop a group membership after ``group_expiry``, and the
+    in-memory and Unix-socket layers also drop it once a message of the
+    channel expires. A socket that joined on its own would get a fresh
+    membership, so the relay channel is added to the group again on every
+    join and, while the relay runs, at least every half of the shorter of
+    the layer's ``expiry`` and ``group_expiry``.
+
+    Members are consumers; the handler named by the message type is called
+    with a shallow copy of the message, as ``dispatch`` would.
+    """
+
+    def __init__(self, batch=500):
+        self.batch = batch
+        self.relays = {}
+
+    def __len__(self):
+        return len(self.relays)
+
+    async def join(self, channel_layer, group, consumer):
+        relay = self.relays.get(group)
+        loop = asyncio.get_running_loop()
+        if relay is None or relay.task.done() or relay.task.get_loop() is not loop:
+            relay = self.relays[group] = GroupRelay(group)
+            relay.task = loop.create_task(self._run(channel_layer, relay))
+
+        relay.members.add(consumer)
+        if relay.joined.done() and relay.channel is not None:
+            await channel_layer.group_add(group, relay.channel)
+        else:
+            await asyncio.shield(relay.joined)
+
+    async def leave(self, channel_layer, group, consumer):
+        relay = self.relays.get(group)
+        if relay is None:
+            return
+
+        relay.members.discard(consumer)
+        if relay.members:
+            return
+
+        del self.relays[group]
+        relay.task.cancel()
+        if relay.channel is not None:
+            await channel_layer.group_discard(group, relay.channel)
+
+    async def _run(self, channel_layer, relay):
+        try:
+            relay.channel = await channel_layer.new_channel("relay.")
+            await channel_layer.group_add(relay.group, relay.channel)
+        except Exception as error:
+            relay.joined.set_exception(error)
+            raise
+        relay.joined.set_result(None)
+
+        refresh = asyncio.ensure_future(self._refresh(channel_layer, relay))
+        try:
+            while True:
+                message = await channel_layer.receive(relay.channel)
+                await self.deliver(relay, message)
+        finally:
+            refresh.cancel()
+
+    async def _refresh(self, channel_layer, relay):
+        interval = min(
+            getattr(channel_layer, "expiry", 60), getattr(channel_layer, "group_expiry", 86400)
+        ) / 2
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await channel_layer.group_add(relay.group, relay.channel)
+            except Exception:
+                logger.exception("Failed to refresh the relay membership of %s", relay.group)
+
+    async def deliver(self, relay, message):
+        handler_name = get_handler_name(message)
+        for index, consumer in enumerate(list(relay.members)):
+            if index and index % self.batch == 0:
+                await asyncio.sleep(0)
+
+            handler = getattr(consumer, handler_name, None)
+            if handler is None or consumer not in relay.members:
+                continue
+            try:
+                await handler(dict(message))
+            except Exception:
+                logger.exception("%r failed to handle a message of %s", consumer, relay.group)
@@ -0,0 +1,68 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+# Per consumer class: sockets currently registered with the monitor and
+# channel layer group memberships they hold. Memberships growing while
+# connections stay flat means groups are being left behind.
+connection_stats = defaultdict(lambda: {"connections": 0, "group_memberships": 0})
+
+
+class HeartbeatMonitor:
+    """Pings quiet sockets and reaps the ones that stop answering.
+
+    A single task per worker sweeps every registered consumer each
+    ``interval`` seconds, so sockets don't need timers of their own. A
+    consumer that sent nothing since the previous sweep is pinged, and one
+    that has been silent for ``timeout`` seconds is reaped. Consumers keep
+    ``last_seen`` (a ``time.monotonic()`` value) up to date themselves and
+    implement ``ping()`` and ``reap()``.
+    """
+
+    def __init__(self, interval=30, timeout=75):
+        self.interval = interval
+        self.timeout = timeout
+        self.consumers = set()
+        self.swept_at = time.monotonic()
+        self._task = None
+
+    def register(self, consumer):
+        consumer.last_seen = time.monotonic()
+        self.consumers.add(consumer)
+        connection_stats[type(consumer).__name__]["connections"] += 1
+
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self.swept_at = time.monotonic()
+            self._task = loop.create_task(self._run())
+
+    def unregister(self, consumer):
+        if consumer not in self.consumers:
+            return
+
+        self.consumers.remove(consumer)
+        connection_stats[type(consumer).__name__]["connections"] -= 1
+        if not self.consumers and self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while self.consumers:
+            await asyncio.sleep(self.interval)
+            await self.sweep()
+
+    async def sweep(self):
+        now = time.monotonic()
+        for consumer in list(self.consumers):
+            try:
+                if now - consumer.last_seen >= self.timeout:
+                    await consumer.reap()
+                elif consumer.last_seen < self.swept_at:
+                    await consumer.ping()
+            except Exception:
+                logger.exception("Heartbeat of %r failed, forgetting it", consumer)
+                self.unregister(consumer)
+        self.swept_at = now
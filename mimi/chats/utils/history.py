@@ -0,0 +1,126 @@
+import time
+from collections import Counter, deque
+
+from mimi.utils.caches import LRUCache
+
+
+class RecentMessages:
+    """Ring buffers of the latest messages of recently active conversations.
+
+    A buffer is only created from a full read of its conversation (``load``
+    or ``fill``), and every broadcast this worker receives for the
+    conversation appends to it, once per message id however many local
+    sockets get the broadcast, so messages sent through other workers are
+    buffered too. Messages appended while a conversation is being read are
+    held back and merged into what the read returned, by message id, so a
+    message stored during the read isn't lost either way.
+
+    The worker only receives a conversation's broadcasts while one of its
+    sockets listens to it, so a buffer is dropped as soon as the last
+    ``listen()`` is undone by ``unlisten()``. Conversations are evicted least
+    recently used first, which caps memory at ``conversations * size``
+    messages. Each buffer is also dropped ``ttl`` seconds after it was
+    filled, so messages edited over REST show up again.
+    """
+
+    def __init__(self, size=50, conversations=1000, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        # key -> (message_infos, participants, their message ids)
+        self._buffers = LRUCache(maxsize=conversations)
+        # key -> [reads in progress, (message id, message_info) appended meanwhile]
+        self._loading = {}
+        self._listeners = Counter()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """``(messages, participants)`` of a conversation, None on a miss."""
+        entry = self._buffers.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        messages, participants, _ = entry
+        return list(messages), participants
+
+    def fill(self, key, messages, participants=None, message_ids=()):
+        """Start buffering a conversation from its latest stored messages."""
+        if key in self._buffers:
+            return
+        self._buffers.set(
+            key,
+            (
+                deque(messages, maxlen=self.size),
+                participants,
+                deque((str(message_id) for message_id in message_ids), maxlen=self.size),
+            ),
+            expires_at=time.time() + self.ttl,
+        )
+
+    def listen(self, key):
+        """A local socket started receiving the conversation's broadcasts."""
+        self._listeners[key] += 1
+
+    def unlisten(self, key):
+        self._listeners[key] -= 1
+        if self._listeners[key] <= 0:
+            del self._listeners[key]
+            self._buffers.pop(key)
+
+    async def load(self, key, read, participants=None):
+        """Start buffering a conversation from ``read()``, an async function
+        returning ``(message id, message_info)`` pairs of its latest stored
+        messages, oldest first. Returns the messages."""
+        loading = self._loading.get(key)
+        if loading is None:
+            loading = self._loading[key] = [0, deque(maxlen=self.size)]
+        loading[0] += 1
+        try:
+            rows = await read()
+        finally:
+            loading[0] -= 1
+            if not loading[0] and self._loading.get(key) is loading:
+                del self._loading[key]
+
+        rows = [(str(message_id), message_info) for message_id, message_info in rows]
+        stored = {message_id for message_id, _ in rows}
+        rows += [(message_id, message_info) for message_id, message_info in loading[1] if message_id not in stored]
+        rows = rows[-self.size:]
+        messages = [message_info for _, message_info in rows]
+        self.fill(key, messages, participants, [message_id for message_id, _ in rows])
+        return messages
+
+    def append(self, key, message_info, message_id=None):
+        if message_id is not None:
+            message_id = str(message_id)
+        entry = self._buffers.get(key)
+        if entry is not None:
+            if message_id is not None:
+                if message_id in entry[2]:
+                    return
+                entry[2].append(message_id)
+            entry[0].append(message_info)
+        elif key in self._loading and message_id is not None:
+            appended = self._loading[key][1]
+            if all(appended_id != message_id for appended_id, _ in appended):
+                appended.append((message_id, message_info))
+
+    def clear(self):
+        self._buffers.clear()
+        self._loading.clear()
+        self._listeners.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {
+            "size": len(self._buffers),
+            "maxsize": self._buffers.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def __len__(self):
+        return len(self._buffers)
@@ -0,0 +1,77 @@
+import uuid
+
+from django.db.models import Case, F, Value, When
+
+from mimi.chats.models import ConversationSummary
+
+PREVIEW_LENGTH = ConversationSummary._meta.get_field("last_message").max_length
+
+
+def record_messages(messages):
+    """Bring the inbox rows of the conversations of stored messages up to date.
+
+    Messages are in the order they were sent. Each conversation costs one
+    UPDATE of both participants' rows: the latest message becomes the
+    preview, and a participant's unread count goes up by the messages they
+    received, counted from their own latest message, since sending one
+    means they have read the conversation. The first message of a
+    conversation creates its rows.
+    """
+    latest = {}
+    # (conversation, participant) -> (sent a message, messages received since)
+    unread = {}
+    for message in messages:
+        if message.conversation is None:
+            continue
+        # Ids are strings until the message is read back from the database.
+        sender_id, receiver_id = uuid.UUID(str(message.sender_id)), uuid.UUID(str(message.receiver_id))
+        latest[message.conversation] = message, sender_id, receiver_id
+        unread[message.conversation, sender_id] = (True, 0)
+        if receiver_id != sender_id:
+            replied, received = unread.get((message.conversation, receiver_id), (False, 0))
+            unread[message.conversation, receiver_id] = (replied, received + 1)
+
+    for conversation, (message, sender_id, receiver_id) in latest.items():
+        summaries = ConversationSummary.objects.filter(conversation=conversation)
+        participants = {sender_id, receiver_id}
+        unread_counts = {owner_id: unread.get((conversation, owner_id), (False, 0)) for owner_id in participants}
+
+        if update_summaries(summaries, message, unread_counts) < len(participants):
+            # First message of the conversation. A concurrent writer may have
+            # created the rows in the meantime, so the update runs again.
+            ConversationSummary.objects.bulk_create(
+                [
+                    ConversationSummary(
+                        owner_id=owner_id,
+                        other_user_id=(participants - {owner_id} or {owner_id}).pop(),
+                        conversation=conversation,
+                        last_activity_at=message.created_at,
+                    )
+                    for owner_id in participants
+                ],
+                ignore_conflicts=True,
+            )
+            update_summaries(summaries, message, unread_counts)
+
+
+def update_summaries(summaries, message, unread_counts):
+    return summaries.update(
+        chat_id=message.chat_id,
+        last_message=message.message[:PREVIEW_LENGTH],
+        last_sender_id=message.sender_id,
+        last_activity_at=message.created_at,
+        unread_count=Case(
+            *(
+                When(owner_id=owner_id, then=Value(received) if replied else F("unread_count") + received)
+                for owner_id, (replied, received) in unread_counts.items()
+            ),
+            default=F("unread_count"),
+            output_field=ConversationSummary._meta.get_field("unread_count"),
+        ),
+    )
+
+
+def mark_read(owner_id, conversation):
+    return ConversationSummary.objects.filter(owner_id=owner_id, conversation=conversation).update(
+        unread_count=0
+    )
@@ -0,0 +1,44 @@
+"""Latency histograms and counters of the WebSocket hot path.
+
+Labelled by consumer class; scraped from ``/api/v1/chats/metrics/``.
+"""
+from mimi.utils.metrics import registry
+
+handshake_auth_seconds = registry.histogram(
+    "chat_handshake_auth_seconds",
+    "Time JWTAuthMiddleware spends authenticating a connection.",
+)
+handshake_auth_failures = registry.counter(
+    "chat_handshake_auth_failures_total",
+    "Connections without a token or with an invalid one.",
+)
+connect_seconds = registry.histogram(
+    "chat_connect_seconds",
+    "Time from the WebSocket handshake reaching the consumer to connect() returning.",
+    ["consumer"],
+)
+receive_seconds = registry.histogram(
+    "chat_receive_seconds",
+    "Time spent handling one inbound frame.",
+    ["consumer"],
+)
+frames_rate_limited = registry.counter(
+    "chat_frames_rate_limited_total",
+    "Inbound frames rejected by the rate limits.",
+    ["consumer"],
+)
+persist_seconds = registry.histogram(
+    "chat_persist_seconds",
+    "Time spent storing a message, or handing it to the write-behind buffer.",
+    ["model"],
+)
+group_send_seconds = registry.histogram(
+    "chat_group_send_seconds",
+    "Time spent in channel layer group_send.",
+    ["consumer"],
+)
+delivery_seconds = registry.histogram(
+    "chat_delivery_seconds",
+    "Time spent delivering one chat_message event to a socket.",
+    ["consumer"],
+)
@@ -0,0 +1,139 @@
+import asyncio
+import logging
+from collections import defaultdict, deque
+
+logger = logging.getLogger(__name__)
+
+DROP_OLDEST = "drop_oldest"
+COALESCE = "coalesce"
+DISCONNECT = "disconnect"
+
+OUTBOUND_POLICIES = (DROP_OLDEST, COALESCE, DISCONNECT)
+
+# Per consumer class: frames currently queued across all its connections,
+# frames dropped or coalesced away, and connections closed for falling behind.
+outbound_stats = defaultdict(lambda: {"depth": 0, "dropped": 0, "disconnected": 0})
+
+
+class OutboundQueue:
+    """Bounded queue of frames waiting to be written to one WebSocket.
+
+    Frames are written in order by a drain task that only exists while the
+    queue is non-empty, so idle connections cost no task. Whether a client
+    keeps up is judged from its acknowledgements: once it has acked, via
+    ``ack()``, with the number of frames it has received so far, no more
+    than ``window`` frames are written ahead of its last ack, and the rest
+    wait here. When ``maxsize`` frames are already waiting the policy
+    decides what happens:
+
+    * ``drop_oldest`` - the oldest waiting frame is discarded.
+    * ``coalesce`` - every waiting frame is replaced by a single
+      ``overflow`` frame telling the client how many it missed, so it can
+      catch up with a resume.
+    * ``disconnect`` - ``put`` returns False, the write in progress is
+      cancelled and the caller closes the socket.
+
+    For clients that never ack, frames only wait here while a write is in
+    progress. That bounds them on servers whose ``send`` waits for the
+    socket, such as uvicorn and hypercorn, but not on daphne: its ``send``
+    hands the frame to Twisted's transport buffer and returns at once, so
+    the queue never fills and the backlog grows in the transport instead.
+
+    Connections are many, so the queue is slotted and only holds a deque
+    while frames are waiting.
+    """
+
+    __slots__ = ("_send", "_frames", "_task", "maxsize", "policy", "window", "sent", "acked", "stats")
+
+    def __init__(self, send, maxsize, policy, stats_key, window=256):
+        if policy not in OUTBOUND_POLICIES:
+            raise ValueError(f"Unknown outbound policy {policy}")
+        self._send = send
+        self._frames = None
+        self._task = None
+        self.maxsize = maxsize
+        self.policy = policy
+        self.window = window
+        self.sent = 0
+        self.acked = None
+        self.stats = outbound_stats[stats_key]
+
+    def __len__(self):
+        return len(self._frames) if self._frames else 0
+
+    def put(self, frame):
+        if len(self) >= self.maxsize:
+            if self.policy == DISCONNECT:
+                self.cancel()
+                self.stats["disconnected"] += 1
+                return False
+
+            if self.policy == DROP_OLDEST:
+                self._frames.popleft()
+                self.stats["depth"] -= 1
+                self.stats["dropped"] += 1
+            else:
+                dropped = self.clear()
+                self.stats["dropped"] += dropped
+                self._append({"overflow": dropped})
+
+        self._append(frame)
+        return True
+
+    def _append(self, frame):
+        if self._frames is None:
+            self._frames = deque()
+        self._frames.append(frame)
+        self.stats["depth"] += 1
+        self._start()
+
+    def ack(self, received):
+        """Record that the client has received ``received`` frames in all."""
+        received = min(received, self.sent)
+        if self.acked is None or received > self.acked:
+            self.acked = received
+        self._start()
+
+    def _in_window(self):
+        return self.acked is None or self.sent - self.acked < self.window
+
+    def _start(self):
+        if self._task is None and self._frames and self._in_window():
+            self._task = asyncio.ensure_future(self._drain())
+
+    async def _drain(self):
+        try:
+            while self._frames and self._in_window():
+                frame = self._frames.popleft()
+                self.stats["depth"] -= 1
+                await self._send(frame)
+                self.sent += 1
+        except Exception:
+            logger.exception("Failed to write a WebSocket frame, dropping the queue")
+            self.clear()
+        finally:
+            if self._task is asyncio.current_task():
+                self._task = None
+            if not self._frames:
+                self._frames = None
+
+    async def join(self):
+        """Wait until every queued frame has been written."""
+        while self._task is not None:
+            await asyncio.shield(self._task)
+
+    def clear(self):
+        dropped = len(self)
+        if dropped:
+            self._frames.clear()
+            self.stats["depth"] -= dropped
+        return dropped
+
+    def cancel(self):
+        """Drop the waiting frames and stop the write in progress, so nothing
+        waits on a client that stopped reading."""
+        dropped = self.clear()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        return dropped
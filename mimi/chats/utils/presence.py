@@ -0,0 +1,124 @@
+import time
+import uuid
+from collections import Counter
+
+from django.core.cache import cache
+
+from mimi.utils.caches import LRUCache
+
+
+class PresenceRegistry:
+    """Who is online, kept in the cache with a TTL and never in the database.
+
+    Each worker counts its own sockets per user and owns one key per user
+    it has sockets for, ``presence:<user>:<worker>``. The key is written
+    when the user's first socket on the worker connects, refreshed by
+    heartbeats at most every third of ``ttl`` and deleted when their last
+    socket on the worker closes; a worker that dies leaves keys that expire
+    after ``ttl``. A user is online while any worker holds a key for them,
+    so closing the sockets on one worker doesn't hide those on another.
+
+    Readers find the keys through a directory of live workers,
+    ``presence:workers``, mapping each worker to the unix time its entry
+    expires. Workers rewrite their entry every third of ``ttl``; an entry
+    lost to two workers writing the directory at once comes back with the
+    next rewrite.
+    """
+
+    key_prefix = "presence:"
+    workers_key = "presence:workers"
+
+    def __init__(self, ttl=60, worker=None):
+        self.ttl = ttl
+        self.worker = worker or uuid.uuid4().hex[:12]
+        self.connections = Counter()
+        self.refreshed_at = {}
+        self.listed_at = None
+
+    @classmethod
+    def key(cls, user_id, worker):
+        return f"{cls.key_prefix}{user_id}:{worker}"
+
+    async def connect(self, user_id):
+        user_id = str(user_id)
+        self.connections[user_id] += 1
+        await self.refresh(user_id)
+
+    async def heartbeat(self, user_id):
+        user_id = str(user_id)
+        if user_id not in self.connections:
+            return
+        if time.monotonic() - self.refreshed_at[user_id] >= self.ttl / 3:
+            await self.refresh(user_id)
+
+    async def refresh(self, user_id):
+        self.refreshed_at[user_id] = time.monotonic()
+        await cache.aset(self.key(user_id, self.worker), time.time(), self.ttl)
+        if self.listed_at is None or time.monotonic() - self.listed_at >= self.ttl / 3:
+            await self.list_worker()
+
+    async def list_worker(self):
+        """Put this worker in the directory, dropping workers that expired."""
+        self.listed_at = time.monotonic()
+        now = time.time()
+        workers = await cache.aget(self.workers_key) or {}
+        workers = {worker: expires_at for worker, expires_at in workers.items() if expires_at > now}
+        workers[self.worker] = now + self.ttl
+        await cache.aset(self.workers_key, workers, self.ttl)
+
+    async def disconnect(self, user_id):
+        user_id = str(user_id)
+        self.connections[user_id] -= 1
+        if self.connections[user_id] > 0:
+            return
+
+        del self.connections[user_id]
+        del self.refreshed_at[user_id]
+        await cache.adelete(self.key(user_id, self.worker))
+
+    async def is_online(self, user_id):
+        """Whether any worker has a socket of the user."""
+        if str(user_id) in self.connections:
+            return True
+        workers = self.live_workers(await cache.aget(self.workers_key))
+        keys = [self.key(user_id, worker) for worker in workers]
+        return bool(keys) and bool(await cache.aget_many(keys))
+
+    @staticmethod
+    def live_workers(workers):
+        now = time.time()
+        return [worker for worker, expires_at in (workers or {}).items() if expires_at > now]
+
+    @classmethod
+    def last_seen(cls, user_ids):
+        """Map each user id to the unix time of its last heartbeat on any
+        worker, or None when it's offline, with two cache reads. Needs no
+        registry instance, so HTTP workers can answer it too."""
+        workers = cls.live_workers(cache.get(cls.workers_key))
+        keys = {
+            cls.key(user_id, worker): user_id for user_id in user_ids for worker in workers
+        }
+        last_seen = dict.fromkeys(user_ids)
+        for key, seen in cache.get_many(list(keys)).items():
+            user_id = keys[key]
+            if last_seen[user_id] is None or seen > last_seen[user_id]:
+                last_seen[user_id] = seen
+        return last_seen
+
+
+class Debouncer:
+    """Lets an event through at most once per ``interval`` seconds per key.
+
+    Keys are remembered in an LRU cache, so memory stays bounded however
+    many users and conversations there are.
+    """
+
+    def __init__(self, interval, maxsize=10000):
+        self.interval = interval
+        self._recent = LRUCache(maxsize=maxsize)
+
+    def allow(self, key):
+        if key in self._recent:
+            return False
+        self._recent.set(key, True, expires_at=time.time() + self.interval)
+        return True
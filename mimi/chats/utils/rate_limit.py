@@ -0,0 +1,55 @@
+import time
+
+from mimi.utils.caches import LRUCache
+
+
+class TokenBucket:
+    """Allows ``rate`` events per second on average and bursts of ``burst``.
+
+    Tokens are topped up from the time elapsed whenever one is taken, so a
+    bucket needs no timer; ``__slots__`` keeps the per-socket instances small.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated_at")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def retry_after(self):
+        """Seconds until the next event is allowed."""
+        return max(0, 1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """Token buckets by key, for limits shared by several sockets such as
+    every connection of a user.
+
+    At most ``maxsize`` keys have a bucket, least recently used evicted
+    first. Evicting a bucket idle for ``burst / rate`` seconds loses nothing,
+    since it would have refilled by then.
+    """
+
+    def __init__(self, maxsize=10000):
+        self._buckets = LRUCache(maxsize=maxsize)
+
+    def bucket(self, key, rate, burst):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(rate, burst)
+            self._buckets.set(key, bucket)
+        return bucket
+
+    def clear(self):
+        self._buckets.clear()
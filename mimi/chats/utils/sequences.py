@@ -0,0 +1,90 @@
+import uuid
+
+from django.db import connection, transaction
+
+from mimi.chats.models import ChatIDs, Message
+from mimi.chats.utils.inbox import record_messages
+from mimi.utils.caches import LRUCache
+
+
+def next_sequence(chat_id, count=1):
+    """Allocate the next ``count`` sequence numbers of a chat and return the
+    last of them.
+
+    Returns None when the chat doesn't exist. Must run inside a transaction:
+    the UPDATE keeps the ChatIDs row locked until it commits, so sequence
+    numbers of one chat are handed out and committed in order. UPDATE ...
+    RETURNING (PostgreSQL, SQLite 3.35+) does it in a single statement.
+    """
+    chat_id = ChatIDs._meta.pk.get_db_prep_value(chat_id, connection)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"UPDATE {ChatIDs._meta.db_table} SET last_sequence = last_sequence + %s "
+            "WHERE id = %s RETURNING last_sequence",
+            [count, chat_id],
+        )
+        row = cursor.fetchone()
+    return None if row is None else row[0]
+
+
+class SequenceBlocks:
+    """Sequence numbers for write-behind messages, reserved ``size`` at a time.
+
+    ``take()`` hands out the next number of the chat's block from memory and
+    returns None once it is used up; ``reserve()`` then allocates a new block
+    with one UPDATE. With a size of 1 every message costs that UPDATE, and
+    the thread hop to run it, before it can be broadcast.
+
+    Larger blocks keep numbers unique but give up their order across
+    workers: two workers sending in one chat each hand out their own block,
+    so a message can get a lower number than one sent earlier through the
+    other worker, and a resume from the higher number skips it. Numbers of
+    a block left unused are gaps. Only use blocks when each chat's messages
+    go through a single worker.
+    """
+
+    def __init__(self, size=1, maxsize=10000):
+        self.size = size
+        # chat id -> [next number, last number of the block]
+        self._blocks = LRUCache(maxsize=maxsize)
+
+    def clear(self):
+        self._blocks.clear()
+
+    def take(self, chat_id):
+        block = self._blocks.get(uuid.UUID(str(chat_id)))
+        if block is None or block[0] > block[1]:
+            return None
+        block[0] += 1
+        return block[0] - 1
+
+    def reserve(self, chat_id):
+        """Allocate a new block and take its first number, None when the
+        chat doesn't exist."""
+        with transaction.atomic():
+            last = next_sequence(chat_id, self.size)
+        if last is None:
+            return None
+        first = last - self.size + 1
+        self._blocks.set(uuid.UUID(str(chat_id)), [first + 1, last])
+        return first
+
+
+def create_sequenced_message(chat_id, **fields):
+    with transaction.atomic():
+        sequence = next_sequence(chat_id)
+        if sequence is not None:
+            fields.update(chat_id=chat_id, sequence=sequence)
+        message = Message.objects.create(**fields)
+        record_messages([message])
+        return message
+
+
+def build_sequenced_message(chat_id, sequence, **fields):
+    """A message stored later (write-behind) under a sequence number taken
+    from SequenceBlocks, None when the chat doesn't exist."""
+    if sequence is not None:
+        fields.update(chat_id=chat_id, sequence=sequence)
+    message = Message(**fields)
+    message.set_conversation()
+    return message
@@ -0,0 +1,78 @@
+import logging
+
+from django.db import transaction
+from django.db.models import Count, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from mimi.chats.models import RoomMembers, RoomMessages
+from mimi.chats.utils.write_behind import DeferredWrites
+
+logger = logging.getLogger(__name__)
+
+
+class ReadWatermarks(DeferredWrites):
+    """Coalesces the read watermarks of room members.
+
+    Reading a room moves its member's watermark in memory only. Every
+    ``interval`` seconds the latest watermark of each member that moved is
+    written, so a member's row is written at most once per interval however
+    many messages they read. Watermarks never move backwards, whichever
+    worker writes last.
+    """
+
+    def __init__(self, interval=5):
+        super().__init__()
+        self.interval = interval
+
+    def new_pending(self):
+        # (room id, user id) -> latest read_at
+        return {}
+
+    def advance(self, room_id, user_id, read_at=None):
+        """Mark the room read by the user up to read_at, now by default."""
+        read_at = read_at or timezone.now()
+        key = (str(room_id), str(user_id))
+        pending = self._pending.get(key)
+        if pending is None or pending < read_at:
+            self._pending[key] = read_at
+        self.schedule(self.interval)
+
+    def write_sync(self, pending):
+        try:
+            with transaction.atomic():
+                for (room_id, user_id), read_at in pending.items():
+                    RoomMembers.objects.filter(
+                        Q(last_read_at__lt=read_at) | Q(last_read_at=None),
+                        room_id=room_id,
+                        room_member_id=user_id,
+                    ).update(last_read_at=read_at)
+        except Exception:
+            logger.exception("Failed to write %s room read watermarks", len(pending))
+        return len(pending)
+
+
+def unread_counts(user_id):
+    """Unread messages of every room the user is a member of, by room id.
+
+    One query: each membership counts the range of the (room, created_at)
+    index after its watermark. Messages the user sent don't count.
+    """
+    unread = (
+        RoomMessages.objects.filter(
+            room_id=OuterRef("room_id"),
+            created_at__gt=Coalesce(OuterRef("last_read_at"), OuterRef("created_at")),
+        )
+        .exclude(sender_id=user_id)
+        .order_by()
+        .values("room_id")
+        .annotate(count=Count("id"))
+        .values("count")
+    )
+    memberships = RoomMembers.objects.filter(room_member_id=user_id).annotate(
+        unread_count=Coalesce(Subquery(unread), 0)
+    )
+    return {
+        str(room_id): unread_count
+        for room_id, unread_count in memberships.values_list("room_id", "unread_count")
+    }
@@ -0,0 +1,150 @@
+import asyncio
+import atexit
+import logging
+from abc import ABC, abstractmethod
+
+from asgiref.sync import sync_to_async
+
+logger = logging.getLogger(__name__)
+
+
+class DeferredWrites(ABC):
+    """Writes held in memory and stored later, in the background.
+
+    Subclasses keep what is waiting in ``_pending`` (a fresh one comes from
+    ``new_pending()``), call ``schedule()`` when it should be stored after a
+    delay, and store it in ``write_sync()``. They override ``write()`` when
+    they can store without a thread. ``flush_sync`` runs at interpreter exit,
+    so nothing waiting is lost on a clean shutdown.
+    """
+
+    def __init__(self):
+        self._pending = self.new_pending()
+        self._timer = None
+        self._tasks = set()
+        atexit.register(self.flush_sync)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def new_pending(self):
+        return []
+
+    def schedule(self, delay):
+        """Flush ``delay`` seconds from now, unless a flush is already due."""
+        if self._timer is None:
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_later(delay, self._flush_later)
+
+    def _flush_later(self):
+        self._timer = None
+        task = asyncio.ensure_future(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def take_pending(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending = self._pending, self.new_pending()
+        return pending
+
+    def clear(self):
+        self.take_pending()
+
+    async def flush(self):
+        pending = self.take_pending()
+        if not pending:
+            return 0
+        return await self.write(pending)
+
+    def flush_sync(self):
+        pending = self.take_pending()
+        if not pending:
+            return 0
+        return self.write_sync(pending)
+
+    async def write(self, pending):
+        return await sync_to_async(self.write_sync)(pending)
+
+    @abstractmethod
+    def write_sync(self, pending):
+        """Store ``pending`` and return how many entries were stored."""
+
+
+class WriteBehindBuffer(DeferredWrites):
+    """Collects unsaved model instances and stores them with bulk_create.
+
+    A batch is written once ``batch_size`` instances are pending or
+    ``flush_interval`` seconds after the first pending instance arrived,
+    whichever comes first. Instances must already carry their primary key
+    (every BaseModel does), so they can be broadcast before they are stored.
+    With ``ignore_conflicts`` rows violating a unique constraint are skipped
+    instead of failing the whole batch. ``on_write``, if given, is called
+    with the instances of every batch that were actually stored, outside
+    the event loop; with ``ignore_conflicts`` that costs a query reading
+    back which primary keys made it.
+    """
+
+    def __init__(self, model, batch_size=100, flush_interval=0.05, ignore_conflicts=False, on_write=None):
+        super().__init__()
+        self.model = model
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.ignore_conflicts = ignore_conflicts
+        self.on_write = on_write
+        self._writing = []
+
+    def find(self, **fields):
+        """The first instance not stored yet, pending or being written, whose
+        fields equal ``fields``, or None."""
+        for batch in (self._pending, *self._writing):
+            for instance in batch:
+                if all(str(getattr(instance, name)) == str(value) for name, value in fields.items()):
+                    return instance
+        return None
+
+    async def add(self, instance):
+        self._pending.append(instance)
+
+        if len(self._pending) >= self.batch_size:
+            await self.flush()
+        else:
+            self.schedule(self.flush_interval)
+
+    async def write(self, batch):
+        self._writing.append(batch)
+        try:
+            await self.model.objects.abulk_create(batch, ignore_conflicts=self.ignore_conflicts)
+            if self.on_write is not None:
+                await sync_to_async(self.written)(batch)
+        except Exception:
+            logger.exception(
+                "Failed to write %s buffered %s rows", len(batch), self.model.__name__
+            )
+            return 0
+        finally:
+            self._writing.remove(batch)
+        return len(batch)
+
+    def write_sync(self, batch):
+        try:
+            self.model.objects.bulk_create(batch, ignore_conflicts=self.ignore_conflicts)
+            if self.on_write is not None:
+                self.written(batch)
+        except Exception:
+            logger.exception(
+                "Failed to write %s buffered %s rows", len(batch), self.model.__name__
+            )
+            return 0
+        return len(batch)
+
+    def written(self, batch):
+        if self.ignore_conflicts:
+            # Skipped rows don't tell bulk_create apart from stored ones.
+            stored = set(
+                self.model.objects.filter(pk__in=[instance.pk for instance in batch]).values_list("pk", flat=True)
+            )
+            batch = [instance for instance in batch if instance.pk in stored]
+        if batch:
+            self.on_write(batch)
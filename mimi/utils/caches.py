@@ -0,0 +1,65 @@
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Bounded in-process cache with least-recently-used eviction.
+
+    Entries can carry an absolute expiry (a unix timestamp); expired entries
+    are treated as misses and dropped on access. Hit/miss counters are kept so
+    callers can report how well the cache performs.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.time():
+            del self._data[key]
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, expires_at=None):
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self):
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def __contains__(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return False
+        return entry[1] is None or entry[1] > time.time()
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,169 @@
+"""In-process counters and latency histograms, rendered in the Prometheus
+text exposition format.
+
+Metrics are kept per worker process and cost a dict lookup and a few
+additions per observation, so they can stay on in production. Each worker
+answers a scrape with its own figures; the scraper sums them up.
+"""
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+
+# Seconds, from half a millisecond to five seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels.items()
+    )
+    return "{" + pairs + "}"
+
+
+class Metric(ABC):
+    type = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+
+    @abstractmethod
+    def samples(self):
+        """(suffix, labels, value) of every sample of the metric."""
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(labels)} {value}")
+        return lines
+
+
+class LabeledMetric(Metric):
+    """A metric recorded by the application, one child per combination of
+    label values."""
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help)
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+
+    def labels(self, *values):
+        """The child metric for one combination of label values."""
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self.new_child()
+        return child
+
+    @abstractmethod
+    def new_child(self):
+        """A child holding the values of one combination of labels."""
+
+
+class CounterValue:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Counter(LabeledMetric):
+    type = "counter"
+
+    def new_child(self):
+        return CounterValue()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def samples(self):
+        for values, child in self._children.items():
+            yield "", dict(zip(self.labelnames, values)), child.value
+
+
+class HistogramValue:
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # One count per bucket, the last one for values above every bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Histogram(LabeledMetric):
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def new_child(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def samples(self):
+        for values, child in self._children.items():
+            labels = dict(zip(self.labelnames, values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), child.counts):
+                cumulative += count
+                yield "_bucket", {**labels, "le": bound}, cumulative
+            yield "_sum", labels, child.sum
+            yield "_count", labels, cumulative
+
+
+class Gauge(Metric):
+    """A value read when the metrics are scraped, from ``collect()``
+    returning ``(labels, value)`` pairs. Its labels come from collect(), so
+    it has no labels() to record through."""
+
+    type = "gauge"
+
+    def __init__(self, name, help, collect):
+        super().__init__(name, help)
+        self.collect = collect
+
+    def samples(self):
+        for labels, value in self.collect():
+            yield "", labels, value
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name, help, collect):
+        return self.register(Gauge(name, help, collect))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
@@ -9,8 +9,16 @@ from mimi.chats.utils.constants import REJECT_ROOM_REQUEST, ACCEPTED_ROOM_REQUES
 
 from tests.accounts.factories import UserFactory
 from rest_framework.test import APITestCase
-from  mimi.chats.models import Room, RoomMembers, JoinRoomRequests
+from  mimi.chats.models import Room, RoomMembers, RoomMessages, JoinRoomRequests, Message, ChatIDs
+from mimi.chats.utils.chat_ids import chat_ids
+from mimi.chats.utils.metrics import receive_seconds
+from mimi.chats.utils.sequences import create_sequenced_message
+from mimi.chats.utils.presence import PresenceRegistry
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
 from django.contrib.auth import get_user_model
+from django.test import override_settings
+from django.utils import timezone
 
 User = get_user_model()
 
@@ -555,6 +563,238 @@ class TestUserLeaveRoomAPIView(APITestCase):
 
 
 
+
+
+class TestPresenceAPIView(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.url = reverse('chats_api_v1:presence')
+        self.user = UserFactory(is_active=True)
+        self.friend = UserFactory(is_active=True, username='friend', email='friend@mail.com')
+        authorization_token = RefreshToken.for_user(self.user).access_token
+        self.headers = {'HTTP_AUTHORIZATION': f'Bearer {authorization_token}'}
+
+    def test_presence_of_a_batch_of_users_is_read_without_the_database(self):
+        """Test the presence of several users is answered from the cache alone"""
+        registry = PresenceRegistry(ttl=60)
+        async_to_sync(registry.connect)(self.friend.id)
+
+        with self.assertNumQueries(0):
+            response = self.client.get(
+                self.url, {'user_ids': f'{self.friend.id},{self.user.id}'}, **self.headers
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data[str(self.friend.id)]['online'])
+        self.assertIsNotNone(response.data[str(self.friend.id)]['last_seen'])
+        self.assertEqual(response.data[str(self.user.id)], {'online': False, 'last_seen': None})
+
+        async_to_sync(registry.disconnect)(self.friend.id)
+        response = self.client.get(self.url, {'user_ids': str(self.friend.id)}, **self.headers)
+        self.assertFalse(response.data[str(self.friend.id)]['online'])
+
+    def test_invalid_user_ids_are_rejected(self):
+        """Test user ids that aren't UUIDs get a 400"""
+        response = self.client.get(self.url, {'user_ids': 'not-a-uuid'}, **self.headers)
+
+        self.assertEqual(response.status_code, 400)
+
+
+class TestMessageAPIView(APITestCase):
+
+    def setUp(self):
+        self.user = UserFactory(is_active=True)
+        self.friend = UserFactory(is_active=True, username='friend', email='friend@mail.com')
+        self.stranger = UserFactory(is_active=True, username='stranger', email='stranger@mail.com')
+        self.url = reverse('chats_api_v1:get_message', kwargs={'other_user_id': self.friend.id})
+        authorization_token = RefreshToken.for_user(self.user).access_token
+        self.headers = {'HTTP_AUTHORIZATION': f'Bearer {authorization_token}'}
+
+        for index in range(5):
+            sender, receiver = (self.user, self.friend) if index % 2 else (self.friend, self.user)
+            Message.objects.create(sender=sender, receiver=receiver, message=f'message {index}')
+        Message.objects.create(sender=self.user, receiver=self.stranger, message='elsewhere')
+
+    def messages(self, response):
+        return [message['message'] for message in response.data['results']]
+
+    def test_history_is_paged_by_cursor_in_both_directions(self):
+        """Test both directions of a conversation are walked newest first and back again"""
+        response = self.client.get(self.url, {'page_size': 2}, **self.headers)
+        pages = [self.messages(response)]
+        self.assertIsNone(response.data['newer'])
+        while response.data['older']:
+            response = self.client.get(response.data['older'], **self.headers)
+            pages.append(self.messages(response))
+
+        self.assertEqual(pages, [['message 4', 'message 3'], ['message 2', 'message 1'], ['message 0']])
+
+        response = self.client.get(response.data['newer'], **self.headers)
+        self.assertEqual(self.messages(response), ['message 2', 'message 1'])
+        response = self.client.get(response.data['newer'], **self.headers)
+        self.assertEqual(self.messages(response), ['message 4', 'message 3'])
+        self.assertIsNone(response.data['newer'])
+
+    def test_page_costs_one_query_for_the_messages(self):
+        """Test senders and receivers are read with the page, not once per message"""
+        with self.assertNumQueries(2):
+            response = self.client.get(self.url, **self.headers)
+
+        self.assertEqual(len(response.data['results']), 5)
+
+    def test_invalid_cursor_is_rejected(self):
+        """Test a cursor that wasn't handed out gets a 404"""
+        response = self.client.get(self.url, {'before': 'not-a-cursor'}, **self.headers)
+
+        self.assertEqual(response.status_code, 404)
+
+
+class TestInboxAPIView(APITestCase):
+
+    def setUp(self):
+        self.url = reverse('chats_api_v1:inbox')
+        self.user = UserFactory(is_active=True)
+        self.friend = UserFactory(is_active=True, username='friend', email='friend@mail.com')
+        self.other_friend = UserFactory(is_active=True, username='other', email='other@mail.com')
+        authorization_token = RefreshToken.for_user(self.user).access_token
+        self.headers = {'HTTP_AUTHORIZATION': f'Bearer {authorization_token}'}
+
+        for sender, receiver, text in (
+            (self.friend, self.user, 'hi'),
+            (self.other_friend, self.user, 'hello'),
+            (self.friend, self.user, 'are you there?'),
+        ):
+            chat = ChatIDs.objects.filter(sender=sender, receiver=receiver).first()
+            chat = chat or ChatIDs.objects.create(sender=sender, receiver=receiver)
+            create_sequenced_message(chat.id, sender_id=sender.id, receiver_id=receiver.id, message=text)
+
+    def test_inbox_lists_conversations_by_last_activity_in_one_query(self):
+        """Test the inbox is read from the summary rows alone, latest conversation first"""
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url, **self.headers)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [
+                (summary['other_user'], summary['last_message'], summary['unread_count'])
+                for summary in response.data['results']
+            ],
+            [('friend', 'are you there?', 2), ('other', 'hello', 1)],
+        )
+
+        response = self.client.get(self.url, {'page_size': 1}, **self.headers)
+        response = self.client.get(response.data['older'], **self.headers)
+        self.assertEqual([summary['other_user'] for summary in response.data['results']], ['other'])
+
+    def test_reading_or_replying_resets_the_unread_count(self):
+        """Test marking a conversation read, or writing in it, clears its unread count"""
+        url = reverse('chats_api_v1:mark_conversation_read', kwargs={'other_user_id': self.friend.id})
+        self.assertEqual(self.client.post(url, **self.headers).status_code, 204)
+
+        chat = ChatIDs.objects.get(sender=self.other_friend)
+        create_sequenced_message(chat.id, sender_id=self.user.id, receiver_id=self.other_friend.id, message='yes')
+
+        response = self.client.get(self.url, **self.headers)
+        self.assertEqual(
+            [(summary['other_user'], summary['unread_count']) for summary in response.data['results']],
+            [('other', 0), ('friend', 0)],
+        )
+
+
+class TestRoomUnreadCountsAPIView(APITestCase):
+
+    def setUp(self):
+        self.url = reverse('chats_api_v1:room_unread_counts')
+        self.user = UserFactory(is_active=True)
+        self.friend = UserFactory(is_active=True, username='friend', email='friend@mail.com')
+        self.room = RoomFactory()
+        RoomMembersFactory(room=self.room, room_member=self.user, last_read_at=timezone.now())
+        authorization_token = RefreshToken.for_user(self.user).access_token
+        self.headers = {'HTTP_AUTHORIZATION': f'Bearer {authorization_token}'}
+
+    def test_unread_counts_of_the_users_rooms_in_one_query(self):
+        """Test the counts are read without loading the user, one query for all rooms"""
+        RoomMessages.objects.create(room=self.room, sender=self.friend, message='hello')
+
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url, **self.headers)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {str(self.room.id): 1})
+
+
+class TestGenerateUniqueIDForChatAPIView(APITestCase):
+
+    def setUp(self):
+        chat_ids.clear()
+        self.url = reverse('chats_api_v1:generate_chat_id')
+        self.user = UserFactory(is_active=True)
+        self.friend = UserFactory(is_active=True, username='friend', email='friend@mail.com')
+        self.headers = {'HTTP_AUTHORIZATION': f'Bearer {RefreshToken.for_user(self.user).access_token}'}
+        self.friend_headers = {'HTTP_AUTHORIZATION': f'Bearer {RefreshToken.for_user(self.friend).access_token}'}
+
+    def test_both_users_get_the_same_chat_once_it_exists(self):
+        """Test the chat is created on the first request and found from either side"""
+        response = self.client.get(self.url, {'receiver': self.friend.id}, **self.headers)
+        self.assertEqual(response.status_code, 200)
+        chat_id = response.data['chat_id']
+
+        chat_ids.clear()
+        with self.assertNumQueries(3):
+            response = self.client.get(self.url, {'receiver': self.user.id}, **self.friend_headers)
+
+        self.assertEqual(response.data['chat_id'], chat_id)
+        self.assertEqual(ChatIDs.objects.count(), 1)
+
+    def test_known_pair_is_answered_without_the_database(self):
+        """Test a chat id already looked up is served from the cache"""
+        chat_id = self.client.get(self.url, {'receiver': self.friend.id}, **self.headers).data['chat_id']
+
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, {'receiver': self.user.id}, **self.friend_headers)
+
+        self.assertEqual(response.data['chat_id'], chat_id)
+
+    def test_invalid_receiver_is_rejected(self):
+        """Test a receiver that isn't a user id gets a 400"""
+        response = self.client.get(self.url, {'receiver': 'not-a-uuid'}, **self.headers)
+
+        self.assertEqual(response.status_code, 400)
+
+
+class TestMetricsAPIView(APITestCase):
+
+    def setUp(self):
+        self.url = reverse('chats_api_v1:metrics')
+
+    def test_histograms_are_exposed_in_the_prometheus_text_format(self):
+        """Test observations show up as cumulative buckets, sum and count"""
+        histogram = receive_seconds.labels('TestConsumer')
+        count = sum(histogram.counts)
+        histogram.observe(0.002)
+
+        with override_settings(DEBUG=True):
+            response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        body = response.content.decode()
+        self.assertIn('# TYPE chat_receive_seconds histogram', body)
+        self.assertIn(f'chat_receive_seconds_bucket{{consumer="TestConsumer",le="0.0025"}} {count + 1}', body)
+        self.assertIn(f'chat_receive_seconds_count{{consumer="TestConsumer"}} {count + 1}', body)
+
+    @override_settings(METRICS_TOKEN='scrape-token')
+    def test_metrics_token_is_required_once_configured(self):
+        """Test scrapers must send the configured token"""
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+        response = self.client.get(self.url, HTTP_AUTHORIZATION='Bearer scrape-token')
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(METRICS_TOKEN=None, DEBUG=False)
+    def test_metrics_are_closed_without_a_token_outside_debug(self):
+        """Test a deployment without METRICS_TOKEN doesn't expose the metrics"""
+        self.assertEqual(self.client.get(self.url).status_code, 403)
 
 
 # NOTE: STOPPED AT 8
@@ -0,0 +1,372 @@
+import asyncio
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer
+from django.core.cache import cache
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from mimi.chats.models import ConversationSummary, Message, RoomMembers, RoomMessages
+from mimi.chats.utils.fanout import GroupFanOut
+from mimi.chats.utils.history import RecentMessages
+from mimi.chats.utils.inbox import record_messages
+from mimi.chats.utils.outbound import OutboundQueue, outbound_stats
+from mimi.chats.utils.presence import PresenceRegistry
+from mimi.chats.utils.watermarks import ReadWatermarks, unread_counts
+from mimi.chats.utils.write_behind import WriteBehindBuffer
+from tests.accounts.factories import UserFactory
+from tests.chats.factories import RoomFactory, RoomMembersFactory
+
+
+class Client:
+    """Records written frames. Like daphne's send(), writing never waits for
+    the client to read, unless stall() was called"""
+
+    def __init__(self):
+        self.frames = []
+        self.gate = asyncio.Event()
+        self.gate.set()
+
+    async def send(self, frame):
+        await self.gate.wait()
+        self.frames.append(frame)
+
+    def stall(self):
+        self.gate.clear()
+
+
+class TestOutboundQueue(SimpleTestCase):
+
+    def setUp(self):
+        outbound_stats.clear()
+
+    async def put_all(self, queue, count):
+        """Queue count frames, letting the queue write between them"""
+        accepted = []
+        for index in range(count):
+            accepted.append(queue.put({'text_data': str(index)}))
+            await asyncio.sleep(0)
+        return accepted
+
+    async def fill(self, policy, count, maxsize=3, window=2):
+        """Queue count frames for a client that acked nothing since its first frame"""
+        client = Client()
+        queue = OutboundQueue(client.send, maxsize=maxsize, policy=policy, stats_key='Test', window=window)
+        queue.ack(0)
+
+        accepted = await self.put_all(queue, count)
+        await queue.join()
+        return client, queue, accepted
+
+    async def test_clients_that_never_ack_get_every_frame(self):
+        """Test frames are written as fast as the server takes them until the client acks"""
+        client = Client()
+        queue = OutboundQueue(client.send, maxsize=3, policy='drop_oldest', stats_key='Test', window=2)
+
+        accepted = await self.put_all(queue, 5)
+        await queue.join()
+
+        self.assertTrue(all(accepted))
+        self.assertEqual(len(client.frames), 5)
+        self.assertEqual(outbound_stats['Test'], {'depth': 0, 'dropped': 0, 'disconnected': 0})
+
+    async def test_frames_past_the_window_wait_for_acks(self):
+        """Test no more than window frames are written ahead of the client's last ack"""
+        client, queue, accepted = await self.fill('drop_oldest', 5, maxsize=5)
+
+        self.assertTrue(all(accepted))
+        self.assertEqual([frame['text_data'] for frame in client.frames], ['0', '1'])
+        self.assertEqual(len(queue), 3)
+
+        queue.ack(2)
+        await asyncio.sleep(0)
+        self.assertEqual([frame['text_data'] for frame in client.frames], ['0', '1', '2', '3'])
+
+        queue.ack(4)
+        await queue.join()
+        self.assertEqual(len(client.frames), 5)
+        self.assertEqual(outbound_stats['Test'], {'depth': 0, 'dropped': 0, 'disconnected': 0})
+
+    async def test_drop_oldest_keeps_the_newest_frames(self):
+        """Test drop_oldest discards the oldest waiting frames once the queue is full"""
+        client, queue, accepted = await self.fill('drop_oldest', 8)
+
+        self.assertTrue(all(accepted))
+        queue.ack(2)
+        await queue.join()
+        self.assertEqual([frame['text_data'] for frame in client.frames], ['0', '1', '5', '6'])
+        self.assertEqual(outbound_stats['Test'], {'depth': 1, 'dropped': 3, 'disconnected': 0})
+
+    async def test_coalesce_replaces_the_backlog_with_an_overflow_frame(self):
+        """Test coalesce collapses the waiting frames into one overflow notice"""
+        client, queue, accepted = await self.fill('coalesce', 7)
+
+        self.assertTrue(all(accepted))
+        queue.ack(2)
+        await queue.join()
+        self.assertEqual(client.frames[2:], [{'overflow': 3}, {'text_data': '5'}])
+        self.assertEqual(outbound_stats['Test'], {'depth': 1, 'dropped': 3, 'disconnected': 0})
+
+    async def test_disconnect_policy_refuses_frames_once_full(self):
+        """Test disconnect reports a full queue so the consumer can close the socket"""
+        client, queue, accepted = await self.fill('disconnect', 6)
+
+        self.assertEqual(accepted, [True] * 5 + [False])
+        self.assertEqual(len(client.frames), 2)
+        self.assertEqual(outbound_stats['Test'], {'depth': 0, 'dropped': 0, 'disconnected': 1})
+
+    async def test_disconnect_policy_stops_a_stalled_write(self):
+        """Test refusing a frame cancels the write in progress, so nothing waits on it"""
+        client = Client()
+        client.stall()
+        queue = OutboundQueue(client.send, maxsize=1, policy='disconnect', stats_key='Test')
+
+        accepted = await self.put_all(queue, 3)
+        await asyncio.wait_for(queue.join(), timeout=1)
+
+        self.assertEqual(accepted, [True, True, False])
+        self.assertEqual(client.frames, [])
+        self.assertEqual(outbound_stats['Test'], {'depth': 0, 'dropped': 0, 'disconnected': 1})
+
+
+class Member:
+    """Records the chat messages a relay hands it"""
+
+    def __init__(self):
+        self.messages = []
+
+    async def chat_message(self, message):
+        self.messages.append(message['text'])
+
+
+class TestGroupFanOut(SimpleTestCase):
+
+    def test_relay_stays_in_the_group_past_the_layer_group_expiry(self):
+        """Test members get messages after the layer expired the relay's first membership"""
+        channel_layer = InMemoryChannelLayer(group_expiry=0.2)
+        fan_out = GroupFanOut()
+        first, second = Member(), Member()
+
+        async def run():
+            await fan_out.join(channel_layer, 'room_a', first)
+            await asyncio.sleep(0.5)
+            await fan_out.join(channel_layer, 'room_a', second)
+            await channel_layer.group_send('room_a', {'type': 'chat.message', 'text': 'hi'})
+            for _ in range(100):
+                if first.messages and second.messages:
+                    break
+                await asyncio.sleep(0.01)
+            for member in (first, second):
+                await fan_out.leave(channel_layer, 'room_a', member)
+
+        async_to_sync(run)()
+
+        self.assertEqual(first.messages, ['hi'])
+        self.assertEqual(second.messages, ['hi'])
+        self.assertEqual(len(fan_out), 0)
+
+
+class TestRecentMessages(SimpleTestCase):
+
+    def test_buffer_keeps_the_latest_messages_once_filled(self):
+        """Test appends only reach filled buffers, which keep the last size messages"""
+        history = RecentMessages(size=3, conversations=2)
+
+        history.append('room:a', 'lost')
+        self.assertIsNone(history.get('room:a'))
+
+        history.fill('room:a', ['one', 'two'])
+        for message in ('three', 'four'):
+            history.append('room:a', message)
+
+        self.assertEqual(history.get('room:a'), (['two', 'three', 'four'], None))
+
+    def test_messages_sent_while_reading_are_merged_into_the_buffer(self):
+        """Test a message appended during the read is kept whether or not the read saw it"""
+        history = RecentMessages(size=3, conversations=2)
+
+        async def read():
+            # 'two' was stored before the query ran, 'three' after it
+            history.append('room:a', 'two', message_id=2)
+            history.append('room:a', 'three', message_id=3)
+            await asyncio.sleep(0)
+            return [(1, 'one'), (2, 'two')]
+
+        messages = async_to_sync(history.load)('room:a', read)
+
+        self.assertEqual(messages, ['one', 'two', 'three'])
+        self.assertEqual(history.get('room:a'), (['one', 'two', 'three'], None))
+
+    def test_broadcasts_are_kept_once_while_the_conversation_is_listened_to(self):
+        """Test a message reaching several sockets is buffered once, and the buffer goes with the last listener"""
+        history = RecentMessages(size=3, conversations=2)
+        history.listen('room:a')
+        history.listen('room:a')
+        history.fill('room:a', ['one'], message_ids=[1])
+
+        for _ in range(2):
+            history.append('room:a', 'two', message_id=2)
+        history.append('room:a', 'one', message_id=1)
+        self.assertEqual(history.get('room:a'), (['one', 'two'], None))
+
+        history.unlisten('room:a')
+        self.assertIsNotNone(history.get('room:a'))
+        history.unlisten('room:a')
+        self.assertIsNone(history.get('room:a'))
+
+    def test_least_recently_used_conversation_is_evicted(self):
+        """Test the number of buffered conversations is capped"""
+        history = RecentMessages(size=3, conversations=2)
+        history.fill('room:a', ['a'])
+        history.fill('room:b', ['b'])
+        history.get('room:a')
+        history.fill('room:c', ['c'])
+
+        self.assertIsNotNone(history.get('room:a'))
+        self.assertIsNone(history.get('room:b'))
+        self.assertEqual(history.stats(), {'size': 2, 'maxsize': 2, 'hits': 2, 'misses': 1})
+
+
+class TestPresenceRegistry(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_user_stays_online_while_another_worker_has_their_sockets(self):
+        """Test closing a user's sockets on one worker leaves them online through the other"""
+        first, second = PresenceRegistry(ttl=60), PresenceRegistry(ttl=60)
+
+        async def run():
+            await first.connect('user')
+            await second.connect('user')
+            await first.disconnect('user')
+            online_elsewhere = await first.is_online('user')
+            await second.disconnect('user')
+            return online_elsewhere, await first.is_online('user')
+
+        online_elsewhere, online_after_all_closed = async_to_sync(run)()
+
+        self.assertTrue(online_elsewhere)
+        self.assertFalse(online_after_all_closed)
+        self.assertEqual(PresenceRegistry.last_seen(['user']), {'user': None})
+
+    def test_last_seen_is_the_latest_heartbeat_on_any_worker(self):
+        """Test a batch read reports users online on any worker"""
+        first, second = PresenceRegistry(ttl=60), PresenceRegistry(ttl=60)
+
+        async def run():
+            await first.connect('one')
+            await second.connect('two')
+            await second.connect('one')
+
+        async_to_sync(run)()
+        last_seen = PresenceRegistry.last_seen(['one', 'two', 'three'])
+
+        self.assertIsNotNone(last_seen['one'])
+        self.assertIsNotNone(last_seen['two'])
+        self.assertIsNone(last_seen['three'])
+
+
+class TestRecordMessages(TestCase):
+
+    def setUp(self):
+        self.alice = UserFactory(is_active=True)
+        self.bob = UserFactory(is_active=True, username='bob', email='bob@mail.com')
+
+    def message(self, sender, receiver, text):
+        message = Message(sender_id=str(sender.id), receiver_id=str(receiver.id), message=text)
+        message.set_conversation()
+        Message.objects.bulk_create([message])
+        return message
+
+    def unread(self):
+        return dict(ConversationSummary.objects.values_list('owner__username', 'unread_count'))
+
+    def test_retried_send_skipped_by_the_buffer_is_not_counted(self):
+        """Test rows bulk_create skipped as conflicts never reach the inbox"""
+        buffer = WriteBehindBuffer(Message, ignore_conflicts=True, on_write=record_messages)
+
+        for text in ('hello', 'hello again'):
+            message = Message(sender_id=self.alice.id, receiver_id=self.bob.id, message=text, client_message_id='retry')
+            message.set_conversation()
+            buffer._pending.append(message)
+            buffer.flush_sync()
+
+        self.assertEqual(self.unread(), {self.alice.username: 0, 'bob': 1})
+        self.assertEqual(ConversationSummary.objects.get(owner=self.bob).last_message, 'hello')
+
+    def test_batch_counts_unread_from_each_participants_last_message(self):
+        """Test a write-behind batch leaves each side with what arrived after they last wrote"""
+        record_messages([
+            self.message(self.alice, self.bob, 'one'),
+            self.message(self.bob, self.alice, 'two'),
+            self.message(self.alice, self.bob, 'three'),
+            self.message(self.alice, self.bob, 'four'),
+        ])
+
+        self.assertEqual(self.unread(), {self.alice.username: 0, 'bob': 2})
+        self.assertEqual(
+            set(ConversationSummary.objects.values_list('last_message', 'last_sender', 'other_user')),
+            {('four', self.alice.id, self.bob.id), ('four', self.alice.id, self.alice.id)},
+        )
+
+        record_messages([self.message(self.alice, self.bob, 'five')])
+        record_messages([self.message(self.bob, self.alice, 'six')])
+
+        self.assertEqual(self.unread(), {self.alice.username: 1, 'bob': 0})
+        self.assertEqual(ConversationSummary.objects.count(), 2)
+
+
+class TestReadWatermarks(TestCase):
+
+    def setUp(self):
+        self.user = UserFactory(is_active=True)
+        self.friend = UserFactory(is_active=True, username='friend', email='friend@mail.com')
+        self.rooms = [RoomFactory(room_name=f'ROOM {index}') for index in range(3)]
+        self.start = timezone.now() - timedelta(hours=1)
+        for room in self.rooms:
+            RoomMembersFactory(room=room, room_member=self.user, last_read_at=self.start)
+            RoomMembersFactory(room=room, room_member=self.friend, last_read_at=self.start)
+
+    def test_reads_are_written_once_per_member_and_never_move_back(self):
+        """Test many reads of a room cost one UPDATE, keeping the latest watermark"""
+        watermarks = ReadWatermarks(interval=60)
+        latest = timezone.now()
+
+        async def run():
+            for minutes in (30, 0, 50):
+                watermarks.advance(self.rooms[0].id, self.user.id, latest - timedelta(minutes=minutes))
+            watermarks.advance(self.rooms[0].id, self.friend.id, latest)
+            return await watermarks.flush()
+
+        with CaptureQueriesContext(connection) as queries:
+            written = async_to_sync(run)()
+
+        self.assertEqual(written, 2)
+        self.assertEqual(len([query for query in queries if query['sql'].startswith('UPDATE')]), 2)
+        self.assertEqual(RoomMembers.objects.get(room=self.rooms[0], room_member=self.user).last_read_at, latest)
+
+        async def move_back():
+            watermarks.advance(self.rooms[0].id, self.user.id, self.start)
+            await watermarks.flush()
+
+        async_to_sync(move_back)()
+        self.assertEqual(RoomMembers.objects.get(room=self.rooms[0], room_member=self.user).last_read_at, latest)
+
+    def test_unread_counts_of_every_room_in_one_query(self):
+        """Test messages after the watermark are counted per room, the user's own aside"""
+        RoomMessages.objects.create(room=self.rooms[0], sender=self.friend, message='one')
+        RoomMessages.objects.create(room=self.rooms[0], sender=self.friend, message='two')
+        RoomMessages.objects.create(room=self.rooms[0], sender=self.user, message='mine')
+        RoomMessages.objects.create(room=self.rooms[1], sender=self.friend, message='three')
+        RoomMembers.objects.filter(room=self.rooms[1], room_member=self.user).update(last_read_at=timezone.now())
+
+        with self.assertNumQueries(1):
+            counts = unread_counts(self.user.id)
+
+        self.assertEqual(
+            counts, {str(self.rooms[0].id): 2, str(self.rooms[1].id): 0, str(self.rooms[2].id): 0}
+        )
@@ -0,0 +1,82 @@
+import asyncio
+import os
+import tempfile
+from unittest import IsolatedAsyncioTestCase
+
+from channels.exceptions import ChannelFull
+
+from config.channel_layers import ChannelBroker, UnixSocketChannelLayer
+
+
+class TestUnixSocketChannelLayer(IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        path = os.path.join(self.directory.name, "channels.sock")
+        self.broker = ChannelBroker(path=path)
+        ready = asyncio.Event()
+        self.serving = asyncio.ensure_future(self.broker.serve(ready))
+        await ready.wait()
+
+        # Two workers of the same host
+        self.first = UnixSocketChannelLayer(path=path, capacity=2)
+        self.second = UnixSocketChannelLayer(path=path, expiry=0.1)
+
+    async def asyncTearDown(self):
+        await self.first.close()
+        await self.second.close()
+        self.serving.cancel()
+        self.directory.cleanup()
+
+    async def receive(self, layer, channel):
+        return await asyncio.wait_for(layer.receive(channel), timeout=1)
+
+    async def test_group_send_reaches_members_on_every_worker(self):
+        first_channel = await self.first.new_channel()
+        second_channel = await self.second.new_channel()
+        await self.first.group_add("room", first_channel)
+        await self.second.group_add("room", second_channel)
+
+        await self.first.group_send("room", {"type": "chat.message", "text": "hi"})
+
+        self.assertEqual(await self.receive(self.first, first_channel), {"type": "chat.message", "text": "hi"})
+        self.assertEqual(await self.receive(self.second, second_channel), {"type": "chat.message", "text": "hi"})
+
+        await self.second.group_discard("room", second_channel)
+        await self.second.send(first_channel, {"type": "direct"})
+        self.assertEqual(await self.receive(self.first, first_channel), {"type": "direct"})
+
+        await self.first.group_send("room", {"type": "second.gone"})
+        self.assertEqual(await self.receive(self.first, first_channel), {"type": "second.gone"})
+        self.assertEqual(list(self.broker.groups["room"]), [self.first.worker])
+
+    async def test_send_to_own_channel_respects_capacity(self):
+        channel = await self.first.new_channel()
+        await self.first.send(channel, {"type": "one"})
+        await self.first.send(channel, {"type": "two"})
+
+        with self.assertRaises(ChannelFull):
+            await self.first.send(channel, {"type": "three"})
+
+        self.assertEqual(await self.receive(self.first, channel), {"type": "one"})
+
+    async def test_expired_messages_are_skipped(self):
+        channel = await self.second.new_channel()
+        await self.second.send(channel, {"type": "stale"})
+        await asyncio.sleep(0.2)
+        await self.second.send(channel, {"type": "fresh"})
+
+        self.assertEqual(await self.receive(self.second, channel), {"type": "fresh"})
+
+    async def test_worker_leaving_drops_its_memberships(self):
+        channel = await self.second.new_channel()
+        await self.second.group_add("room", channel)
+        self.assertIn(self.second.worker, self.broker.groups["room"])
+
+        await self.second.close()
+        for _ in range(100):
+            if "room" not in self.broker.groups:
+                break
+            await asyncio.sleep(0.01)
+
+        self.assertNotIn("room", self.broker.groups)
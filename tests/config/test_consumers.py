@@ -0,0 +1,919 @@
+from unittest import mock, skipUnless
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from config.consumers import (
+    heartbeat_monitor,
+    message_buffer,
+    online_users,
+    read_watermarks,
+    recent_client_message_ids,
+    recent_messages,
+    room_fan_out,
+    room_message_buffer,
+    sequence_blocks,
+)
+from config.jwt_middleware import JWTAuthMiddleware
+from config.routing import websocket_urlpatterns
+from mimi.chats.models import ChatIDs, Message, RoomMessages
+from mimi.chats.utils.codecs import msgpack
+from mimi.chats.utils.heartbeat import connection_stats
+from mimi.chats.utils.watermarks import unread_counts
+from tests.accounts.factories import UserFactory
+from tests.chats.factories import RoomFactory, RoomMembersFactory
+
+
+application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+
+
+def communicator_for(user, path, subprotocols=None):
+    authorization_token = RefreshToken.for_user(user).access_token
+    headers = [(b'authorization', f'Bearer {authorization_token}'.encode())]
+    return WebsocketCommunicator(application, path, headers=headers, subprotocols=subprotocols)
+
+
+async def open_conversation(communicator):
+    """Connect to a chat or room and return the history frame sent on connect"""
+    connected, _ = await communicator.connect()
+    assert connected
+    return await communicator.receive_json_from()
+
+
+async def history_for(user, path):
+    communicator = communicator_for(user, path)
+    history = await open_conversation(communicator)
+    await communicator.disconnect()
+    return history
+
+
+class TestDirectMessageConsumer(TestCase):
+
+    def setUp(self):
+        self.sender = UserFactory(is_active=True)
+        self.receiver = UserFactory(is_active=True, username='receiver', email='receiver@mail.com')
+        self.chat = ChatIDs.objects.create(sender=self.sender, receiver=self.receiver)
+        self.path = f'/ws/chat/{self.chat.id}/'
+
+    def exchange(self, texts):
+        """Send texts as self.sender and return the events echoed back"""
+        async def run():
+            communicator = communicator_for(self.sender, self.path)
+            await open_conversation(communicator)
+
+            events = []
+            for text in texts:
+                await communicator.send_json_to({
+                    'message': text,
+                    'receiver_id': str(self.receiver.id),
+                })
+                events.append(await communicator.receive_json_from())
+
+            await communicator.disconnect()
+            return events
+
+        return async_to_sync(run)()
+
+    def test_message_is_stored_and_broadcast(self):
+        """Test a message is stored and echoed to the chat group"""
+        events = self.exchange(['hello'])
+
+        self.assertEqual(events[0]['message_info'], {'message': 'hello', 'sender': self.sender.username, 'sequence': 1})
+        self.assertTrue(Message.objects.filter(chat=self.chat, sender=self.sender, receiver=self.receiver, message='hello', sequence=1).exists())
+
+    @override_settings(CHAT_WRITE_BEHIND=True)
+    def test_write_behind_broadcasts_before_storing_and_flushes_on_disconnect(self):
+        """Test write-behind mode stores buffered messages in one batch on disconnect"""
+        events = self.exchange(['one', 'two', 'three'])
+
+        self.assertEqual([event['message_info']['message'] for event in events], ['one', 'two', 'three'])
+        self.assertEqual(len(message_buffer), 0)
+        self.assertEqual(Message.objects.filter(sender=self.sender).count(), 3)
+
+    def test_send_path_makes_no_sender_lookup(self):
+        """Test the sender is resolved at connect, so sending never reads the user table"""
+        # The first message of a conversation also creates its inbox rows.
+        self.exchange(['first'])
+        with CaptureQueriesContext(connection) as one_message:
+            self.exchange(['one'])
+        with CaptureQueriesContext(connection) as three_messages:
+            events = self.exchange(['one', 'two', 'three'])
+
+        self.assertEqual([event['message_info']['sender'] for event in events], [self.sender.username] * 3)
+        extra_queries = three_messages.captured_queries[len(one_message):]
+        self.assertEqual(len([query for query in extra_queries if query['sql'].startswith('INSERT')]), 2)
+        self.assertFalse(any('accounts_customuser' in query['sql'] for query in extra_queries))
+
+
+    def test_direct_message_reaches_every_device_of_both_participants(self):
+        """Test a DM is delivered through the user groups of sender and receiver"""
+        friend = UserFactory(is_active=True, username='friend', email='friend@mail.com')
+        other_chat_path = f'/ws/chat/{ChatIDs.objects.create(sender=friend, receiver=self.receiver).id}/'
+
+        async def run():
+            sender_phone = communicator_for(self.sender, self.path)
+            sender_laptop = communicator_for(self.sender, '/ws/multiplex/')
+            receiver_laptop = communicator_for(self.receiver, '/ws/multiplex/')
+            receiver_other_chat = communicator_for(self.receiver, other_chat_path)
+            communicators = [sender_phone, sender_laptop, receiver_laptop, receiver_other_chat]
+            for communicator in (sender_laptop, receiver_laptop):
+                await communicator.connect()
+            for communicator in (sender_phone, receiver_other_chat):
+                await open_conversation(communicator)
+            presence = await receiver_laptop.receive_json_from()
+
+            await sender_phone.send_json_to({'message': 'hello', 'receiver_id': str(self.receiver.id)})
+            frames = [
+                await sender_phone.receive_json_from(),
+                await sender_laptop.receive_json_from(),
+                await receiver_laptop.receive_json_from(),
+                presence,
+            ]
+            other_chat_is_quiet = await receiver_other_chat.receive_nothing()
+
+            for communicator in communicators:
+                await communicator.disconnect()
+            return frames, other_chat_is_quiet
+
+        frames, other_chat_is_quiet = async_to_sync(run)()
+
+        chat_id = self.path.split('/')[3]
+        self.assertEqual(frames[0]['message_info']['message'], 'hello')
+        self.assertEqual(frames[1]['stream'], f'chat:{chat_id}')
+        self.assertEqual(frames[2]['stream'], f'chat:{chat_id}')
+        self.assertEqual(frames[2]['payload']['message_info']['message'], 'hello')
+        self.assertEqual(frames[3]['payload']['type'], 'presence')
+        self.assertTrue(other_chat_is_quiet)
+
+
+    def resume(self, last_sequence):
+        async def run():
+            communicator = communicator_for(self.receiver, self.path)
+            await open_conversation(communicator)
+            await communicator.send_json_to({'action': 'resume', 'last_sequence': last_sequence})
+
+            frames = [await communicator.receive_json_from()]
+            while frames[-1]['type'] != 'resumed':
+                frames.append(await communicator.receive_json_from())
+
+            await communicator.disconnect()
+            return frames
+
+        return async_to_sync(run)()
+
+    def test_resume_replays_only_the_missed_messages(self):
+        """Test a reconnecting client gets the messages after its last seen sequence"""
+        self.exchange(['one', 'two', 'three'])
+
+        frames = self.resume(1)
+
+        self.assertEqual(
+            [frame['message_info'] for frame in frames[:-1]],
+            [
+                {'message': 'two', 'sender': self.sender.username, 'sequence': 2},
+                {'message': 'three', 'sender': self.sender.username, 'sequence': 3},
+            ]
+        )
+        self.assertEqual(frames[-1]['last_sequence'], 3)
+        self.assertTrue(frames[-1]['complete'])
+
+    @override_settings(CHAT_RESUME_LIMIT=2)
+    def test_resume_is_capped(self):
+        """Test a resume past CHAT_RESUME_LIMIT stops early and says so"""
+        self.exchange(['one', 'two', 'three'])
+
+        frames = self.resume(0)
+
+        self.assertEqual([frame['message_info']['sequence'] for frame in frames[:-1]], [1, 2])
+        self.assertEqual(frames[-1]['last_sequence'], 2)
+        self.assertFalse(frames[-1]['complete'])
+
+    @override_settings(CHAT_WRITE_BEHIND=True)
+    def test_write_behind_keeps_sequences_in_order(self):
+        """Test buffered messages are numbered when sent, not when stored"""
+        events = self.exchange(['one', 'two'])
+
+        self.assertEqual([event['message_info']['sequence'] for event in events], [1, 2])
+        self.assertEqual(list(Message.objects.order_by('sequence').values_list('message', flat=True)), ['one', 'two'])
+
+    @override_settings(CHAT_WRITE_BEHIND=True)
+    def test_write_behind_reserves_sequence_numbers_in_blocks(self):
+        """Test a block of sequence numbers costs one UPDATE for many messages"""
+        self.addCleanup(sequence_blocks.clear)
+        with mock.patch.object(sequence_blocks, 'size', 10), CaptureQueriesContext(connection) as queries:
+            events = self.exchange(['one', 'two', 'three'])
+
+        updates = [query for query in queries if query['sql'].startswith('UPDATE') and 'chats_chatids' in query['sql']]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual([event['message_info']['sequence'] for event in events], [1, 2, 3])
+        self.assertEqual(ChatIDs.objects.get(id=self.chat.id).last_sequence, 10)
+
+
+    def send_twice(self, client_message_id, forget_in_between=False, flush_in_between=False):
+        async def run():
+            communicator = communicator_for(self.sender, self.path)
+            await open_conversation(communicator)
+
+            frames = []
+            for _ in range(2):
+                await communicator.send_json_to({
+                    'message': 'hello',
+                    'receiver_id': str(self.receiver.id),
+                    'client_message_id': client_message_id,
+                })
+                frames.append(await communicator.receive_json_from())
+                if forget_in_between:
+                    recent_client_message_ids.clear()
+                if flush_in_between:
+                    await message_buffer.flush()
+            nothing_else = await communicator.receive_nothing()
+
+            await communicator.disconnect()
+            return frames, nothing_else
+
+        return async_to_sync(run)()
+
+    def test_retried_send_is_acknowledged_without_second_write(self):
+        """Test a retry with the same client message id is acked, not stored or broadcast again"""
+        frames, nothing_else = self.send_twice('retry-1')
+
+        self.assertEqual(frames[0]['type'], 'chat_message')
+        self.assertEqual(frames[0]['message_info']['client_message_id'], 'retry-1')
+        self.assertEqual(frames[1]['type'], 'ack')
+        self.assertTrue(frames[1]['duplicate'])
+        self.assertEqual(frames[1]['message_info'], frames[0]['message_info'])
+        self.assertTrue(nothing_else)
+        self.assertEqual(Message.objects.filter(client_message_id='retry-1').count(), 1)
+
+    def test_retry_missing_from_cache_is_caught_by_the_constraint(self):
+        """Test a retry the cache has forgotten is still recognised by the database"""
+        frames, _ = self.send_twice('retry-2', forget_in_between=True)
+
+        self.assertEqual(frames[1]['type'], 'ack')
+        self.assertEqual(frames[1]['message_info']['sequence'], 1)
+        self.assertEqual(Message.objects.filter(client_message_id='retry-2').count(), 1)
+        self.assertEqual(ChatIDs.objects.get(id=self.chat.id).last_sequence, 1)
+
+    @override_settings(CHAT_WRITE_BEHIND=True)
+    def test_write_behind_retry_missing_from_cache_is_not_broadcast_again(self):
+        """Test a forgotten retry is found buffered or stored before it gets a new sequence number"""
+        for client_message_id, flush_in_between in (('retry-3', False), ('retry-4', True)):
+            frames, nothing_else = self.send_twice(
+                client_message_id, forget_in_between=True, flush_in_between=flush_in_between
+            )
+
+            self.assertEqual(frames[1]['type'], 'ack')
+            self.assertEqual(frames[1]['message_info'], frames[0]['message_info'])
+            self.assertTrue(nothing_else)
+            self.assertEqual(Message.objects.filter(client_message_id=client_message_id).count(), 1)
+
+        self.assertEqual(ChatIDs.objects.get(id=self.chat.id).last_sequence, 2)
+
+
+    def test_backlog_is_sent_on_connect_from_memory(self):
+        """Test opening a chat sends its latest messages without reading them again"""
+        async def run():
+            sender = communicator_for(self.sender, self.path)
+            await open_conversation(sender)
+            for text in ('one', 'two'):
+                await sender.send_json_to({'message': text})
+                await sender.receive_json_from()
+
+            misses = recent_messages.misses
+            history = await history_for(self.receiver, self.path)
+            read_again = recent_messages.misses > misses
+
+            await sender.disconnect()
+            return history, read_again
+
+        history, read_again = async_to_sync(run)()
+
+        self.assertEqual(history['type'], 'history')
+        self.assertEqual([message['message'] for message in history['messages']], ['one', 'two'])
+        self.assertEqual([message['sequence'] for message in history['messages']], [1, 2])
+        self.assertFalse(read_again)
+
+    def test_backlog_has_messages_broadcast_through_other_workers(self):
+        """Test messages this worker only received as broadcasts are in the backlog, once each"""
+        async def run():
+            sender = communicator_for(self.sender, self.path)
+            await open_conversation(sender)
+
+            # What another worker's send puts on the layer, delivered twice
+            event = {
+                'type': 'chat_message',
+                'stream': f'chat:{self.chat.id}',
+                'message_info': {'message': 'elsewhere', 'sender': self.receiver.username, 'sequence': 1},
+                'message_id': '5b0f6a9e-8a8e-4c0b-9d57-3f1f1c1d2e3f',
+            }
+            for _ in range(2):
+                await get_channel_layer().group_send(f'user_{self.sender.id}', dict(event))
+                await sender.receive_json_from()
+
+            misses = recent_messages.misses
+            history = await history_for(self.receiver, self.path)
+            read_again = recent_messages.misses > misses
+
+            await sender.disconnect()
+            return history, read_again
+
+        history, read_again = async_to_sync(run)()
+
+        self.assertEqual([message['message'] for message in history['messages']], ['elsewhere'])
+        self.assertFalse(read_again)
+
+    def test_backlog_miss_is_read_from_the_database(self):
+        """Test an evicted chat is reloaded from the database"""
+        self.exchange(['one', 'two'])
+        recent_messages.clear()
+
+        history = async_to_sync(history_for)(self.receiver, self.path)
+
+        self.assertEqual(
+            history['messages'],
+            [
+                {'message': 'one', 'sender': self.sender.username, 'sequence': 1},
+                {'message': 'two', 'sender': self.sender.username, 'sequence': 2},
+            ]
+        )
+
+    def test_outsider_is_refused_and_receiver_comes_from_the_chat(self):
+        """Test only participants can connect, and a client-supplied receiver_id is ignored"""
+        outsider = UserFactory(is_active=True, username='outsider', email='outsider@mail.com')
+
+        async def run():
+            refused = await history_for(outsider, self.path)
+
+            communicator = communicator_for(self.sender, self.path)
+            await open_conversation(communicator)
+            await communicator.send_json_to({'message': 'hello', 'receiver_id': str(outsider.id)})
+            await communicator.receive_json_from()
+            await communicator.disconnect()
+            return refused
+
+        with CaptureQueriesContext(connection) as queries:
+            refused = async_to_sync(run)()
+
+        self.assertEqual(refused, {'error': "Chat doesn't exist or you aren't part of the chat"})
+        self.assertTrue(Message.objects.filter(sender=self.sender, receiver=self.receiver, message='hello').exists())
+        self.assertFalse(Message.objects.filter(receiver=outsider).exists())
+        # Loaded once, on the first connect
+        self.assertEqual(len([query for query in queries if 'FROM "chats_chatids"' in query['sql']]), 1)
+
+    @mock.patch.object(heartbeat_monitor, 'timeout', 0.3)
+    @mock.patch.object(heartbeat_monitor, 'interval', 0.05)
+    def test_silent_socket_is_pinged_then_reaped_and_cleaned_up(self):
+        """Test a client that stops answering pings is closed and leaves its groups"""
+        stats_before = dict(connection_stats['DirectMessageConsumer'])
+
+        async def run():
+            communicator = communicator_for(self.sender, self.path)
+            await open_conversation(communicator)
+            first_ping = await communicator.receive_json_from()
+            await communicator.send_json_to({'action': 'pong'})
+
+            while True:
+                output = await communicator.receive_output()
+                if output['type'] == 'websocket.close':
+                    break
+            stats_after_reaping = dict(connection_stats['DirectMessageConsumer'])
+            still_online = str(self.sender.id) in online_users.connections
+
+            await communicator.disconnect()
+            return first_ping, output, stats_after_reaping, still_online
+
+        first_ping, close, stats_after_reaping, still_online = async_to_sync(run)()
+
+        self.assertEqual(first_ping, {'type': 'ping'})
+        self.assertEqual(close['code'], 4009)
+        self.assertEqual(stats_after_reaping, stats_before)
+        self.assertEqual(connection_stats['DirectMessageConsumer'], stats_before)
+        self.assertFalse(still_online)
+        self.assertFalse(Message.objects.exists())
+
+    @override_settings(CHAT_RATE_LIMIT=1, CHAT_RATE_LIMIT_BURST=2, CHAT_USER_RATE_LIMIT=0)
+    def test_flood_is_rejected_before_any_database_work(self):
+        """Test frames over the connection's limit get one error frame and are never stored"""
+        async def run():
+            communicator = communicator_for(self.sender, self.path)
+            await open_conversation(communicator)
+
+            frames = []
+            for text in ('one', 'two', 'three', 'four'):
+                await communicator.send_json_to({'message': text, 'receiver_id': str(self.receiver.id)})
+            for _ in range(3):
+                frames.append(await communicator.receive_json_from())
+            only_one_error = await communicator.receive_nothing()
+
+            await communicator.disconnect()
+            return frames, only_one_error
+
+        frames, only_one_error = async_to_sync(run)()
+
+        # Echoes come back through the user group, after the error
+        errors = [frame for frame in frames if frame['type'] == 'error']
+        self.assertEqual([frame['message_info']['message'] for frame in frames if frame not in errors], ['one', 'two'])
+        self.assertEqual(len(errors), 1)
+        self.assertGreater(errors[0]['retry_after'], 0)
+        self.assertTrue(only_one_error)
+        self.assertEqual(list(Message.objects.filter(sender=self.sender).values_list('message', flat=True).order_by('sequence')), ['one', 'two'])
+
+    @skipUnless(msgpack, 'msgpack is not installed')
+    def test_msgpack_subprotocol_gets_binary_frames(self):
+        """Test a client offering the msgpack subprotocol talks MessagePack both ways"""
+        async def run():
+            communicator = communicator_for(self.sender, self.path, subprotocols=['msgpack'])
+            connected, subprotocol = await communicator.connect()
+            history = msgpack.unpackb(await communicator.receive_from())
+
+            await communicator.send_to(bytes_data=msgpack.packb({
+                'message': 'packed',
+                'receiver_id': str(self.receiver.id),
+            }))
+            frame = await communicator.receive_from()
+
+            await communicator.disconnect()
+            return subprotocol, history, frame
+
+        subprotocol, history, frame = async_to_sync(run)()
+
+        self.assertEqual(subprotocol, 'msgpack')
+        self.assertEqual(history['type'], 'history')
+        self.assertIsInstance(frame, bytes)
+        self.assertEqual(msgpack.unpackb(frame)['message_info']['message'], 'packed')
+        self.assertTrue(Message.objects.filter(chat=self.chat, message='packed').exists())
+
+    @override_settings(CHAT_OUTBOUND_WINDOW=1)
+    def test_frames_wait_for_the_client_to_ack(self):
+        """Test a client that acks gets no more than the window of unacknowledged frames"""
+        async def run():
+            communicator = communicator_for(self.sender, self.path)
+            await open_conversation(communicator)
+            await communicator.send_json_to({'action': 'ack', 'received': 1})
+
+            frames = []
+            for text in ('one', 'two'):
+                await communicator.send_json_to({'message': text})
+            frames.append(await communicator.receive_json_from())
+            held_back = await communicator.receive_nothing()
+
+            await communicator.send_json_to({'action': 'ack', 'received': 2})
+            frames.append(await communicator.receive_json_from())
+
+            await communicator.disconnect()
+            return frames, held_back
+
+        frames, held_back = async_to_sync(run)()
+
+        self.assertTrue(held_back)
+        self.assertEqual([frame['message_info']['message'] for frame in frames], ['one', 'two'])
+        self.assertEqual(Message.objects.count(), 2)
+
+
+class TestRoomMessageConsumer(TestCase):
+
+    def setUp(self):
+        self.member = UserFactory(is_active=True)
+        self.other_member = UserFactory(is_active=True, username='member', email='member@mail.com')
+        self.outsider = UserFactory(is_active=True, username='outsider', email='outsider@mail.com')
+        self.room = RoomFactory()
+        RoomMembersFactory(room=self.room, room_member=self.member)
+        RoomMembersFactory(room=self.room, room_member=self.other_member)
+        self.path = f'/ws/room-chat/{self.room.id}/'
+        self.addCleanup(read_watermarks.clear)
+
+    def test_messages_shown_on_an_open_room_are_read(self):
+        """Test delivered messages advance the watermark of connected members only"""
+        away = UserFactory(is_active=True, username='away', email='away@mail.com')
+        RoomMembersFactory(room=self.room, room_member=away)
+
+        async def run():
+            sender = communicator_for(self.member, self.path)
+            listener = communicator_for(self.other_member, self.path)
+            await open_conversation(sender)
+            await open_conversation(listener)
+            await sender.receive_json_from()  # listener's presence
+
+            await sender.send_json_to({'message': 'hello room'})
+            await listener.receive_json_from()
+            pending = len(read_watermarks)
+            await read_watermarks.flush()
+
+            await sender.disconnect()
+            await listener.disconnect()
+            return pending
+
+        pending = async_to_sync(run)()
+
+        self.assertEqual(pending, 2)
+        self.assertEqual(unread_counts(self.other_member.id), {str(self.room.id): 0})
+        self.assertEqual(unread_counts(away.id), {str(self.room.id): 1})
+
+    @override_settings(CHAT_WRITE_BEHIND=True)
+    def test_write_behind_messages_shown_on_an_open_room_are_read(self):
+        """Test a message stored after it was delivered doesn't count as unread"""
+        async def run():
+            sender = communicator_for(self.member, self.path)
+            listener = communicator_for(self.other_member, self.path)
+            await open_conversation(sender)
+            await open_conversation(listener)
+            await sender.receive_json_from()  # listener's presence
+
+            await sender.send_json_to({'message': 'hello room'})
+            await listener.receive_json_from()
+            await read_watermarks.flush()
+            await room_message_buffer.flush()
+
+            await sender.disconnect()
+            await listener.disconnect()
+
+        async_to_sync(run)()
+
+        self.assertTrue(RoomMessages.objects.filter(message='hello room').exists())
+        self.assertEqual(unread_counts(self.other_member.id), {str(self.room.id): 0})
+
+    def test_room_message_is_stored_and_broadcast_to_members(self):
+        """Test a message sent to a room is stored and delivered to every member"""
+        async def run():
+            sender = communicator_for(self.member, self.path)
+            listener = communicator_for(self.other_member, self.path)
+            await open_conversation(sender)
+            await open_conversation(listener)
+
+            listener_joined = await sender.receive_json_from()
+            self.assertEqual(listener_joined['type'], 'presence')
+
+            await sender.send_json_to({'message': 'hello room'})
+            events = [await sender.receive_json_from(), await listener.receive_json_from()]
+
+            await sender.disconnect()
+            await listener.disconnect()
+            return events
+
+        events = async_to_sync(run)()
+
+        for event in events:
+            self.assertEqual(event['message_info'], {'message': 'hello room', 'sender': self.member.username})
+        self.assertTrue(RoomMessages.objects.filter(room=self.room, sender=self.member, message='hello room').exists())
+
+    def test_room_group_is_joined_once_per_worker(self):
+        """Test every socket of a room is reached through a single group membership"""
+        async def run():
+            channel_layer = get_channel_layer()
+            group = f'room_{self.room.id}'
+            sender = communicator_for(self.member, self.path)
+            listener = communicator_for(self.other_member, self.path)
+            await open_conversation(sender)
+            await open_conversation(listener)
+            await sender.receive_json_from()
+
+            memberships = len(channel_layer.groups[group])
+            members = len(room_fan_out.relays[group].members)
+            capacity = channel_layer.get_capacity(room_fan_out.relays[group].channel)
+            await sender.send_json_to({'message': 'hello room'})
+            events = [await sender.receive_json_from(), await listener.receive_json_from()]
+
+            await sender.disconnect()
+            await listener.disconnect()
+            return memberships, members, capacity, events, group in channel_layer.groups
+
+        memberships, members, capacity, events, group_left = async_to_sync(run)()
+
+        self.assertEqual((memberships, members), (1, 2))
+        # A full relay channel would drop the message for every local member
+        self.assertEqual(capacity, settings.CHANNEL_CAPACITY['relay.*'])
+        self.assertEqual([event['message_info']['message'] for event in events], ['hello room'] * 2)
+        self.assertFalse(group_left)
+        self.assertEqual(len(room_fan_out), 0)
+
+    def test_non_member_is_rejected(self):
+        """Test a user outside the room gets an error and is disconnected"""
+        async def run():
+            communicator = communicator_for(self.outsider, self.path)
+            await communicator.connect()
+            error = await communicator.receive_json_from()
+            output = await communicator.receive_output()
+            return error, output
+
+        error, output = async_to_sync(run)()
+
+        self.assertIn("aren't a member", error['error'])
+        self.assertEqual(output['type'], 'websocket.close')
+
+
+    def test_room_backlog_is_sent_on_connect(self):
+        """Test members opening a room get its latest messages, from memory or the database"""
+        async def run():
+            sender = communicator_for(self.member, self.path)
+            await open_conversation(sender)
+            for text in ('one', 'two'):
+                await sender.send_json_to({'message': text})
+                await sender.receive_json_from()
+            await sender.disconnect()
+
+            histories = [await history_for(self.other_member, self.path)]
+            recent_messages.clear()
+            histories.append(await history_for(self.other_member, self.path))
+            return histories
+
+        for history in async_to_sync(run)():
+            self.assertEqual(
+                history['messages'],
+                [
+                    {'message': 'one', 'sender': self.member.username},
+                    {'message': 'two', 'sender': self.member.username},
+                ]
+            )
+
+    def test_presence_and_debounced_typing_reach_the_other_members(self):
+        """Test members see each other come and go, and typing bursts are debounced"""
+        async def run():
+            typist = communicator_for(self.member, self.path)
+            listener = communicator_for(self.other_member, self.path)
+            await open_conversation(listener)
+            await open_conversation(typist)
+
+            frames = [await listener.receive_json_from()]
+            for _ in range(3):
+                await typist.send_json_to({'action': 'typing'})
+            frames.append(await listener.receive_json_from())
+            typing_debounced = await listener.receive_nothing()
+            typist_is_quiet = await typist.receive_nothing()
+
+            await typist.disconnect()
+            frames.append(await listener.receive_json_from())
+            await listener.disconnect()
+            return frames, typing_debounced, typist_is_quiet
+
+        frames, typing_debounced, typist_is_quiet = async_to_sync(run)()
+
+        self.assertEqual([frame['type'] for frame in frames], ['presence', 'typing', 'presence'])
+        self.assertEqual([frame.get('online') for frame in frames], [True, None, False])
+        self.assertTrue(all(frame['username'] == self.member.username for frame in frames))
+        self.assertTrue(typing_debounced)
+        self.assertTrue(typist_is_quiet)
+        self.assertFalse(RoomMessages.objects.exists())
+
+    @override_settings(CHAT_COALESCE_WINDOW=0.05, CHAT_COALESCE_MAX_BATCH=2)
+    def test_coalescing_batches_events_into_array_frames(self):
+        """Test bursts are sent as arrays, flushed by size or once the window closes"""
+        async def run():
+            sender = communicator_for(self.member, self.path)
+            listener = communicator_for(self.other_member, self.path)
+            await open_conversation(sender)
+            await open_conversation(listener)
+
+            for text in ('one', 'two', 'three'):
+                await sender.send_json_to({'message': text})
+            frames = [await listener.receive_json_from(), await listener.receive_json_from()]
+
+            await sender.disconnect()
+            await listener.disconnect()
+            return frames
+
+        frames = async_to_sync(run)()
+
+        self.assertEqual([[event['message_info']['message'] for event in frame] for frame in frames], [['one', 'two'], ['three']])
+
+
+class TestMultiplexConsumer(TestCase):
+
+    def setUp(self):
+        self.user = UserFactory(is_active=True)
+        self.friend = UserFactory(is_active=True, username='friend', email='friend@mail.com')
+        self.room = RoomFactory()
+        RoomMembersFactory(room=self.room, room_member=self.user)
+        self.chat_stream = f'chat:{ChatIDs.objects.create(sender=self.user, receiver=self.friend).id}'
+        self.room_stream = f'room:{self.room.id}'
+        self.addCleanup(read_watermarks.clear)
+
+    def test_one_socket_carries_chat_and_room_streams(self):
+        """Test a single socket can subscribe and send to a chat and a room"""
+        async def run():
+            communicator = communicator_for(self.user, '/ws/multiplex/')
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+
+            frames = []
+            for stream in (self.chat_stream, self.room_stream):
+                await communicator.send_json_to({'stream': stream, 'action': 'subscribe'})
+                frames.append(await communicator.receive_json_from())
+                history = await communicator.receive_json_from()
+                self.assertEqual(history, {'stream': stream, 'payload': {'type': 'history', 'messages': []}})
+
+            await communicator.send_json_to({
+                'stream': self.chat_stream,
+                'action': 'send',
+                'payload': {'message': 'hi friend'},
+            })
+            frames.append(await communicator.receive_json_from())
+            await communicator.send_json_to({
+                'stream': self.room_stream,
+                'action': 'send',
+                'payload': {'message': 'hi room'},
+            })
+            frames.append(await communicator.receive_json_from())
+
+            await communicator.send_json_to({'stream': self.room_stream, 'action': 'unsubscribe'})
+            frames.append(await communicator.receive_json_from())
+
+            await communicator.disconnect()
+            return frames
+
+        frames = async_to_sync(run)()
+
+        self.assertEqual(frames[0], {'stream': self.chat_stream, 'subscribed': True})
+        self.assertEqual(frames[1], {'stream': self.room_stream, 'subscribed': True})
+        self.assertEqual(frames[2]['stream'], self.chat_stream)
+        self.assertEqual(frames[2]['payload']['message_info']['message'], 'hi friend')
+        self.assertEqual(frames[3]['stream'], self.room_stream)
+        self.assertEqual(frames[3]['payload']['message_info']['message'], 'hi room')
+        self.assertEqual(frames[4], {'stream': self.room_stream, 'subscribed': False})
+        self.assertTrue(Message.objects.filter(sender=self.user, receiver=self.friend).exists())
+        self.assertTrue(RoomMessages.objects.filter(room=self.room, sender=self.user).exists())
+
+    def test_cannot_subscribe_to_room_without_membership_or_send_unsubscribed(self):
+        """Test room subscriptions need membership and sends need a subscription"""
+        other_room = RoomFactory(room_name='OTHER ROOM')
+
+        async def run():
+            communicator = communicator_for(self.user, '/ws/multiplex/')
+            await communicator.connect()
+
+            await communicator.send_json_to({'stream': f'room:{other_room.id}', 'action': 'subscribe'})
+            subscribe_error = await communicator.receive_json_from()
+            await communicator.send_json_to({
+                'stream': self.room_stream,
+                'action': 'send',
+                'payload': {'message': 'hi room'},
+            })
+            send_error = await communicator.receive_json_from()
+
+            await communicator.disconnect()
+            return subscribe_error, send_error
+
+        subscribe_error, send_error = async_to_sync(run)()
+
+        self.assertIn("aren't a member", subscribe_error['error'])
+        self.assertEqual(send_error['error'], 'Subscribe to the stream first')
+        self.assertFalse(RoomMessages.objects.exists())
+
+    def test_upper_case_ids_name_the_same_streams(self):
+        """Test ids are canonicalised, so upper case ones reach the same chats and rooms"""
+        chat_id = self.chat_stream.partition(':')[2]
+
+        async def run():
+            chat_socket = communicator_for(self.friend, f'/ws/chat/{chat_id.upper()}/')
+            room_socket = communicator_for(self.user, f'/ws/room-chat/{str(self.room.id).upper()}/')
+            multiplex = communicator_for(self.user, '/ws/multiplex/')
+            await open_conversation(chat_socket)
+            await open_conversation(room_socket)
+            await multiplex.connect()
+
+            await multiplex.send_json_to({'stream': f'room:{str(self.room.id).upper()}', 'action': 'subscribe'})
+            subscribed = await multiplex.receive_json_from()
+            await multiplex.receive_json_from()
+            await multiplex.send_json_to({
+                'stream': f'chat:{chat_id.upper()}',
+                'action': 'send',
+                'payload': {'message': 'hi friend'},
+            })
+            echoed = await multiplex.receive_json_from()
+            received = await chat_socket.receive_json_from()
+
+            await room_socket.send_json_to({'message': 'hi room'})
+            await room_socket.receive_json_from()
+            room_frame = await multiplex.receive_json_from()
+
+            for communicator in (chat_socket, room_socket, multiplex):
+                await communicator.disconnect()
+            return subscribed, echoed, received, room_frame
+
+        subscribed, echoed, received, room_frame = async_to_sync(run)()
+
+        self.assertEqual(subscribed, {'stream': self.room_stream, 'subscribed': True})
+        self.assertEqual(echoed['stream'], self.chat_stream)
+        self.assertEqual(received['message_info']['message'], 'hi friend')
+        self.assertEqual(room_frame['stream'], self.room_stream)
+        self.assertEqual(room_frame['payload']['message_info']['message'], 'hi room')
+
+    def test_malformed_frames_get_errors_without_closing_the_socket(self):
+        """Test undecodable frames and bad payloads are answered with errors, and the socket stays usable"""
+        async def run():
+            communicator = communicator_for(self.user, '/ws/multiplex/')
+            await communicator.connect()
+
+            await communicator.send_to(text_data='{not json')
+            errors = [await communicator.receive_json_from()]
+            await communicator.send_json_to(['not', 'an', 'object'])
+            errors.append(await communicator.receive_json_from())
+            for payload in ({}, 'hi', {'message': ['hi']}):
+                await communicator.send_json_to({'stream': self.chat_stream, 'action': 'send', 'payload': payload})
+                errors.append(await communicator.receive_json_from())
+
+            await communicator.send_json_to({
+                'stream': self.chat_stream,
+                'action': 'send',
+                'payload': {'message': 'still here'},
+            })
+            sent = await communicator.receive_json_from()
+
+            await communicator.disconnect()
+            return errors, sent
+
+        errors, sent = async_to_sync(run)()
+
+        self.assertEqual(errors[:2], [{'stream': None, 'error': 'Invalid frame'}] * 2)
+        self.assertEqual(
+            errors[2:], [{'stream': self.chat_stream, 'error': 'payload must be an object with a message string'}] * 3
+        )
+        self.assertEqual(sent['payload']['message_info']['message'], 'still here')
+        self.assertEqual(Message.objects.count(), 1)
+
+    def test_opening_many_streams_is_not_rate_limited_like_sends(self):
+        """Test subscribes have their own budget, so a client can open 30 conversations at once"""
+        rooms = [RoomFactory(room_name=f'ROOM {index}') for index in range(30)]
+        for room in rooms:
+            RoomMembersFactory(room=room, room_member=self.user)
+
+        async def run():
+            communicator = communicator_for(self.user, '/ws/multiplex/')
+            await communicator.connect()
+
+            replies = []
+            for room in rooms:
+                await communicator.send_json_to({'stream': f'room:{room.id}', 'action': 'subscribe'})
+                replies.append(await communicator.receive_json_from())
+                await communicator.receive_json_from()
+
+            await communicator.disconnect()
+            return replies
+
+        replies = async_to_sync(run)()
+
+        self.assertEqual(replies, [{'stream': f'room:{room.id}', 'subscribed': True} for room in rooms])
+
+    @override_settings(CHAT_RATE_LIMIT=1, CHAT_RATE_LIMIT_BURST=2, CHAT_USER_RATE_LIMIT=0)
+    def test_every_send_over_the_limit_gets_a_stream_error(self):
+        """Test each rejected send is answered on its stream and never stored"""
+        async def run():
+            communicator = communicator_for(self.user, '/ws/multiplex/')
+            await communicator.connect()
+
+            for text in ('one', 'two', 'three', 'four'):
+                await communicator.send_json_to({
+                    'stream': self.chat_stream,
+                    'action': 'send',
+                    'payload': {'message': text},
+                })
+            frames = [await communicator.receive_json_from() for _ in range(4)]
+            nothing_else = await communicator.receive_nothing()
+
+            await communicator.disconnect()
+            return frames, nothing_else
+
+        frames, nothing_else = async_to_sync(run)()
+
+        errors = [frame for frame in frames if 'error' in frame]
+        self.assertEqual(len(errors), 2)
+        for error in errors:
+            self.assertEqual(error['stream'], self.chat_stream)
+            self.assertEqual(error['error'], 'Too many messages, slow down')
+            self.assertGreater(error['retry_after'], 0)
+        self.assertTrue(nothing_else)
+        self.assertEqual(sorted(Message.objects.values_list('message', flat=True)), ['one', 'two'])
+
+    def test_chat_streams_of_other_users_are_refused(self):
+        """Test a chat the user isn't part of can't be subscribed, sent or resumed on"""
+        stranger = UserFactory(is_active=True, username='stranger', email='stranger@mail.com')
+        stream = f'chat:{ChatIDs.objects.create(sender=self.friend, receiver=stranger).id}'
+
+        async def run():
+            communicator = communicator_for(self.user, '/ws/multiplex/')
+            await communicator.connect()
+
+            errors = []
+            for frame in (
+                {'stream': stream, 'action': 'subscribe'},
+                {'stream': stream, 'action': 'send', 'payload': {'message': 'hi'}},
+                {'stream': stream, 'action': 'resume', 'last_sequence': 0},
+            ):
+                await communicator.send_json_to(frame)
+                errors.append(await communicator.receive_json_from())
+
+            await communicator.disconnect()
+            return errors
+
+        errors = async_to_sync(run)()
+
+        self.assertEqual(
+            errors, [{'stream': stream, 'error': "Chat doesn't exist or you aren't part of the chat"}] * 3
+        )
+        self.assertFalse(Message.objects.exists())
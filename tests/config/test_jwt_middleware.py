@@ -0,0 +1,44 @@
+from rest_framework_simplejwt.tokens import RefreshToken
+from django.test import TestCase
+
+from config.jwt_middleware import JWTAuthMiddleware
+from tests.accounts.factories import UserFactory
+
+
+class TestJWTAuthMiddleware(TestCase):
+
+    def setUp(self):
+        self.user = UserFactory(is_active=True)
+        self.middleware = JWTAuthMiddleware(None)
+        JWTAuthMiddleware.identity_cache.clear()
+
+    def test_valid_token_is_decoded_then_served_from_cache(self):
+        """Test a token is decoded once and later lookups hit the cache"""
+        token = str(RefreshToken.for_user(self.user).access_token)
+
+        with self.assertNumQueries(0):
+            first = self.middleware.get_user_from_token(token)
+            second = self.middleware.get_user_from_token(token)
+
+        self.assertEqual(first, str(self.user.id))
+        self.assertEqual(second, first)
+        stats = JWTAuthMiddleware.cache_stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['size'], 1)
+
+    def test_invalid_token_is_not_cached(self):
+        """Test an invalid token returns None and is never cached"""
+        self.assertIsNone(self.middleware.get_user_from_token('not-a-token'))
+        self.assertIsNone(self.middleware.get_user_from_token('not-a-token'))
+        self.assertEqual(JWTAuthMiddleware.cache_stats()['size'], 0)
+
+    def test_cached_identity_expires_with_token(self):
+        """Test a cached identity is dropped once the token's expiry has passed"""
+        token = str(RefreshToken.for_user(self.user).access_token)
+        self.middleware.get_user_from_token(token)
+
+        key, (user_id, _) = next(iter(JWTAuthMiddleware.identity_cache._data.items()))
+        JWTAuthMiddleware.identity_cache.set(key, user_id, expires_at=0)
+
+        self.assertNotIn(key, JWTAuthMiddleware.identity_cache)